@@ -0,0 +1,97 @@
+"""
+Load benchmark of the KeyCloakAuthenticator hot paths, against the in-process fake OIDC provider.
+
+Logs in N simulated users with `authenticate`, then refreshes them all with `refresh_user`,
+with the given concurrency, and reports the latency percentiles and the throughput of each phase.
+
+Example:
+
+    python KeyCloakAuthenticator/benchmarks/auth_benchmark.py --users 1000 --concurrency 50 \
+        --latency 0.01 --exchange-token eos-service --exchange-token cernbox-service
+"""
+import asyncio
+import time
+
+import click
+from keycloakauthenticator.tests.fake_idp import (
+    FakeIdP,
+    FakeLoginHandler,
+    FakeUser,
+    configured_authenticator,
+)
+
+
+def _percentile(values, percent):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+async def _run_phase(name, calls, concurrency):
+    """Run the coroutine functions in calls with the given concurrency and report their latencies"""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def timed(call):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                if not await call():
+                    errors += 1
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(timed(call) for call in calls))
+    elapsed = time.perf_counter() - start
+
+    click.echo(
+        f"{name:<14} {len(calls):>7} calls  {errors:>5} errors  {len(calls) / elapsed:>9.1f} req/s  "
+        f"p50 {_percentile(latencies, 50) * 1000:>8.1f} ms  "
+        f"p95 {_percentile(latencies, 95) * 1000:>8.1f} ms  "
+        f"p99 {_percentile(latencies, 99) * 1000:>8.1f} ms"
+    )
+
+
+async def _benchmark(users, concurrency, latency, error_rate, exchange_tokens):
+    idp = FakeIdP(latency=latency, error_rate=error_rate).start()
+    try:
+        authenticator = await configured_authenticator(idp, exchange_tokens=list(exchange_tokens))
+        fake_users = [FakeUser(f"user{i}") for i in range(users)]
+
+        def login(user):
+            async def call():
+                auth_model = await authenticator.authenticate(FakeLoginHandler(user.name))
+                if auth_model:
+                    user.auth_state = auth_model["auth_state"]
+                return auth_model
+            return call
+
+        def refresh(user):
+            async def call():
+                return await authenticator.refresh_user(user)
+            return call
+
+        await _run_phase("authenticate", [login(user) for user in fake_users], concurrency)
+        await _run_phase("refresh_user", [refresh(user) for user in fake_users if user.auth_state], concurrency)
+        click.echo(f"IdP requests: {idp.requests}")
+    finally:
+        idp.stop()
+
+
+@click.command()
+@click.option("--users", default=500, show_default=True, help="Number of simulated users")
+@click.option("--concurrency", default=50, show_default=True, help="Maximum number of calls in progress")
+@click.option("--latency", default=0.0, show_default=True, help="Latency (in seconds) of every IdP request")
+@click.option("--error-rate", default=0.0, show_default=True, help="Ratio of IdP requests failing with a 503")
+@click.option("--exchange-token", "exchange_tokens", multiple=True, help="Audience to exchange tokens for (repeatable)")
+def main(users, concurrency, latency, error_rate, exchange_tokens):
+    asyncio.run(_benchmark(users, concurrency, latency, error_rate, exchange_tokens))
+
+
+if __name__ == "__main__":
+    main()
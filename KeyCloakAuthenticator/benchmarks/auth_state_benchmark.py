@@ -0,0 +1,78 @@
+"""
+Benchmark of the size and encryption cost of the auth_state stored on every refresh, for each layout.
+
+jupyterhub serializes the auth_state to JSON and encrypts it with Fernet every time it is saved,
+and decrypts it every time it is read. This measures both, and the size of the database row,
+for the layout stored before versioning, the current one, and the current one compressed.
+
+Example:
+
+    python KeyCloakAuthenticator/benchmarks/auth_state_benchmark.py --exchange-token eos-service \
+        --exchange-token cernbox-service --iterations 5000
+"""
+import json
+import time
+
+import click
+from cryptography.fernet import Fernet, MultiFernet
+from keycloakauthenticator.state import (
+    compact_auth_state,
+    compress_auth_state,
+    read_auth_state,
+)
+from keycloakauthenticator.tests.fake_idp import FakeIdP
+
+
+def _legacy_auth_state(idp, username, exchange_tokens):
+    """auth_state as stored by the KeyCloakAuthenticator before it was versioned"""
+    token_response = {
+        "access_token": idp.issue(username),
+        "refresh_token": idp.issue(username, lifetime=idp.refresh_token_lifetime),
+        "id_token": idp.issue(username),
+        "token_type": "Bearer",
+        "scope": "openid profile",
+    }
+    return {
+        **token_response,
+        "token_response": token_response,
+        "oauth_user": {"sub": f"sub-{username}", "preferred_username": username},
+        "roles": list(idp.roles),
+        "exchanged_tokens": {service_name: idp.issue(username, audience=service_name) for service_name in exchange_tokens},
+    }
+
+
+def _measure(name, auth_state, fernet, iterations):
+    """Time what jupyterhub does on each save (encrypt) and read (decrypt) of the auth_state"""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        encrypted = fernet.encrypt(json.dumps(auth_state).encode("utf8"))
+    save_t = (time.perf_counter() - start) / iterations
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        read_auth_state(json.loads(fernet.decrypt(encrypted).decode("utf8")))
+    read_t = (time.perf_counter() - start) / iterations
+
+    click.echo(
+        f"{name:<12} {len(json.dumps(auth_state)):>7} bytes JSON  {len(encrypted):>7} bytes stored  "
+        f"save {save_t * 1e6:>8.1f} us  read {read_t * 1e6:>8.1f} us"
+    )
+
+
+@click.command()
+@click.option("--iterations", default=2000, show_default=True, help="Number of saves and reads measured per layout")
+@click.option("--exchange-token", "exchange_tokens", multiple=True, help="Audience of an exchanged token in auth_state (repeatable)")
+def main(iterations, exchange_tokens):
+    idp = FakeIdP()
+    idp.url = "https://keycloak.example.com/auth/realms/swan"
+    fernet = MultiFernet([Fernet(Fernet.generate_key())])
+
+    legacy = _legacy_auth_state(idp, "alice", exchange_tokens or ["eos-service"])
+    current = compact_auth_state(legacy)
+    _measure("legacy", legacy, fernet, iterations)
+    _measure("current", current, fernet, iterations)
+    _measure("compressed", compress_auth_state(current), fernet, iterations)
+
+
+if __name__ == "__main__":
+    main()
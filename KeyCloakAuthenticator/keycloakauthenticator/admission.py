@@ -0,0 +1,56 @@
+"""
+Admission control of the logins, so that a burst of users does not overload the IdP
+"""
+
+import asyncio
+import contextlib
+import time
+
+from tornado import web
+
+
+class AdmissionRejectedError(web.HTTPError):
+    """Raised when too many logins are waiting already, telling the client when to try again"""
+
+    def __init__(self, retry_after):
+        super().__init__(503, "Too many users are logging in, please try again in a few seconds")
+        # Set in the response by the jupyterhub error handler
+        self.headers = {"Retry-After": str(retry_after)}
+
+
+class AdmissionController:
+    """
+    Lets at most max_concurrent calls run at the same time, the next ones wait in a queue.
+
+    Once max_queue calls are waiting, new calls are rejected right away with AdmissionRejectedError,
+    instead of waiting for a slot they would probably not get before the client times out.
+    A max_concurrent of 0 disables the limit.
+    """
+
+    def __init__(self, max_concurrent, max_queue, retry_after=10):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.retry_after = retry_after
+        self.waiting = 0
+        self._semaphore = asyncio.Semaphore(max_concurrent) if max_concurrent > 0 else None
+
+    @contextlib.asynccontextmanager
+    async def admit(self):
+        """Wait for a slot, yielding the time spent waiting (in seconds)"""
+        if self._semaphore is None:
+            yield 0
+            return
+
+        if self._semaphore.locked() and self.waiting >= self.max_queue:
+            raise AdmissionRejectedError(self.retry_after)
+
+        start = time.perf_counter()
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        try:
+            yield time.perf_counter() - start
+        finally:
+            self._semaphore.release()
@@ -3,30 +3,80 @@
 
 """KeyCloakAuthenticator"""
 import asyncio
+import atexit
+import copy
 import json
+import os
+import random
 import time
 from urllib import parse
 from urllib.error import HTTPError
+from urllib.parse import urlparse, urlunparse
 
 import jwt
 from jupyterhub.utils import maybe_future
-from jwt.algorithms import RSAAlgorithm
 from oauthenticator.generic import GenericOAuthenticator
 from oauthenticator.oauth2 import OAuthLoginHandler
 from tornado import web
-from tornado.httpclient import HTTPRequest
-from traitlets import Any, Bool, List, TraitError, Unicode, default, validate
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from traitlets import (
+    Any,
+    Bool,
+    Dict,
+    Enum,
+    Float,
+    Int,
+    List,
+    TraitError,
+    Unicode,
+    default,
+    validate,
+)
 
+from .admission import AdmissionController, AdmissionRejectedError
+from .breaker import CircuitBreaker, CircuitOpenError, is_outage_error
+from .cache import ExpiringLRUCache, token_digest
+from .jwks import JWKSKeySet
 from .metrics import (
+    metric_auth_state_cache_hit,
+    metric_auth_state_cache_miss,
     metric_authenticate,
+    metric_background_refresh,
+    metric_background_refresh_scheduled,
+    metric_exchange_duration,
+    metric_exchange_failures,
+    metric_exchange_hedged,
     metric_exchange_tornado_queue_time,
     metric_exchange_tornado_request_time,
+    metric_exchanged_token_cache,
+    metric_idp_connections,
+    metric_idp_pool_saturation,
+    metric_idp_requests_in_flight,
+    metric_login_queue_depth,
+    metric_login_queue_wait,
+    metric_logins_rejected,
     metric_pre_spawn_start,
     metric_refresh_token,
     metric_refresh_tornado_queue_time,
     metric_refresh_tornado_request_time,
     metric_refresh_user,
+    metric_refresh_user_coalesced,
+    metric_stale_tokens_served,
+    metric_token_cache_hit,
+    metric_token_cache_miss,
+    metric_token_endpoint_circuit_open,
+    metric_token_endpoint_rejected,
+)
+from .refresher import BackgroundRefresher
+from .shared_cache import SharedCache, cache_backend
+from .state import (
+    compact_auth_state,
+    compress_auth_state,
+    read_auth_state,
+    stored_expiry,
+    token_expiry,
 )
+from .verify import TokenVerifierPool
 
 
 # Use a login handler wrapper to ensure the configuration was loaded before redirecting the user
@@ -49,6 +99,37 @@ class KeyCloakAuthenticator(GenericOAuthenticator):
         help="OIDC issuer URL for automatic discovery of configuration"
     )
 
+    oidc_cache_file = Unicode(
+        default_value='',
+        config=True,
+        help="""
+        File where the last OIDC configuration and signing keys retrieved from the issuer are saved.
+        At startup, the authenticator is configured from it right away, while the configuration is fetched again in the background.
+        """
+    )
+
+    shared_cache_url = Unicode(
+        default_value='',
+        config=True,
+        help="""
+        Cache shared with the other hubs using the same IdP, for the OIDC configuration, the signing keys and the exchanged tokens,
+        so that they are only fetched or exchanged once: 'memory', 'sqlite:///path/to/file.db' or 'redis://[:password@]host[:port][/db]'.
+        The exchanged tokens are stored as is, so the cache must only be reachable by the hubs. Empty (default) disables it.
+        """
+    )
+
+    oidc_retry_initial_delay = Int(
+        default_value=5,
+        config=True,
+        help="Seconds before retrying to fetch the OIDC configuration after a failure, doubled (with jitter) on every failure."
+    )
+
+    oidc_retry_max_delay = Int(
+        default_value=300,
+        config=True,
+        help="Maximum number of seconds between retries to fetch the OIDC configuration."
+    )
+
     enable_logout = Bool(
         default_value=True,
         config=True,
@@ -104,6 +185,17 @@ class KeyCloakAuthenticator(GenericOAuthenticator):
         help="If True, it will verify the audience in the JWT token."
     )
 
+    user_claims_source = Enum(
+        ['userinfo', 'id_token', 'access_token'],
+        default_value='userinfo',
+        config=True,
+        help="""
+        Where the user information (username_claim) comes from after the login:
+        the userinfo endpoint (default), or the claims of the verified ID or access token,
+        which saves one request to the IdP per login.
+        """
+    )
+
     jwt_signing_algorithms = List (
         Unicode(),
         default_value=["HS256", "RS256"],
@@ -118,6 +210,257 @@ class KeyCloakAuthenticator(GenericOAuthenticator):
         help="List of audiences to exchange our token to"
     )
 
+    optional_exchange_tokens = List (
+        Unicode(),
+        default_value=[],
+        config=True,
+        help="""
+        Audiences of exchange_tokens that are allowed to fail, without failing the login or the refresh.
+        Their tokens are missing from auth_state until they are successfully exchanged in a later refresh.
+        """
+    )
+
+    on_demand_exchange_tokens = Dict(
+        value_trait=Dict(value_trait=List(Unicode())),
+        default_value={},
+        config=True,
+        help="""
+        Audiences only exchanged when a session needs them, instead of at every login and refresh.
+        Maps a spawn option to the audiences needed by each of its values ('*' for any value other than 'none'),
+        e.g. {'clusters': {'analytix': ['hadoop-service']}}. They are exchanged in pre_spawn_start,
+        and then kept fresh by refresh_user along with the exchange_tokens while a running session needs them.
+        Once no running session needs them, they are dropped from auth_state at the next refresh.
+        """
+    )
+
+    exchange_token_timeout = Float(
+        default_value=10.0,
+        config=True,
+        help="Maximum number of seconds to wait for each token exchange."
+    )
+
+    exchange_token_hedge_delay = Float(
+        default_value=0,
+        config=True,
+        help="""
+        If a token exchange takes longer than this many seconds, send a second identical request
+        and use the first response. 0 (default) disables it.
+        """
+    )
+
+    exchange_token_min_lifetime = Int(
+        default_value=300,
+        config=True,
+        help="""
+        Exchanged tokens are reused until they have less than this many seconds of lifetime left,
+        then they are exchanged again.
+        """
+    )
+
+    access_token_min_lifetime = Int(
+        default_value=0,
+        config=True,
+        help="""
+        refresh_user only refreshes the tokens once the access token (or one of the exchanged tokens)
+        has less than this many seconds of lifetime left, plus a random jitter of up to refresh_jitter seconds.
+        If 0 (default), the tokens are refreshed every time refresh_user is called.
+        """
+    )
+
+    refresh_jitter = Int(
+        default_value=60,
+        config=True,
+        help="""
+        Maximum random number of seconds added to access_token_min_lifetime,
+        so that users who logged in at the same time do not refresh their tokens all at once.
+        """
+    )
+
+    exchanged_token_cache_size = Int(
+        default_value=4096,
+        config=True,
+        help="Maximum number of exchanged tokens (one per user and audience) kept in memory. Set to 0 to disable."
+    )
+
+    auth_state_cache_size = Int(
+        default_value=1024,
+        config=True,
+        help="Maximum number of decrypted auth_state kept in memory (one per user). Set to 0 to disable."
+    )
+
+    auth_state_cache_ttl = Int(
+        default_value=60,
+        config=True,
+        help="""
+        Seconds a decrypted auth_state is served from memory, instead of decrypting it again from the database.
+        The cache is updated whenever the authenticator stores new tokens. Set to 0 to disable.
+        """
+    )
+
+    compress_auth_state = Bool(
+        default_value=False,
+        config=True,
+        help="""
+        Store the auth_state compressed, which makes it smaller to encrypt and store in the database.
+        Code reading the auth_state must then use get_user_auth_state, instead of user.get_auth_state.
+        Compressed or not, the stored auth_state has no token_response (see state.py): stock JupyterHub/oauthenticator
+        code reading it from user.get_auth_state() no longer finds it, and must use access_token, refresh_token
+        and id_token instead.
+        """
+    )
+
+    token_cache_size = Int(
+        default_value=1024,
+        config=True,
+        help="""
+        Maximum number of decoded tokens kept in memory, so the same token is not verified twice.
+        Entries are evicted when the token expires or, if the cache is full, by LRU. Set to 0 to disable.
+        """
+    )
+
+    jwks_refresh_interval = Int(
+        default_value=3600,
+        config=True,
+        help="Seconds between refreshes of the IdP signing keys, when the JWKS endpoint does not send cache headers."
+    )
+
+    jwks_min_refresh_interval = Int(
+        default_value=60,
+        config=True,
+        help="""
+        Minimum number of seconds between two fetches of the IdP signing keys.
+        Tokens signed with an unknown key id do not trigger a refetch more often than this.
+        """
+    )
+
+    idp_max_clients = Int(
+        default_value=50,
+        config=True,
+        help="""
+        Maximum number of simultaneous requests of the dedicated http client used to talk to the IdP.
+        If pycurl is available, the client keeps the connections to the IdP alive between requests.
+        """
+    )
+
+    idp_endpoint_concurrency = Int(
+        default_value=0,
+        config=True,
+        help="Maximum number of simultaneous requests to each IdP endpoint (e.g. the token endpoint). 0 means no limit."
+    )
+
+    login_max_concurrent = Int(
+        default_value=0,
+        config=True,
+        help="""
+        Maximum number of logins (authenticate calls) talking to the IdP at the same time, the next ones wait in a queue.
+        This avoids overloading the IdP when many users log in at once, like at the start of a course. 0 disables it.
+        """
+    )
+
+    login_queue_size = Int(
+        default_value=200,
+        config=True,
+        help="Maximum number of logins waiting for login_max_concurrent. Once full, logins fail right away with a 503."
+    )
+
+    login_retry_after = Int(
+        default_value=10,
+        config=True,
+        help="Seconds the clients are told to wait (Retry-After header) when a login is rejected because the queue is full."
+    )
+
+    token_endpoint_failure_threshold = Int(
+        default_value=5,
+        config=True,
+        help="""
+        Number of consecutive failures (errors 5xx, timeouts or connection errors) of the token endpoint
+        after which requests to it are stopped for a while, so that a struggling IdP can recover.
+        In the meantime, refresh_user keeps the users whose access token is still valid. 0 disables it.
+        """
+    )
+
+    token_endpoint_reset_timeout = Int(
+        default_value=30,
+        config=True,
+        help="""
+        Seconds (with a random jitter) before a single probe request is sent to a token endpoint that was failing.
+        This time doubles every time the probe fails, up to token_endpoint_max_reset_timeout.
+        """
+    )
+
+    token_endpoint_max_reset_timeout = Int(
+        default_value=300,
+        config=True,
+        help="Maximum number of seconds between probes to a failing token endpoint."
+    )
+
+    background_refresh = Bool(
+        default_value=False,
+        config=True,
+        help="""
+        If True, the tokens of the users with running servers are refreshed in the background,
+        background_refresh_lead_time seconds before they expire, so that requests rarely need to wait for a refresh.
+        """
+    )
+
+    background_refresh_lead_time = Int(
+        default_value=600,
+        config=True,
+        help="Seconds before the expiration of the tokens when they are refreshed in the background."
+    )
+
+    background_refresh_rate = Float(
+        default_value=5.0,
+        config=True,
+        help="Maximum number of background refreshes started per second, spreading the load on the IdP."
+    )
+
+    spawn_token_min_lifetime = Int(
+        default_value=0,
+        config=True,
+        help="""
+        Minimum number of seconds the access token and the exchanged tokens given to a new session must still be valid.
+        If they expire sooner, pre_spawn_start refreshes them (concurrently with the on demand exchanges)
+        before calling the pre_spawn_hook. 0 disables it.
+        """
+    )
+
+    refresh_stale_while_revalidate = Bool(
+        default_value=False,
+        config=True,
+        help="""
+        If True, refresh_user does not make the request wait for the refresh while the current tokens are still valid:
+        it returns right away and refreshes them in the background, storing the new auth_state once done.
+        """
+    )
+
+    @default("http_client")
+    def _default_http_client(self):
+        defaults = dict(validate_cert=self.validate_server_cert)
+        try:
+            # The curl client keeps the connections alive and reuses them for the next requests
+            from tornado.curl_httpclient import CurlAsyncHTTPClient
+            return CurlAsyncHTTPClient(force_instance=True, max_clients=self.idp_max_clients, defaults=defaults)
+        except ImportError:
+            self.log.warning("Could not load pycurl, the connections to the IdP will not be kept alive")
+            return AsyncHTTPClient(force_instance=True, max_clients=self.idp_max_clients, defaults=defaults)
+
+    jwt_verify_workers = Int(
+        default_value=0,
+        config=True,
+        help="""
+        Number of workers verifying the signature of the tokens, so that it does not block the hub event loop.
+        If 0 (default), the tokens are verified in the event loop.
+        """
+    )
+
+    jwt_verify_executor = Enum(
+        ['thread', 'process'],
+        default_value='thread',
+        config=True,
+        help="Whether the jwt_verify_workers are threads or processes."
+    )
+
     @validate('pre_spawn_hook')
     def _validate_pre_spawn_hook(self, proposal):
         value = proposal['value']
@@ -125,6 +468,13 @@ class KeyCloakAuthenticator(GenericOAuthenticator):
             raise TraitError("pre_spawn_hook must be callable")
         return value
 
+    @validate('shared_cache_url')
+    def _validate_shared_cache_url(self, proposal):
+        value = proposal['value']
+        if value and value != 'memory' and urlparse(value).scheme not in ('sqlite', 'redis'):
+            raise TraitError("shared_cache_url must be 'memory', a sqlite:// or a redis:// url")
+        return value
+
     @validate('claim_roles_key')
     def _validate_claim_roles_key(self, proposal):
         value = proposal['value']
@@ -147,19 +497,47 @@ class KeyCloakAuthenticator(GenericOAuthenticator):
         # Force auth state so that we can store the tokens in the user dict
         self.enable_auth_state = True
         self._allowed_roles = set(self.allowed_roles)
+        self._verified_tokens = ExpiringLRUCache(self.token_cache_size)
+        self._jwks = None
+        self._verifier_pool = None
+        self._exchanged_tokens = ExpiringLRUCache(self.exchanged_token_cache_size)
+        self._shared_cache = SharedCache(cache_backend(self.shared_cache_url), self.log) if self.shared_cache_url else None
+        self._auth_states = ExpiringLRUCache(self.auth_state_cache_size if self.auth_state_cache_ttl > 0 else 0)
+        self._refreshes_in_flight = {}
+        self._revalidations = {}
+        self._background_refresher = None
+        self._endpoint_semaphores = {}
+        self._idp_requests_in_flight = 0
+        self._login_admission = AdmissionController(self.login_max_concurrent, self.login_queue_size, self.login_retry_after)
+        metric_login_queue_depth.set_function(lambda: self._login_admission.waiting)
+        self._token_endpoint_breaker = CircuitBreaker(self.token_endpoint_failure_threshold,
+                                                      self.token_endpoint_reset_timeout,
+                                                      self.token_endpoint_max_reset_timeout)
 
         if not self.oidc_issuer:
             raise Exception('No OIDC issuer url provided')
 
         # Try to configure the authenticator
         self.configured = False
+        self._post_logout_redirect_url = None
+        if self.oidc_cache_file:
+            # Usable right away with the configuration saved before, while it's revalidated
+            self._load_oidc_snapshot()
         asyncio.ensure_future(self._get_oidc_configs())
         self.login_handler = OIDCOAuthLoginHandler
+        # JupyterHub does not tell the authenticator when it shuts down
+        atexit.register(self.close)
 
+    def close(self):
+        """Shut down the token verification workers and close the connection to the shared cache"""
+        if self._verifier_pool is not None:
+            self._verifier_pool.shutdown()
+            self._verifier_pool = None
+        if self._shared_cache is not None:
+            self._shared_cache.close()
 
-    async def _get_oidc_configs_helper(self):
-        data = await self.httpfetch(f"{self.oidc_issuer}/.well-known/openid-configuration", label="fetching oidc config")
 
+    def _apply_oidc_configs(self, data):
         if not set(['authorization_endpoint', 'token_endpoint', 'userinfo_endpoint']).issubset(data.keys()):
             raise Exception('Unable to retrieve OIDC necessary values')
 
@@ -167,50 +545,225 @@ class KeyCloakAuthenticator(GenericOAuthenticator):
         self.token_url = data['token_endpoint']
         self.userdata_url = data['userinfo_endpoint']
 
+        if self._post_logout_redirect_url is None:
+            # Remember the configured value, as it gets replaced below
+            self._post_logout_redirect_url = self.logout_redirect_url
         end_session_url = data.get('end_session_endpoint')
         if self.enable_logout and end_session_url:
-            if self.logout_redirect_url:
-                end_session_url += '?post_logout_redirect_uri=%s' % self.logout_redirect_url
+            if self._post_logout_redirect_url:
+                end_session_url += '?post_logout_redirect_uri=%s' % self._post_logout_redirect_url
                 end_session_url += '&client_id=%s' % self.client_id
             # Update parent class OAuthenticator.logout_redirect_url
             self.logout_redirect_url = end_session_url
 
+    def _new_keyset(self, jwks_uri):
+        return JWKSKeySet(jwks_uri, self._fetch_jwks, self.log,
+                          min_refresh_interval=self.jwks_min_refresh_interval,
+                          default_refresh_interval=self.jwks_refresh_interval,
+                          cache=self._shared_cache)
+
+    def _use_keyset(self, keyset):
+        if self._jwks is not None:
+            self._jwks.stop()
+        self._jwks = keyset
+
+    # Set directly when the keys are not fetched from the IdP
+    _public_key = None
+
+    @property
+    def public_key(self):
+        """Key for the tokens without a kid: the default key of the current keyset, following its refreshes"""
+        return self._jwks.default_key if self._jwks is not None else self._public_key
+
+    @public_key.setter
+    def public_key(self, key):
+        self._public_key = key
+
+    async def _get_oidc_configs_helper(self):
+        data = None
+        if self._shared_cache is not None:
+            data = await self._shared_cache.get(f'discovery:{self.oidc_issuer}')
+        if data is None:
+            data = await self.httpfetch(f"{self.oidc_issuer}/.well-known/openid-configuration", label="fetching oidc config")
+            if self._shared_cache is not None:
+                await self._shared_cache.set(f'discovery:{self.oidc_issuer}', data, time.time() + self.jwks_refresh_interval)
+        self._apply_oidc_configs(data)
+
+        jwk_data = None
         if self.config.check_signature :
             jwks_uri = data['jwks_uri']
 
             self.log.info("Fetching JWKs data")
-            jwk_data = await self.httpfetch(jwks_uri, label="fetching jwks")
-            # Find signature key out of keys provided at certs endpoint
-            sign_keys = [key for key in jwk_data['keys'] if key.get('use') == 'sig']
-            if not sign_keys:
-                # If no signature key is found, fallback to first key in the list
-                sign_keys = jwk_data['keys']
-            self.public_key = RSAAlgorithm(RSAAlgorithm.SHA256).from_jwk(sign_keys[0])
-            self.log.info(f"acquired public key from {jwks_uri}")
+            keyset = self._new_keyset(jwks_uri)
+            await keyset.refresh()
+            self._use_keyset(keyset)
+            self.log.info(f"acquired public keys from {jwks_uri}")
+            keyset.start()
+            jwk_data = keyset.document
         else:
-            self.public_key = None
+            self._use_keyset(None)
 
         self.configured = True
         # All good, let's finish
         self.log.info('KeycloakAuthenticator fully configured')
 
+        if self.oidc_cache_file:
+            self._save_oidc_snapshot(data, jwk_data)
+
+    def _save_oidc_snapshot(self, data, jwk_data):
+        """Save the discovery document and the JWKS, to be usable right away after a restart"""
+        tmp_file = f'{self.oidc_cache_file}.tmp'
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump({'discovery': data, 'jwks': jwk_data, 'saved_at': time.time()}, f)
+            os.replace(tmp_file, self.oidc_cache_file)
+        except OSError:
+            self.log.warning(f'Failed to save the OIDC configuration to {self.oidc_cache_file}', exc_info=True)
+
+    def _load_oidc_snapshot(self):
+        """Configure the authenticator from the last saved discovery document and JWKS, if any"""
+        try:
+            with open(self.oidc_cache_file) as f:
+                snapshot = json.load(f)
+            self._apply_oidc_configs(snapshot['discovery'])
+            if self.config.check_signature:
+                keyset = self._new_keyset(snapshot['discovery']['jwks_uri'])
+                keyset.load(snapshot['jwks'])
+                self._use_keyset(keyset)
+            else:
+                self._use_keyset(None)
+        except FileNotFoundError:
+            return
+        except Exception:
+            self.log.warning(f'Failed to load the OIDC configuration saved in {self.oidc_cache_file}', exc_info=True)
+            return
+
+        self.configured = True
+        self.log.info(f"KeycloakAuthenticator configured from {self.oidc_cache_file}, saved at "
+                      f"{time.ctime(snapshot.get('saved_at', 0))}, it will be revalidated in the background")
+
+    async def fetch(self, req, label="fetching", parse_json=True, **kwargs):
+        """
+            Send the request to the IdP through the dedicated http client,
+            limiting the concurrency per endpoint and recording the usage of the connection pool.
+        """
+        endpoint = urlunparse(urlparse(req.url)._replace(query=""))
+        semaphore = None
+        if self.idp_endpoint_concurrency > 0:
+            semaphore = self._endpoint_semaphores.setdefault(endpoint, asyncio.Semaphore(self.idp_endpoint_concurrency))
+            await semaphore.acquire()
+
+        # Fail fast while the token endpoint is down, instead of piling up requests on it
+        breaker = self._token_endpoint_breaker if endpoint == self.token_url else None
+        if breaker is not None and not breaker.allow_request():
+            if semaphore is not None:
+                semaphore.release()
+            metric_token_endpoint_rejected.inc()
+            raise CircuitOpenError(endpoint)
+        is_probe = breaker is not None and breaker.state == breaker.HALF_OPEN
+
+        self._idp_requests_in_flight += 1
+        metric_idp_requests_in_flight.set(self._idp_requests_in_flight)
+        metric_idp_pool_saturation.set(self._idp_requests_in_flight / max(self.idp_max_clients, 1))
+        try:
+            response = await super().fetch(req, label=label, parse_json=False, **kwargs)
+        except asyncio.CancelledError:
+            # Timed out or hedged: a probe without a response counts as failed, so that the circuit re-opens
+            if is_probe and breaker.state == breaker.HALF_OPEN:
+                breaker.record_failure()
+                metric_token_endpoint_circuit_open.set(1)
+            raise
+        except Exception as e:
+            if breaker is not None:
+                # The IdP rejecting a request (e.g. an invalid refresh token) still means it is up
+                if is_outage_error(e):
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+                metric_token_endpoint_circuit_open.set(breaker.state != breaker.CLOSED)
+            raise
+        else:
+            if breaker is not None:
+                breaker.record_success()
+                metric_token_endpoint_circuit_open.set(0)
+        finally:
+            self._idp_requests_in_flight -= 1
+            metric_idp_requests_in_flight.set(self._idp_requests_in_flight)
+            metric_idp_pool_saturation.set(self._idp_requests_in_flight / max(self.idp_max_clients, 1))
+            if semaphore is not None:
+                semaphore.release()
+
+        # Only reported by the curl client: no time spent connecting means the connection was reused
+        connect_t = response.time_info.get('connect')
+        if connect_t is not None:
+            metric_idp_connections.labels("true" if connect_t == 0 else "false").inc()
+
+        if not parse_json:
+            return response
+        if response.body:
+            return json.loads(response.body.decode('utf8', 'replace'))
+        # empty body is None
+        return None
+
+    async def _fetch_jwks(self, url):
+        return await self.httpfetch(url, label="fetching jwks", parse_json=False)
+
     async def _get_oidc_configs(self):
         self.log.info('Configuring OIDC from %s' % self.oidc_issuer)
 
-        # Try to load the configs until it succeeds
+        # Try to load the configs until it succeeds, with a jittered exponential backoff
+        delay = self.oidc_retry_initial_delay
         while True:
             try:
                 await self._get_oidc_configs_helper()
                 break
             except Exception:
-                self.log.error("Failure to retrieve the openid configuration, will try again in 1 min (auth calls will fail)", exc_info=True)
-                await asyncio.sleep(60)
+                wait = random.uniform(delay / 2, delay)
+                consequence = "using the saved configuration" if self.configured else "auth calls will fail"
+                self.log.error(f"Failure to retrieve the openid configuration, will try again in {wait:.0f} s ({consequence})", exc_info=True)
+                await asyncio.sleep(wait)
+                delay = min(delay * 2, self.oidc_retry_max_delay)
 
     def _validate_roles(self, user_roles):
         return not self._allowed_roles or \
             (self._allowed_roles & user_roles)
 
-    def _decode_token(self, token, options={}):
+    def _signing_key(self, token):
+        """Key to verify the token with, selected by the kid in its header"""
+        if self._jwks is not None:
+            key = self._jwks.get(jwt.get_unverified_header(token).get('kid'))
+            if key is not None:
+                return key
+        return self.public_key
+
+    async def _verify_token(self, token, options={}):
+        """
+            Decode a token, fetching the IdP keys again first if it was signed with a key we don't know yet.
+            If jwt_verify_workers is set, the signature is verified in the worker pool instead of the event loop.
+        """
+        if self.config.check_signature and self._jwks is not None:
+            await self._jwks.ensure_kid(jwt.get_unverified_header(token).get('kid'))
+        if self.jwt_verify_workers <= 0:
+            return self._decode_token(token, options)
+
+        options = self._decode_options(options)
+        cache_key, decoded_token = self._cached_token(token, options)
+        if decoded_token is not None:
+            return decoded_token
+
+        if self._verifier_pool is None:
+            self._verifier_pool = TokenVerifierPool(self.jwt_verify_workers, self.jwt_verify_executor)
+        try:
+            key = self._signing_key(token) if options.get("verify_signature", True) else None
+            decoded_token = await self._verifier_pool.decode(token, key, **self._decode_kwargs(options))
+        except jwt.exceptions.ExpiredSignatureError:
+            self.log.info("Token expired")
+            return None
+        return self._cache_token(cache_key, decoded_token)
+
+    def _decode_options(self, options):
+        # Work on a copy, the options are part of the cache key
+        options = dict(options)
         if not self.config.check_signature:
             options.update({"verify_signature": False})
         if not self.verify_aud:
@@ -222,19 +775,99 @@ class KeyCloakAuthenticator(GenericOAuthenticator):
         # - small clock drift can lead to rejected tokens (jwt.exceptions.ImmatureSignatureError)
         # See related issue in PyJWT: https://github.com/jpadilla/pyjwt/issues/939
         options.setdefault("verify_iat", False)
+        return options
 
-        try:
-            decoded_token = jwt.decode(token, self.public_key, options=options, audience=self.client_id,
-                    issuer=self.oidc_issuer, algorithms=self.jwt_signing_algorithms)
+    def _decode_kwargs(self, options):
+        return dict(options=options, audience=self.client_id, issuer=self.oidc_issuer, algorithms=self.jwt_signing_algorithms)
+
+    def _cached_token(self, token, options):
+        """Tokens already decoded with the same options are served from the cache until they expire"""
+        cache_key = (token_digest(token), tuple(sorted(options.items())))
+        decoded_token = self._verified_tokens.get(cache_key)
+        if decoded_token is not None:
+            metric_token_cache_hit.inc()
+            return cache_key, dict(decoded_token)
+        metric_token_cache_miss.inc()
+        return cache_key, None
+
+    def _cache_token(self, cache_key, decoded_token):
+        self._verified_tokens.set(cache_key, decoded_token, decoded_token.get('exp'))
+        return dict(decoded_token)
+
+    def _decode_token(self, token, options={}):
+        options = self._decode_options(options)
+        cache_key, decoded_token = self._cached_token(token, options)
+        if decoded_token is not None:
             return decoded_token
+
+        try:
+            key = self._signing_key(token) if options.get("verify_signature", True) else None
+            decoded_token = jwt.decode(token, key, **self._decode_kwargs(options))
         except jwt.exceptions.ExpiredSignatureError:
             self.log.info("Token expired")
             return None
+        return self._cache_token(cache_key, decoded_token)
+
+    def _token_expiry(self, token):
+        """Expiration time of a token issued for another audience, without verifying it (None if unknown)"""
+        return token_expiry(token)
+
+    def _shared_exchange_key(self, username, service_name):
+        # Tokens are exchanged by our client, other clients sharing the cache must not get them
+        return f'exchanged_token:{self.client_id}:{username}:{service_name}'
+
+    def _cache_exchanged_token(self, username, service_name, token):
+        exp = self._token_expiry(token)
+        if username is not None and exp is not None:
+            # Drop the token from the cache once it gets too close to its expiration
+            self._exchanged_tokens.set((username, service_name), token, exp - self.exchange_token_min_lifetime)
+
+    async def _exchange_tokens(self, token, username=None, previous=None, audiences=None, min_lifetime=0):
+        """
+            Exchange the token for all the audiences (by default, exchange_tokens).
+            If the username is provided, audiences with a cached token (or a token in previous,
+            the exchanged tokens from the current auth_state) that is still valid for long enough
+            (exchange_token_min_lifetime, or min_lifetime seconds if longer) are not exchanged again.
+        """
+        audiences = self.exchange_tokens if audiences is None else audiences
+        access_tokens = {}
+        services_to_exchange = []
+        for service_name in audiences:
+            metric_label = "exchange_token_{}".format(service_name.replace("-","_"))
+            if username is not None and previous and service_name in previous \
+                    and (username, service_name) not in self._exchanged_tokens:
+                # e.g. after a restart of the hub, reuse the tokens stored in auth_state
+                self._cache_exchanged_token(username, service_name, previous[service_name])
+            cached_token = self._exchanged_tokens.get((username, service_name)) if username is not None else None
+            if cached_token is not None and min_lifetime > self.exchange_token_min_lifetime and \
+                    self._token_expiry(cached_token) < time.time() + min_lifetime:
+                cached_token = None
+            if cached_token is not None:
+                metric_exchanged_token_cache.labels(metric_label, "hit").inc()
+                access_tokens[service_name] = cached_token
+            else:
+                metric_exchanged_token_cache.labels(metric_label, "miss").inc()
+                services_to_exchange.append(service_name)
+
+        if services_to_exchange and username is not None and self._shared_cache is not None:
+            # Tokens exchanged by another hub
+            shared_tokens = await asyncio.gather(
+                *(self._shared_cache.get(self._shared_exchange_key(username, service_name)) for service_name in services_to_exchange))
+            for service_name, shared_token in zip(list(services_to_exchange), shared_tokens, strict=True):
+                if shared_token is None or (min_lifetime > self.exchange_token_min_lifetime and
+                                            self._token_expiry(shared_token) < time.time() + min_lifetime):
+                    continue
+                metric_exchanged_token_cache.labels("exchange_token_{}".format(service_name.replace("-","_")), "shared_hit").inc()
+                access_tokens[service_name] = shared_token
+                self._cache_exchanged_token(username, service_name, shared_token)
+                services_to_exchange.remove(service_name)
+
+        if not services_to_exchange:
+            return {service_name: access_tokens[service_name] for service_name in audiences if service_name in access_tokens}
 
-    async def _exchange_tokens(self, token):
         # Construct requests for all token exchanges
         exchange_requests = []
-        for service_name in self.exchange_tokens:
+        for service_name in services_to_exchange:
             values = dict(
                 grant_type = 'urn:ietf:params:oauth:grant-type:token-exchange',
                 client_id = self.client_id,
@@ -256,13 +889,23 @@ class KeyCloakAuthenticator(GenericOAuthenticator):
 
         # Schedule all exchange requests at once
         start = time.time()
-        responses = await asyncio.gather(*(self.fetch(req, "exchanging token", parse_json=False) for req in exchange_requests))
+        responses = await asyncio.gather(
+            *(self._exchange_token(req, service_name) for req, service_name in zip(exchange_requests, services_to_exchange, strict=True)),
+            return_exceptions=True)
         total_t = time.time() - start
         self.log.info(f'Token exchanges finished, total time: {total_t} s')
 
         # Inspect the responses obtained for each service
-        access_tokens = {}
-        for response, service_name in zip(responses, self.exchange_tokens, strict=True):
+        shared_writes = []
+        for response, service_name in zip(responses, services_to_exchange, strict=True):
+            if isinstance(response, BaseException):
+                metric_exchange_failures.labels(service_name).inc()
+                if service_name not in self.optional_exchange_tokens:
+                    raise response
+                # Not cached, so it will be exchanged again on the next refresh
+                self.log.warning(f"Failed to exchange optional {service_name} token, skipping it: {response!r}")
+                continue
+
             # Get the access token obtained for this service
             access_token = None
             if response.body:
@@ -273,6 +916,12 @@ class KeyCloakAuthenticator(GenericOAuthenticator):
                 continue
 
             access_tokens[service_name] = access_token
+            self._cache_exchanged_token(username, service_name, access_token)
+            if username is not None and self._shared_cache is not None:
+                exp = self._token_expiry(access_token)
+                if exp is not None:
+                    shared_writes.append(self._shared_cache.set(self._shared_exchange_key(username, service_name),
+                                                                access_token, exp - self.exchange_token_min_lifetime))
 
             # Produce logs and metrics for this token exchange
             queue_t = response.time_info['queue'] if 'queue' in response.time_info else -1
@@ -281,8 +930,56 @@ class KeyCloakAuthenticator(GenericOAuthenticator):
             metric_exchange_tornado_queue_time.labels("exchange_token_{}".format(service_name.replace("-","_"))).observe(queue_t)
             metric_exchange_tornado_request_time.labels("exchange_token_{}".format(service_name.replace("-","_")), response.code).observe(request_t)
 
-        return access_tokens
+        await asyncio.gather(*shared_writes)
 
+        # Keep the order of the audiences
+        return {service_name: access_tokens[service_name] for service_name in audiences if service_name in access_tokens}
+
+
+    async def _exchange_token(self, req, service_name):
+        """Send a token exchange request, failing if it takes longer than exchange_token_timeout"""
+        start = time.time()
+        try:
+            return await asyncio.wait_for(self._hedged_fetch(req, service_name), self.exchange_token_timeout)
+        except TimeoutError:
+            # The cancelled requests recorded no outcome, a missed deadline counts as a failure of the token endpoint
+            breaker = self._token_endpoint_breaker
+            if breaker.state == breaker.CLOSED:
+                breaker.record_failure()
+                metric_token_endpoint_circuit_open.set(breaker.state != breaker.CLOSED)
+            raise
+        finally:
+            metric_exchange_duration.labels(service_name).observe(time.time() - start)
+
+    async def _hedged_fetch(self, req, service_name):
+        """
+            Fetch the request, sending a second identical one if there is no response after exchange_token_hedge_delay,
+            and return the first successful response.
+        """
+        tasks = [asyncio.create_task(self.fetch(req, "exchanging token", parse_json=False))]
+        try:
+            if self.exchange_token_hedge_delay <= 0:
+                return await tasks[0]
+
+            done, _ = await asyncio.wait(tasks, timeout=self.exchange_token_hedge_delay)
+            if done:
+                return tasks[0].result()
+
+            self.log.info(f'Exchange of {service_name} token is slow, sending a second request')
+            metric_exchange_hedged.labels(service_name).inc()
+            tasks.append(asyncio.create_task(self.fetch(req, "exchanging token", parse_json=False)))
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+            # Both requests failed
+            return tasks[0].result()
+        finally:
+            # The requests still running when the caller gives up (deadline, cancellation) or the other one won
+            for task in tasks:
+                task.cancel()
 
     async def _refresh_token(self, refresh_token):
         with metric_refresh_token.time():
@@ -317,13 +1014,23 @@ class KeyCloakAuthenticator(GenericOAuthenticator):
             return access_t, refresh_t
 
     async def authenticate(self, handler, data=None):
+        try:
+            async with self._login_admission.admit() as wait_time:
+                metric_login_queue_wait.observe(wait_time)
+                return await self._authenticate(handler, data)
+        except AdmissionRejectedError:
+            self.log.warning(f"Too many logins in progress, rejecting login ({self._login_admission.waiting} waiting)")
+            metric_logins_rejected.inc()
+            raise
+
+    async def _authenticate(self, handler, data=None):
         with metric_authenticate.time():
             user = await super().authenticate(handler, data=data)
             if not user:
                 return None
 
             try:
-                decoded_token = self._decode_token(user['auth_state']['access_token'])
+                decoded_token = await self._verify_token(user['auth_state']['access_token'])
                 user_roles = self.claim_roles_key(self, decoded_token)
                 user['auth_state']['roles'] = list(user_roles)
             except Exception:
@@ -338,7 +1045,7 @@ class KeyCloakAuthenticator(GenericOAuthenticator):
                 self.log.info(f"User '{user['name']}' doesn't have apropriate role to be allowed")
                 return None
             try:
-                user['auth_state']['exchanged_tokens'] = await self._exchange_tokens(user['auth_state']['access_token'])
+                user['auth_state']['exchanged_tokens'] = await self._exchange_tokens(user['auth_state']['access_token'], username=user['name'])
             except Exception:
                 self.log.error("Failed to exchange tokens during authenticate.", exc_info=True)
                 return None
@@ -348,65 +1055,335 @@ class KeyCloakAuthenticator(GenericOAuthenticator):
 
             return user
 
+    async def token_to_user(self, token_info):
+        """Get the user information from the userinfo endpoint or, if configured, from the verified token claims"""
+        if self.user_claims_source == 'userinfo':
+            return await super().token_to_user(token_info)
+
+        token = token_info.get(self.user_claims_source)
+        if not token:
+            raise web.HTTPError(500, f"No {self.user_claims_source} was returned by the IdP")
+        claims = await self._verify_token(token)
+        if claims is None:
+            raise web.HTTPError(500, f"The {self.user_claims_source} returned by the IdP is expired")
+        return claims
+
+    async def run_post_auth_hook(self, handler, auth_model):
+        auth_model = await super().run_post_auth_hook(handler, auth_model)
+        # This is the auth_state jupyterhub is about to store
+        auth_state = auth_model.get('auth_state')
+        if auth_state is not None:
+            auth_state = compact_auth_state(auth_state)
+            auth_model['auth_state'] = self._stored_auth_state(auth_state)
+        self._cache_auth_state(auth_model['name'], auth_state)
+        return auth_model
+
+    def _stored_auth_state(self, auth_state):
+        """auth_state as stored by jupyterhub, compressed if compress_auth_state is set"""
+        return compress_auth_state(auth_state) if self.compress_auth_state else auth_state
+
+    async def get_user_auth_state(self, user):
+        """
+            Decrypted auth_state of the user, served from memory for auth_state_cache_ttl seconds.
+            It is always in the current layout (see state.py), and the value returned is a copy, that the caller can modify.
+        """
+        auth_state = self._auth_states.get(user.name)
+        if auth_state is not None:
+            metric_auth_state_cache_hit.inc()
+            return copy.deepcopy(auth_state)
+        metric_auth_state_cache_miss.inc()
+        auth_state = read_auth_state(await user.get_auth_state())
+        self._cache_auth_state(user.name, auth_state)
+        return copy.deepcopy(auth_state)
+
+    def _cache_auth_state(self, username, auth_state):
+        if auth_state is None:
+            self._auth_states.pop(username)
+            return
+        self._auth_states.set(username, copy.deepcopy(auth_state), time.time() + self.auth_state_cache_ttl)
+
     async def pre_spawn_start(self, user, spawner):
         with metric_pre_spawn_start.time():
+            auth_state = await self._prepare_spawn_tokens(user, spawner)
             if self.pre_spawn_hook:
-                auth_state = await user.get_auth_state()
+                auth_state = auth_state or await self.get_user_auth_state(user)
                 await maybe_future(self.pre_spawn_hook(self, spawner, auth_state))
+            if self.background_refresh:
+                # Keep the tokens of the user fresh while the server is running
+                self._schedule_background_refresh(user, auth_state or await self.get_user_auth_state(user), force=True)
+
+    def _spawn_exchange_audiences(self, user_options):
+        """Audiences of on_demand_exchange_tokens needed by a session started with these options"""
+        audiences = []
+        for option, audiences_by_value in self.on_demand_exchange_tokens.items():
+            value = (user_options or {}).get(option)
+            if value in (None, '', 'none'):
+                continue
+            for service_name in audiences_by_value.get(value, audiences_by_value.get('*', [])):
+                if service_name not in audiences:
+                    audiences.append(service_name)
+        return audiences
 
+    def _exchange_audiences(self, auth_state, user=None):
+        """
+            Audiences to exchange on refresh: exchange_tokens plus the on demand ones the user already has.
+            Given the user, only the on demand ones still needed by a running (or starting) session of the user.
+        """
+        on_demand = {service_name for audiences_by_value in self.on_demand_exchange_tokens.values()
+                     for audiences in audiences_by_value.values() for service_name in audiences}
+        if on_demand and user is not None:
+            on_demand.intersection_update(
+                service_name for spawner in user.spawners.values() if spawner.active
+                for service_name in self._spawn_exchange_audiences(spawner.user_options))
+        exchanged_tokens = auth_state.get('exchanged_tokens') or {}
+        return self.exchange_tokens + [service_name for service_name in exchanged_tokens
+                                       if service_name in on_demand and service_name not in self.exchange_tokens]
+
+    async def _prepare_spawn_tokens(self, user, spawner):
+        """
+            Make sure the session starts with tokens valid for at least spawn_token_min_lifetime, and with
+            the on demand tokens it needs. The refresh and the on demand exchanges are done concurrently.
+            Returns the new auth_state, or None if nothing had to be done.
+        """
+        audiences = self._spawn_exchange_audiences(spawner.user_options)
+        if not audiences and self.spawn_token_min_lifetime <= 0:
+            return None
+
+        auth_state = await self.get_user_auth_state(user)
+        refresh = None
+        expires_at = self._tokens_expiry(auth_state)
+        if self.spawn_token_min_lifetime > 0 and (expires_at is None or expires_at < time.time() + self.spawn_token_min_lifetime):
+            self.log.info(f'Tokens of user {user.name} expire too soon for a new session, refreshing them')
+            refresh = asyncio.create_task(self._coalesced_refresh(user, force=True, min_lifetime=self.spawn_token_min_lifetime))
+            access_token_exp = stored_expiry(auth_state, 'access_token')
+            if access_token_exp is None or access_token_exp <= time.time():
+                # The on demand tokens can only be exchanged with the new access token
+                auth_state = self._spawn_refreshed_auth_state(user, await refresh, auth_state)
+                refresh = None
+
+        async def exchange():
+            if not audiences:
+                return {}
+            return await self._exchange_tokens(auth_state['access_token'], username=user.name,
+                                               previous=auth_state.get('exchanged_tokens'), audiences=audiences,
+                                               min_lifetime=self.spawn_token_min_lifetime)
+
+        if refresh is not None:
+            refresh_result, tokens = await asyncio.gather(refresh, exchange())
+            new_auth_state = self._spawn_refreshed_auth_state(user, refresh_result, auth_state)
+        else:
+            tokens = await exchange()
+            new_auth_state = auth_state
+
+        exchanged_tokens = new_auth_state.get('exchanged_tokens') or {}
+        if new_auth_state is not auth_state or \
+                any(exchanged_tokens.get(service_name) != token for service_name, token in tokens.items()):
+            if tokens:
+                self.log.info(f"Exchanged on demand tokens {list(tokens)} for the session of user {user.name}")
+            new_auth_state['exchanged_tokens'] = {**exchanged_tokens, **tokens}
+            new_auth_state = compact_auth_state(new_auth_state)
+            await user.save_auth_state(self._stored_auth_state(new_auth_state))
+            self._cache_auth_state(user.name, new_auth_state)
+        return new_auth_state
+
+    def _spawn_refreshed_auth_state(self, user, refresh_result, auth_state):
+        if isinstance(refresh_result, dict):
+            return read_auth_state(refresh_result['auth_state'])
+        exp = stored_expiry(auth_state, 'access_token')
+        if not refresh_result and (exp is None or exp <= time.time()):
+            raise web.HTTPError(403, f"auth has expired for {user.name}, login again")
+        self.log.warning(f'Could not refresh the tokens of user {user.name}, starting the session with the current ones')
+        return auth_state
+
+    async def post_spawn_stop(self, user, spawner):
+        if self._background_refresher is not None and \
+                not any(s.active for s in user.spawners.values() if s is not spawner):
+            self._background_refresher.remove(user.name)
 
     async def refresh_user(self, user, handler=None):
         """
             Refresh user's oAuth tokens.
             This is called when user info is requested and
             has passed more than "auth_refresh_age" seconds.
+            Concurrent calls for the same user share the result of a single refresh.
         """
         with metric_refresh_user.time():
-            start = time.time()
+            if self.refresh_stale_while_revalidate:
+                auth_state = await self.get_user_auth_state(user)
+                expires_at = self._tokens_expiry(auth_state) if auth_state else None
+                if expires_at is not None and expires_at > time.time():
+                    if self._needs_refresh(auth_state):
+                        self._revalidate(user)
+                    return True
+            return await self._coalesced_refresh(user)
+
+    def _revalidate(self, user):
+        """Refresh the tokens of the user in a background task, unless a refresh is already in progress"""
+        if user.name in self._revalidations or user.name in self._refreshes_in_flight:
+            return
+        task = asyncio.create_task(self._revalidate_user(user))
+        self._revalidations[user.name] = task
+        task.add_done_callback(lambda _: self._revalidations.pop(user.name, None))
+
+    async def _revalidate_user(self, user):
+        try:
+            await self._background_refresh_user(user, force=False)
+        except Exception:
+            self.log.error(f"Failed to refresh the tokens of user {user.name} in the background", exc_info=True)
+
+    async def _coalesced_refresh(self, user, force=False, min_lifetime=0):
+        in_flight = self._refreshes_in_flight.get(user.name)
+        if in_flight is not None:
+            in_flight_task, in_flight_force, in_flight_min_lifetime = in_flight
+            metric_refresh_user_coalesced.inc()
+            self.log.debug(f'Waiting for the refresh already in progress for user {user.name}')
+            result = copy.deepcopy(await asyncio.shield(in_flight_task))
+            if (in_flight_force or not force) and in_flight_min_lifetime >= min_lifetime:
+                return result
+            # The refresh in progress did not have to refresh the tokens, or for as long as this caller needs:
+            # refresh again if they still fall short
+            if result is False or (isinstance(result, dict) and self._lasts(result['auth_state'], min_lifetime)):
+                return result
+            return await self._coalesced_refresh(user, force=force, min_lifetime=min_lifetime)
+
+        task = asyncio.create_task(self._refresh_user(user, force=force, min_lifetime=min_lifetime))
+        self._refreshes_in_flight[user.name] = (task, force, min_lifetime)
+        # Only forgotten once done: if this caller is cancelled, the next ones still join the refresh
+        task.add_done_callback(
+            lambda t: self._refreshes_in_flight.pop(user.name, None) if self._refreshes_in_flight.get(user.name, (None,))[0] is t else None)
+        # Shielded, so the refresh goes on for the other callers if this request is cancelled
+        return await asyncio.shield(task)
+
+    def _lasts(self, stored_auth_state, min_lifetime):
+        """Whether the tokens of the stored auth_state are valid for at least min_lifetime seconds"""
+        expires_at = self._tokens_expiry(read_auth_state(stored_auth_state))
+        return expires_at is not None and expires_at >= time.time() + min_lifetime
+
+    async def _background_refresh_user(self, user, force=True):
+        # Exchanged tokens expiring within the lead time are exchanged again, otherwise the refreshed
+        # tokens would be due for the next background refresh right away
+        result = await self._coalesced_refresh(user, force=force, min_lifetime=self.background_refresh_lead_time)
+        if isinstance(result, dict):
+            await user.save_auth_state(result['auth_state'])
+            metric_background_refresh.labels("refreshed").inc()
+        elif result:
+            metric_background_refresh.labels("skipped").inc()
+        else:
+            self.log.info(f'Could not refresh the tokens of user {user.name} in the background')
+            metric_background_refresh.labels("failed").inc()
+        if self._background_refresher is not None:
+            metric_background_refresh_scheduled.set(len(self._background_refresher))
+
+    def _schedule_background_refresh(self, user, auth_state, force=False):
+        """Schedule the refresh of the tokens of a user with a running server ahead of their expiration"""
+        if not self.background_refresh or not auth_state:
+            return
+        if not force and not getattr(user, 'active', False):
+            return
+        expires_at = self._tokens_expiry(auth_state) or stored_expiry(auth_state, 'access_token')
+        if expires_at is None:
+            return
+        if self._background_refresher is None:
+            self._background_refresher = BackgroundRefresher(self._background_refresh_user, self.log,
+                                                             rate=self.background_refresh_rate,
+                                                             lead_time=self.background_refresh_lead_time)
+        self._background_refresher.schedule(user, expires_at)
+        metric_background_refresh_scheduled.set(len(self._background_refresher))
+
+    def _tokens_expiry(self, auth_state):
+        """Earliest expiration time of the access token and the exchanged tokens in auth_state (None if unknown)"""
+        exchanged_tokens = auth_state.get('exchanged_tokens') or {}
+        audiences = self._exchange_audiences(auth_state)
+        if not set(audiences).issubset(exchanged_tokens):
+            return None
+        expiries = [stored_expiry(auth_state, 'access_token'),
+                    *(stored_expiry(auth_state, 'exchanged_tokens', service_name) for service_name in audiences)]
+        if None in expiries:
+            return None
+        return min(expiries)
 
-            # The config was not loaded yet, just fail
-            if not self.configured:
-                return False
+    def _needs_refresh(self, auth_state):
+        """Whether the tokens in auth_state are getting close enough to their expiration to be refreshed"""
+        if self.access_token_min_lifetime <= 0:
+            return True
 
-            try:
-                # Retrieve user authentication info, decode, and check if refresh is needed
-                auth_state = await user.get_auth_state()
+        threshold = time.time() + self.access_token_min_lifetime + random.uniform(0, self.refresh_jitter)
+        expires_at = self._tokens_expiry(auth_state)
+        return expires_at is None or expires_at < threshold
 
-                # no verification of the refresh token signature as it is not needed, the auth server
-                # verifies it
-                decoded_refresh_token = self._decode_token(auth_state['refresh_token'], options={"verify_signature": False})
+    def _serve_stale(self, user, auth_state, e):
+        """Whether the user can keep their current tokens while the IdP is unavailable"""
+        if not is_outage_error(e) or not auth_state:
+            return False
+        exp = stored_expiry(auth_state, 'access_token')
+        if exp is None or exp <= time.time():
+            return False
+        self.log.warning(f'IdP unavailable ({e}), keeping the current tokens of user {user.name} (valid for {int(exp - time.time())} s)')
+        metric_stale_tokens_served.inc()
+        return True
 
-                # If we request the offline_access scope, our refresh token won't have expiration
-                diff_refresh = (decoded_refresh_token['exp'] - time.time()) if 'exp' in decoded_refresh_token else 0
+    async def _refresh_user(self, user, force=False, min_lifetime=0):
+        start = time.time()
 
-                if diff_refresh < 0:
-                    # Refresh token not valid, need to re-authenticate again
-                    self.log.info(f'Failed to refresh token as refresh token expired, took {time.time() - start}')
-                    return False
+        # The config was not loaded yet, just fail
+        if not self.configured:
+            return False
 
-                else:
-                    # We need to refresh access token (which will also refresh the refresh token)
-                    access_token, refresh_token = await self._refresh_token(auth_state['refresh_token'])
-                    #check signature for new access token, if it fails we catch in the exception below
-                    self._decode_token(access_token)
-                    auth_state['access_token'] = access_token
-                    auth_state['refresh_token'] = refresh_token
-                    try:
-                        auth_state['exchanged_tokens'] = await self._exchange_tokens(access_token)
-                    except Exception:
-                        self.log.error("Failed to exchange tokens during refresh, took %s seconds" % (time.time()-start), exc_info=True)
+        auth_state = None
+        try:
+            # Retrieve user authentication info, decode, and check if refresh is needed
+            auth_state = await self.get_user_auth_state(user)
+
+            if not force and not self._needs_refresh(auth_state):
+                self.log.debug(f'Tokens of user {user.name} are still valid for long enough, skipping refresh')
+                self._schedule_background_refresh(user, auth_state)
+                return True
+
+            # If we request the offline_access scope, our refresh token won't have expiration
+            # (no verification of the refresh token signature as it is not needed, the auth server verifies it)
+            refresh_exp = stored_expiry(auth_state, 'refresh_token')
+            diff_refresh = (refresh_exp - time.time()) if refresh_exp is not None else 0
+
+            if diff_refresh < 0:
+                # Refresh token not valid, need to re-authenticate again
+                self.log.info(f'Failed to refresh token as refresh token expired, took {time.time() - start}')
+                return False
 
+            else:
+                # We need to refresh access token (which will also refresh the refresh token)
+                access_token, refresh_token = await self._refresh_token(auth_state['refresh_token'])
+                #check signature for new access token, if it fails we catch in the exception below
+                await self._verify_token(access_token)
+                previous_exchanged_tokens = auth_state.get('exchanged_tokens')
+                auth_state['access_token'] = access_token
+                auth_state['refresh_token'] = refresh_token
+                auth_state = compact_auth_state(auth_state)
+                try:
+                    auth_state['exchanged_tokens'] = await self._exchange_tokens(
+                        access_token, username=user.name, previous=previous_exchanged_tokens,
+                        audiences=self._exchange_audiences(auth_state, user), min_lifetime=min_lifetime)
+                except Exception as e:
+                    self.log.error("Failed to exchange tokens during refresh, took %s seconds" % (time.time()-start), exc_info=True)
+                    if not self._serve_stale(user, auth_state, e):
                         return False
-
-                    self.log.info('User %s oAuth tokens refreshed, took %s seconds' % (user.name, (time.time() - start)))
-                    return {
-                        'auth_state': auth_state
-                    }
-
-            except HTTPError as e:
-                self.log.error("Failure calling the renew endpoint: %s (code: %s)" % (e.read(), e.code))
-
-            except Exception:
-                self.log.error("Failed to refresh the oAuth tokens, took %s seconds" % (time.time()-start), exc_info=True)
-
-            return False
+                    # Store the new access and refresh tokens, keeping the previous exchanged tokens
+                    auth_state['exchanged_tokens'] = previous_exchanged_tokens
+
+                self.log.info('User %s oAuth tokens refreshed, took %s seconds' % (user.name, (time.time() - start)))
+                auth_state = compact_auth_state(auth_state)
+                self._schedule_background_refresh(user, auth_state)
+                # jupyterhub stores it when we return it
+                self._cache_auth_state(user.name, auth_state)
+                return {
+                    'auth_state': self._stored_auth_state(auth_state)
+                }
+
+        except HTTPError as e:
+            self.log.error("Failure calling the renew endpoint: %s (code: %s)" % (e.read(), e.code))
+
+        except Exception as e:
+            self.log.error("Failed to refresh the oAuth tokens, took %s seconds" % (time.time()-start), exc_info=True)
+            if self._serve_stale(user, auth_state, e):
+                return True
+
+        return False
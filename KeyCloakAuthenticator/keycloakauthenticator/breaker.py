@@ -0,0 +1,91 @@
+"""
+Circuit breaker protecting the IdP endpoints from the KeyCloakAuthenticator when they are failing
+"""
+
+import asyncio
+import random
+import time
+
+from tornado import web
+from tornado.httpclient import HTTPClientError
+
+
+class CircuitOpenError(web.HTTPError):
+    """Raised instead of sending a request to an endpoint whose circuit is open"""
+
+    def __init__(self, endpoint):
+        super().__init__(503, "Identity provider unavailable, please try again later")
+        self.endpoint = endpoint
+
+
+def is_outage_error(e):
+    """Whether the exception means that the IdP is unavailable, rather than it rejecting the request"""
+    if isinstance(e, CircuitOpenError):
+        return True
+    if isinstance(e, HTTPClientError):
+        # 599 is used by tornado for timeouts and connection errors
+        return e.code >= 500
+    return isinstance(e, (OSError, asyncio.TimeoutError))
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests to an endpoint after failure_threshold consecutive failures.
+
+    Once open, the circuit lets a single probe request through after a jittered backoff
+    (half-open state): if it succeeds the circuit closes again, otherwise it re-opens
+    with a doubled backoff, up to max_reset_timeout.
+    A probe without an outcome after probe_timeout (reset_timeout by default) seconds is
+    considered lost, and another one is let through.
+    A failure_threshold of 0 disables the breaker.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30, max_reset_timeout=300, probe_timeout=None):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.probe_timeout = probe_timeout if probe_timeout is not None else reset_timeout
+
+        self.state = self.CLOSED
+        self.failures = 0
+        self.backoff = reset_timeout
+        self.retry_at = 0
+
+    def allow_request(self):
+        if self.failure_threshold <= 0 or self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.time() >= self.retry_at:
+            # Let one probe request through
+            self.state = self.HALF_OPEN
+            self.retry_at = time.time() + self.probe_timeout
+            return True
+        if self.state == self.HALF_OPEN and time.time() >= self.retry_at:
+            # The probe never reported back, let another one through
+            self.retry_at = time.time() + self.probe_timeout
+            return True
+        return False
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self.backoff = self.reset_timeout
+
+    def record_failure(self):
+        if self.failure_threshold <= 0:
+            return
+        if self.state == self.HALF_OPEN:
+            # The probe failed, wait longer before the next one
+            self.backoff = min(self.backoff * 2, self.max_reset_timeout)
+            self._open()
+            return
+        self.failures += 1
+        if self.state == self.CLOSED and self.failures >= self.failure_threshold:
+            self._open()
+
+    def _open(self):
+        self.state = self.OPEN
+        self.retry_at = time.time() + random.uniform(self.backoff / 2, self.backoff)
@@ -0,0 +1,59 @@
+"""
+In-process caches used by the KeyCloakAuthenticator
+"""
+
+import hashlib
+import time
+from collections import OrderedDict
+
+
+def token_digest(token):
+    """Digest used to index tokens in caches, so raw tokens are never used as keys"""
+    return hashlib.sha256(token.encode('utf8')).hexdigest()
+
+
+class ExpiringLRUCache:
+    """
+    Bounded LRU cache where every entry can also carry an absolute expiry timestamp.
+
+    Entries are evicted when they expire (checked lazily on lookup) or when the
+    cache is full and they are the least recently used ones.
+    A max_size of 0 disables the cache.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        entry = self._entries.get(key)
+        return entry is not None and (entry[1] is None or entry[1] > time.time())
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= time.time():
+            del self._entries[key]
+            return default
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key, value, expires_at=None):
+        if self.max_size <= 0:
+            return
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        entry = self._entries.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def clear(self):
+        self._entries.clear()
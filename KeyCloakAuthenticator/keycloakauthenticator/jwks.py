@@ -0,0 +1,152 @@
+"""
+Signing keys published by the IdP at its JWKS endpoint
+"""
+
+import asyncio
+import json
+import re
+import time
+from email.utils import parsedate_to_datetime
+
+from jwt.algorithms import RSAAlgorithm
+
+_MAX_AGE_RE = re.compile(r"max-age\s*=\s*(\d+)")
+
+
+def _cache_lifetime(headers):
+    """Seconds the JWKS response can be cached for, according to its headers (None if not set)"""
+    cache_control = headers.get('Cache-Control', '')
+    if 'no-cache' in cache_control or 'no-store' in cache_control:
+        return 0
+    match = _MAX_AGE_RE.search(cache_control)
+    if match:
+        return int(match.group(1))
+    expires = headers.get('Expires')
+    if expires:
+        try:
+            return max(0, parsedate_to_datetime(expires).timestamp() - time.time())
+        except (TypeError, ValueError):
+            pass
+    return None
+
+
+class JWKSKeySet:
+    """
+    All the signing keys of the IdP, indexed by kid, with their key objects already built.
+
+    The keyset is refreshed in the background following the cache headers of the JWKS endpoint,
+    and a token signed with an unknown kid triggers a single refetch, shared by all the callers
+    that are waiting for it.
+    With a shared cache, the keys fetched by another hub are used until they expire, instead of fetching them again.
+    """
+
+    def __init__(self, jwks_uri, fetch, log, min_refresh_interval=60, default_refresh_interval=3600, cache=None):
+        self.jwks_uri = jwks_uri
+        # Coroutine function receiving the url and returning the tornado response
+        self._fetch = fetch
+        self.log = log
+        self.min_refresh_interval = min_refresh_interval
+        self.default_refresh_interval = default_refresh_interval
+
+        self.keys = {}
+        self.document = None
+        self.default_key = None
+        self.last_refresh = 0
+        self.expires_in = default_refresh_interval
+        self._cache = cache
+        self._refreshing = None
+        self._refresher = None
+
+    def __contains__(self, kid):
+        return kid in self.keys
+
+    def get(self, kid):
+        return self.keys.get(kid)
+
+    def load(self, jwk_data):
+        """Index the keys of a JWKS document"""
+        # Find signature keys out of keys provided at certs endpoint
+        sign_keys = [key for key in jwk_data['keys'] if key.get('use') == 'sig']
+        if not sign_keys:
+            # If no signature key is found, fallback to all the keys in the list
+            sign_keys = jwk_data['keys']
+
+        keys = {}
+        for jwk in sign_keys:
+            try:
+                keys[jwk.get('kid')] = RSAAlgorithm(RSAAlgorithm.SHA256).from_jwk(jwk)
+            except Exception:
+                self.log.warning(f"Ignoring unsupported key {jwk.get('kid')} from {self.jwks_uri}", exc_info=True)
+        if not keys:
+            raise Exception(f'No usable signing key found at {self.jwks_uri}')
+
+        self.keys = keys
+        self.document = jwk_data
+        self.default_key = next(iter(keys.values()))
+        self.last_refresh = time.time()
+
+    async def _load_shared(self, kid=None):
+        """Load the keys from the shared cache, if they are there (and have the key for kid)"""
+        if self._cache is None:
+            return False
+        entry = await self._cache.get(f'jwks:{self.jwks_uri}')
+        if entry is None or (kid is not None and not any(jwk.get('kid') == kid for jwk in entry['document']['keys'])):
+            return False
+        self.load(entry['document'])
+        self.expires_in = max(entry['expires_at'] - time.time(), self.min_refresh_interval)
+        self.log.info(f"Loaded {len(self.keys)} signing keys of {self.jwks_uri} from the shared cache, next refresh in {self.expires_in:.0f} s")
+        return True
+
+    async def _refresh(self, kid=None):
+        if await self._load_shared(kid):
+            return
+        response = await self._fetch(self.jwks_uri)
+        self.load(json.loads(response.body.decode('utf8', 'replace')))
+
+        lifetime = _cache_lifetime(response.headers)
+        if lifetime is None:
+            lifetime = self.default_refresh_interval
+        self.expires_in = max(lifetime, self.min_refresh_interval)
+        self.log.info(f"Loaded {len(self.keys)} signing keys from {self.jwks_uri}, next refresh in {self.expires_in} s")
+        if self._cache is not None:
+            expires_at = time.time() + self.expires_in
+            await self._cache.set(f'jwks:{self.jwks_uri}', {'document': self.document, 'expires_at': expires_at}, expires_at)
+
+    async def refresh(self, kid=None):
+        """Fetch the keys again (unless another hub just did, with the key for kid), or wait for the fetch already in progress"""
+        if self._refreshing is None:
+            self._refreshing = asyncio.create_task(self._refresh(kid))
+            self._refreshing.add_done_callback(lambda _: setattr(self, '_refreshing', None))
+        await asyncio.shield(self._refreshing)
+
+    async def ensure_kid(self, kid):
+        """Make sure the key for kid is loaded, refetching the keyset (at most once per min_refresh_interval) if not"""
+        if kid in self.keys:
+            return
+        if self._refreshing is None and time.time() - self.last_refresh < self.min_refresh_interval:
+            # Avoid refetching for every token carrying an unknown kid
+            return
+        self.log.info(f"Unknown signing key {kid}, refreshing keys from {self.jwks_uri}")
+        try:
+            await self.refresh(kid)
+        except Exception:
+            self.log.error(f"Failed to refresh keys from {self.jwks_uri}", exc_info=True)
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.expires_in)
+            try:
+                await self.refresh()
+            except Exception:
+                self.expires_in = self.min_refresh_interval
+                self.log.error(f"Failed to refresh keys from {self.jwks_uri}, will try again in {self.expires_in} s", exc_info=True)
+
+    def start(self):
+        """Start refreshing the keys in the background"""
+        if self._refresher is None:
+            self._refresher = asyncio.ensure_future(self._refresh_loop())
+
+    def stop(self):
+        if self._refresher is not None:
+            self._refresher.cancel()
+            self._refresher = None
@@ -4,7 +4,7 @@ Defines custom prometheus metrics recording durations of actions in the KeyCloak
 These metrics are scraped by prometheus from the /hub/metrics endpoint
 """
 
-from prometheus_client import Histogram
+from prometheus_client import Counter, Gauge, Histogram
 
 # Customize default buckets to include more buckets between 10s-infinity
 _buckets = (
@@ -56,13 +56,143 @@ _TORNADO_QUEUE_DURATION_SECONDS = Histogram(
     buckets=_buckets,
 )
 
+_CACHE_LOOKUPS = Counter(
+    "keycloak_authenticator_cache_lookups",
+    "Number of lookups in the caches of the KeyCloakAuthenticator",
+    labelnames=["cache", "result"],
+)
+
+_COALESCED_CALLS = Counter(
+    "keycloak_authenticator_coalesced_calls",
+    "Number of calls to methods of the KeyCloakAuthenticator that waited for the result of a call already in progress",
+    labelnames=["method"],
+)
+
+_IDP_REQUESTS_IN_FLIGHT = Gauge(
+    "keycloak_authenticator_idp_requests_in_flight",
+    "Number of requests to the IdP currently in progress in the KeyCloakAuthenticator http client",
+)
+
+_IDP_POOL_SATURATION = Gauge(
+    "keycloak_authenticator_idp_pool_saturation",
+    "Ratio of the KeyCloakAuthenticator http client slots (idp_max_clients) currently in use",
+)
+
+_IDP_CONNECTIONS = Counter(
+    "keycloak_authenticator_idp_connections",
+    "Number of requests to the IdP, by whether they reused an open connection",
+    labelnames=["reused"],
+)
+
+_TOKEN_ENDPOINT_CIRCUIT_OPEN = Gauge(
+    "keycloak_authenticator_token_endpoint_circuit_open",
+    "1 if the requests to the token endpoint are currently stopped because it was failing, 0 otherwise",
+)
+
+_TOKEN_ENDPOINT_REJECTED = Counter(
+    "keycloak_authenticator_token_endpoint_rejected",
+    "Number of requests to the token endpoint not sent because it was failing",
+)
+
+_STALE_TOKENS_SERVED = Counter(
+    "keycloak_authenticator_stale_tokens_served",
+    "Number of failed token refreshes where the user kept their still valid tokens because the IdP was unavailable",
+)
+
+_BACKGROUND_REFRESH = Counter(
+    "keycloak_authenticator_background_refresh",
+    "Number of token refreshes done in the background, by result",
+    labelnames=["result"],
+)
+
+_BACKGROUND_REFRESH_SCHEDULED = Gauge(
+    "keycloak_authenticator_background_refresh_scheduled",
+    "Number of users whose tokens are scheduled to be refreshed in the background",
+)
+
+_EXCHANGE_DURATION_SECONDS = Histogram(
+    "keycloak_authenticator_exchange_duration_seconds",
+    "Histogram of durations of token exchanges per audience, including timeouts and hedged requests",
+    labelnames=["audience"],
+    buckets=_buckets,
+)
+
+_EXCHANGE_FAILURES = Counter(
+    "keycloak_authenticator_exchange_failures",
+    "Number of failed (or timed out) token exchanges per audience",
+    labelnames=["audience"],
+)
+
+_EXCHANGE_HEDGED = Counter(
+    "keycloak_authenticator_exchange_hedged",
+    "Number of token exchanges per audience that were slow enough to send a second request",
+    labelnames=["audience"],
+)
+
+_JWT_VERIFY_QUEUE_DEPTH = Gauge(
+    "keycloak_authenticator_jwt_verify_queue_depth",
+    "Number of tokens waiting or being verified in the worker pool of the KeyCloakAuthenticator",
+)
+
+_JWT_VERIFY_DURATION_SECONDS = Histogram(
+    "keycloak_authenticator_jwt_verify_duration_seconds",
+    "Histogram of durations of token verifications in the worker pool of the KeyCloakAuthenticator",
+    buckets=_buckets,
+)
+
+_LOGIN_QUEUE_DEPTH = Gauge(
+    "keycloak_authenticator_login_queue_depth",
+    "Number of logins waiting for a slot (login_max_concurrent) in the KeyCloakAuthenticator",
+)
+
+_LOGIN_QUEUE_WAIT_SECONDS = Histogram(
+    "keycloak_authenticator_login_queue_wait_seconds",
+    "Histogram of the time logins waited for a slot (login_max_concurrent) in the KeyCloakAuthenticator",
+    buckets=_buckets,
+)
+
+_LOGINS_REJECTED = Counter(
+    "keycloak_authenticator_logins_rejected",
+    "Number of logins rejected by the KeyCloakAuthenticator because the login queue was full",
+)
+
 metric_refresh_user = _METHOD_DURATION_SECONDS.labels("refresh_user")
 metric_authenticate = _METHOD_DURATION_SECONDS.labels("authenticate")
 metric_pre_spawn_start = _METHOD_DURATION_SECONDS.labels("pre_spawn_start")
 
+metric_refresh_user_coalesced = _COALESCED_CALLS.labels("refresh_user")
+
 metric_refresh_token = _REQUEST_DURATION_SECONDS.labels("refresh_token")
 
 metric_exchange_tornado_request_time = _TORNADO_REQUEST_DURATION_SECONDS # Label 'request' set dynamically
 metric_exchange_tornado_queue_time = _TORNADO_QUEUE_DURATION_SECONDS # Label 'request' set dynamically
 metric_refresh_tornado_request_time = _TORNADO_REQUEST_DURATION_SECONDS # Label 'request' set dynamically
 metric_refresh_tornado_queue_time = _TORNADO_QUEUE_DURATION_SECONDS.labels("refresh_token")
+
+metric_token_cache_hit = _CACHE_LOOKUPS.labels("verified_token", "hit")
+metric_token_cache_miss = _CACHE_LOOKUPS.labels("verified_token", "miss")
+metric_auth_state_cache_hit = _CACHE_LOOKUPS.labels("auth_state", "hit")
+metric_auth_state_cache_miss = _CACHE_LOOKUPS.labels("auth_state", "miss")
+metric_exchanged_token_cache = _CACHE_LOOKUPS # Label 'cache' set dynamically
+
+metric_idp_requests_in_flight = _IDP_REQUESTS_IN_FLIGHT
+metric_idp_pool_saturation = _IDP_POOL_SATURATION
+metric_idp_connections = _IDP_CONNECTIONS # Label 'reused' set dynamically
+
+metric_token_endpoint_circuit_open = _TOKEN_ENDPOINT_CIRCUIT_OPEN
+metric_token_endpoint_rejected = _TOKEN_ENDPOINT_REJECTED
+metric_stale_tokens_served = _STALE_TOKENS_SERVED
+
+metric_background_refresh = _BACKGROUND_REFRESH # Label 'result' set dynamically
+metric_background_refresh_scheduled = _BACKGROUND_REFRESH_SCHEDULED
+
+metric_exchange_duration = _EXCHANGE_DURATION_SECONDS # Label 'audience' set dynamically
+metric_exchange_failures = _EXCHANGE_FAILURES # Label 'audience' set dynamically
+metric_exchange_hedged = _EXCHANGE_HEDGED # Label 'audience' set dynamically
+
+metric_jwt_verify_queue_depth = _JWT_VERIFY_QUEUE_DEPTH
+metric_jwt_verify_duration = _JWT_VERIFY_DURATION_SECONDS
+
+metric_login_queue_depth = _LOGIN_QUEUE_DEPTH
+metric_login_queue_wait = _LOGIN_QUEUE_WAIT_SECONDS
+metric_logins_rejected = _LOGINS_REJECTED
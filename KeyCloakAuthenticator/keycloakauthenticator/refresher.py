@@ -0,0 +1,111 @@
+"""
+Background refresh of the tokens of the users with running servers
+"""
+
+import asyncio
+import heapq
+import itertools
+import time
+
+
+class BackgroundRefresher:
+    """
+    Refreshes the tokens of the scheduled users shortly before they expire.
+
+    Users are kept in a priority queue ordered by the time their refresh is due,
+    and refreshes are started at most at `rate` per second, so that users whose tokens
+    expire at the same time are spread over time instead of hitting the IdP all at once.
+
+    After a refresh, tokens valid for less than lead_time (e.g. access tokens with a shorter lifetime)
+    are refreshed again after half their lifetime, and never sooner than min_interval seconds after
+    the previous refresh, so that a refresh not extending the tokens does not loop.
+    """
+
+    def __init__(self, refresh, log, rate=5.0, lead_time=600, min_interval=60):
+        # Coroutine function receiving the user to refresh
+        self._refresh = refresh
+        self.log = log
+        self.rate = rate
+        self.lead_time = lead_time
+        self.min_interval = min_interval
+
+        self._queue = []
+        # username -> (user, due time), the entries of the queue not matching it are stale
+        self._scheduled = {}
+        # username -> time of the last background refresh
+        self._last_refresh = {}
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._refreshing = set()
+        self._task = None
+
+    def __len__(self):
+        return len(self._scheduled)
+
+    def __contains__(self, username):
+        return username in self._scheduled
+
+    def schedule(self, user, expires_at):
+        """(Re)schedule the refresh of the user, lead_time seconds before expires_at"""
+        due = expires_at - self.lead_time
+        last_refresh = self._last_refresh.get(user.name)
+        if last_refresh is not None:
+            now = time.time()
+            due = max(due, now + (expires_at - now) / 2, last_refresh + self.min_interval)
+        self._scheduled[user.name] = (user, due)
+        heapq.heappush(self._queue, (due, next(self._counter), user.name))
+        self._wakeup.set()
+        self.start()
+
+    def remove(self, username):
+        self._scheduled.pop(username, None)
+        self._last_refresh.pop(username, None)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _refresh_user(self, user):
+        try:
+            await self._refresh(user)
+        except Exception:
+            self.log.error(f"Failed to refresh the tokens of user {user.name} in the background", exc_info=True)
+
+    async def _run(self):
+        while True:
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            due, _, username = self._queue[0]
+            entry = self._scheduled.get(username)
+            if entry is None or entry[1] != due:
+                # The user was removed or rescheduled
+                heapq.heappop(self._queue)
+                continue
+
+            delay = due - time.time()
+            if delay > 0:
+                # Sleep until the refresh is due, or until an earlier one is scheduled
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self._queue)
+            del self._scheduled[username]
+            self._last_refresh[username] = time.time()
+            task = asyncio.create_task(self._refresh_user(entry[0]))
+            self._refreshing.add(task)
+            task.add_done_callback(self._refreshing.discard)
+
+            # Spread the refreshes evenly
+            await asyncio.sleep(1 / self.rate)
@@ -0,0 +1,238 @@
+"""
+Cache shared by several hubs (or hub processes), so that they do not each fetch the OIDC configuration
+and the signing keys, nor exchange tokens that another one already got.
+
+The backend is selected with a url:
+ - memory: in the process only (for a single hub, or for testing)
+ - sqlite:///path/to/file.db: a SQLite file, shared by the processes of the same host (or a shared volume).
+   Like the jupyterhub db_url, the path is relative to the working directory (sqlite:////path for an absolute one)
+ - redis://[:password@]host[:port][/db]: a server speaking the Redis protocol
+"""
+
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+from urllib.parse import unquote, urlparse
+
+from .cache import ExpiringLRUCache
+
+
+class MemoryCacheBackend:
+    def __init__(self, max_size=4096):
+        self._entries = ExpiringLRUCache(max_size)
+
+    async def get(self, key):
+        return self._entries.get(key)
+
+    async def set(self, key, value, expires_at):
+        self._entries.set(key, value, expires_at)
+
+    async def delete(self, key):
+        self._entries.pop(key)
+
+    def close(self):
+        self._entries.clear()
+
+
+class SQLiteCacheBackend:
+    """Entries are stored in a table of a SQLite database, the queries run in a thread"""
+
+    # Expired entries are deleted once every this many writes
+    _PURGE_EVERY = 100
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._db = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        with self._lock:
+            # Readers do not block the writer of another process
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)")
+
+    def _get(self, key):
+        with self._lock:
+            row = self._db.execute("SELECT value FROM cache WHERE key = ? AND expires_at > ?", (key, time.time())).fetchone()
+        return row[0] if row else None
+
+    def _set(self, key, value, expires_at):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)", (key, value, expires_at))
+            self._writes += 1
+            if self._writes % self._PURGE_EVERY == 0:
+                self._db.execute("DELETE FROM cache WHERE expires_at <= ?", (time.time(),))
+
+    def _delete(self, key):
+        with self._lock:
+            self._db.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    async def get(self, key):
+        return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key, value, expires_at):
+        await asyncio.to_thread(self._set, key, value, expires_at)
+
+    async def delete(self, key):
+        await asyncio.to_thread(self._delete, key)
+
+    def close(self):
+        self._db.close()
+
+
+class RedisError(Exception):
+    """Error reply of the Redis server"""
+
+
+def _encode_command(args):
+    parts = [f"*{len(args)}\r\n".encode()]
+    for arg in args:
+        data = arg if isinstance(arg, bytes) else str(arg).encode('utf8')
+        parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+    return b"".join(parts)
+
+
+async def _read_reply(reader):
+    line = await reader.readline()
+    if not line.endswith(b"\r\n"):
+        raise ConnectionError("Connection to the Redis server closed")
+    kind, payload = line[:1], line[1:-2]
+    if kind == b"+":
+        return payload.decode('utf8')
+    if kind == b"-":
+        raise RedisError(payload.decode('utf8'))
+    if kind == b":":
+        return int(payload)
+    if kind == b"$":
+        length = int(payload)
+        if length < 0:
+            return None
+        data = await reader.readexactly(length + 2)
+        return data[:-2].decode('utf8')
+    if kind == b"*":
+        length = int(payload)
+        if length < 0:
+            return None
+        return [await _read_reply(reader) for _ in range(length)]
+    raise RedisError(f"Unexpected reply from the Redis server: {line!r}")
+
+
+class RedisCacheBackend:
+    """
+    Minimal client of the Redis protocol (RESP) over a single asyncio connection.
+
+    Only the GET, SET (with an expiration) and DEL commands are used, which any Redis compatible server supports.
+    The connection is opened on first use, and again after an error.
+    """
+
+    def __init__(self, host='localhost', port=6379, db=0, password=None, timeout=1.0):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self._reader = None
+        self._writer = None
+        self._lock = asyncio.Lock()
+
+    async def _send(self, *args):
+        self._writer.write(_encode_command(args))
+        await self._writer.drain()
+        return await _read_reply(self._reader)
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            if self.password:
+                await self._send("AUTH", self.password)
+            if self.db:
+                await self._send("SELECT", self.db)
+        except BaseException:
+            # Not authenticated or on the wrong database, do not keep using this connection
+            self.close()
+            raise
+
+    async def command(self, *args):
+        # One command at a time on the connection, so that the replies match the commands
+        async with self._lock:
+            try:
+                async with asyncio.timeout(self.timeout):
+                    if self._writer is None:
+                        await self._connect()
+                    return await self._send(*args)
+            except (OSError, TimeoutError, asyncio.IncompleteReadError, asyncio.CancelledError):
+                # The connection is in an unknown state, open a new one next time
+                self.close()
+                raise
+
+    async def get(self, key):
+        return await self.command("GET", key)
+
+    async def set(self, key, value, expires_at):
+        ttl_ms = int((expires_at - time.time()) * 1000)
+        if ttl_ms <= 0:
+            await self.command("DEL", key)
+            return
+        await self.command("SET", key, value, "PX", ttl_ms)
+
+    async def delete(self, key):
+        await self.command("DEL", key)
+
+    def close(self):
+        if self._writer is not None:
+            try:
+                self._writer.close()
+            except RuntimeError:
+                # The event loop is already closed (at exit), the socket goes with it
+                pass
+        self._reader = None
+        self._writer = None
+
+
+def cache_backend(url):
+    """Backend for the cache url (see the module documentation)"""
+    parsed = urlparse(url)
+    if url == 'memory':
+        return MemoryCacheBackend()
+    if parsed.scheme == 'sqlite':
+        return SQLiteCacheBackend(unquote(parsed.path[1:]))
+    if parsed.scheme == 'redis':
+        return RedisCacheBackend(
+            host=parsed.hostname or 'localhost',
+            port=parsed.port or 6379,
+            db=int(parsed.path.lstrip('/') or 0),
+            password=unquote(parsed.password) if parsed.password else None,
+        )
+    raise ValueError(f"Unsupported cache backend url: {url}")
+
+
+class SharedCache:
+    """
+    JSON values in a cache backend, under a common prefix.
+
+    Errors of the backend are logged and handled as cache misses, so that an unavailable cache
+    only means talking to the IdP again.
+    """
+
+    def __init__(self, backend, log, prefix='keycloakauthenticator:'):
+        self.backend = backend
+        self.log = log
+        self.prefix = prefix
+
+    async def get(self, key):
+        try:
+            value = await self.backend.get(self.prefix + key)
+        except Exception as e:
+            self.log.warning(f"Failed to read {key} from the shared cache: {e!r}")
+            return None
+        return json.loads(value) if value is not None else None
+
+    async def set(self, key, value, expires_at):
+        try:
+            await self.backend.set(self.prefix + key, json.dumps(value), expires_at)
+        except Exception as e:
+            self.log.warning(f"Failed to write {key} to the shared cache: {e!r}")
+
+    def close(self):
+        self.backend.close()
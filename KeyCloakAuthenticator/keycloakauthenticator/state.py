@@ -0,0 +1,77 @@
+"""
+Layout of the auth_state stored by jupyterhub for the users of the KeyCloakAuthenticator
+
+Version 2 drops token_response, which only duplicates the tokens stored next to it, and records the expiration
+time of every token in expires_at, so that checking them does not need decoding the tokens.
+This breaks stock JupyterHub/oauthenticator code reading token_response from user.get_auth_state(): it must read
+access_token, refresh_token and id_token instead.
+It can also be stored compressed. The auth_state stored before (without version) is read as well.
+"""
+
+import base64
+import json
+import zlib
+
+import jwt
+
+AUTH_STATE_VERSION = 2
+
+# Fields set by oauthenticator that only duplicate the tokens. id_token is kept, e.g. for the id_token_hint of the logout
+_DROPPED_FIELDS = ('token_response',)
+
+
+def token_expiry(token):
+    """Expiration time of a token, without verifying it (None if unknown)"""
+    if not token:
+        return None
+    try:
+        return jwt.decode(token, options={"verify_signature": False}).get('exp')
+    except jwt.exceptions.InvalidTokenError:
+        return None
+
+
+def compact_auth_state(auth_state):
+    """auth_state in the current layout, with the expiration times of its current tokens"""
+    state = {key: value for key, value in auth_state.items() if key not in _DROPPED_FIELDS}
+    state['version'] = AUTH_STATE_VERSION
+    state['expires_at'] = {
+        'access_token': token_expiry(state.get('access_token')),
+        'refresh_token': token_expiry(state.get('refresh_token')),
+        'exchanged_tokens': {service_name: token_expiry(token)
+                             for service_name, token in (state.get('exchanged_tokens') or {}).items()},
+    }
+    return state
+
+
+def compress_auth_state(auth_state):
+    data = json.dumps(auth_state, separators=(',', ':')).encode('utf8')
+    return {
+        'version': AUTH_STATE_VERSION,
+        'compressed': base64.b64encode(zlib.compress(data)).decode('ascii'),
+    }
+
+
+def read_auth_state(stored):
+    """auth_state in the current layout, from the stored one (compressed or not, in the current layout or the older one)"""
+    if stored is None:
+        return None
+    if 'compressed' in stored:
+        return json.loads(zlib.decompress(base64.b64decode(stored['compressed'])))
+    if stored.get('version') != AUTH_STATE_VERSION:
+        return compact_auth_state(stored)
+    return stored
+
+
+def stored_expiry(auth_state, token_name, service_name=None):
+    """
+    Expiration time of a token of auth_state (access_token, refresh_token, or an exchanged_tokens service_name),
+    from expires_at, or from the token itself if auth_state does not have it.
+    """
+    expires_at = auth_state.get('expires_at')
+    if expires_at is not None:
+        exp = expires_at.get(token_name)
+        return (exp or {}).get(service_name) if service_name is not None else exp
+    token = auth_state.get(token_name)
+    if service_name is not None:
+        token = (token or {}).get(service_name)
+    return token_expiry(token)
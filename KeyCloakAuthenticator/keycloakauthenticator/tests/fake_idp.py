@@ -0,0 +1,212 @@
+"""
+In-process fake OIDC provider, to run the KeyCloakAuthenticator without a real Keycloak.
+
+It serves the discovery, JWKS, token (authorization code, refresh and token exchange)
+and userinfo endpoints, with configurable latency and error injection.
+The authorization code sent to the token endpoint is used as the username.
+"""
+
+import asyncio
+import copy
+import json
+import random
+import time
+import uuid
+from urllib import parse
+
+import jwt
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jwt.algorithms import RSAAlgorithm
+from tornado import web
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+
+KEY_ID = "fake-idp-key"
+
+
+class _FakeIdPHandler(web.RequestHandler):
+    def initialize(self, idp, endpoint):
+        self.idp = idp
+        self.endpoint = endpoint
+
+    async def prepare(self):
+        self.idp.requests[self.endpoint] = self.idp.requests.get(self.endpoint, 0) + 1
+        latency = self.idp.latency.get(self.endpoint, 0) if isinstance(self.idp.latency, dict) else self.idp.latency
+        if latency:
+            await asyncio.sleep(latency)
+        error_rate = self.idp.error_rate.get(self.endpoint, 0) if isinstance(self.idp.error_rate, dict) else self.idp.error_rate
+        if error_rate and random.random() < error_rate:
+            raise web.HTTPError(503)
+
+    def write_json(self, data, **headers):
+        for name, value in headers.items():
+            self.set_header(name, value)
+        self.set_header("Content-Type", "application/json")
+        self.finish(json.dumps(data))
+
+
+class _DiscoveryHandler(_FakeIdPHandler):
+    def get(self):
+        url = self.idp.url
+        self.write_json({
+            "issuer": url,
+            "authorization_endpoint": f"{url}/auth",
+            "token_endpoint": f"{url}/token",
+            "userinfo_endpoint": f"{url}/userinfo",
+            "end_session_endpoint": f"{url}/logout",
+            "jwks_uri": f"{url}/certs",
+        })
+
+
+class _JWKSHandler(_FakeIdPHandler):
+    def get(self):
+        jwk = json.loads(RSAAlgorithm.to_jwk(self.idp.private_key.public_key()))
+        jwk.update({"kid": KEY_ID, "use": "sig", "alg": "RS256"})
+        self.write_json({"keys": [jwk]}, **{"Cache-Control": "max-age=3600"})
+
+
+class _TokenHandler(_FakeIdPHandler):
+    def post(self):
+        args = dict(parse.parse_qsl(self.request.body.decode()))
+        grant_type = args.get("grant_type")
+        if grant_type == "authorization_code":
+            username = args["code"]
+        elif grant_type == "refresh_token":
+            username = self.idp.decode(args["refresh_token"])["preferred_username"]
+        elif grant_type == "urn:ietf:params:oauth:grant-type:token-exchange":
+            username = self.idp.decode(args["subject_token"])["preferred_username"]
+            self.write_json({
+                "access_token": self.idp.issue(username, audience=args["audience"]),
+                "token_type": "Bearer",
+            })
+            return
+        else:
+            raise web.HTTPError(400, f"Unsupported grant_type {grant_type}")
+
+        self.write_json({
+            "access_token": self.idp.issue(username),
+            "refresh_token": self.idp.issue(username, lifetime=self.idp.refresh_token_lifetime),
+            "id_token": self.idp.issue(username),
+            "token_type": "Bearer",
+            "scope": "openid profile",
+        })
+
+
+class _UserInfoHandler(_FakeIdPHandler):
+    def get(self):
+        token = self.request.headers.get("Authorization", "").split(" ")[-1]
+        claims = self.idp.decode(token)
+        self.write_json({"sub": claims["sub"], "preferred_username": claims["preferred_username"]})
+
+
+class FakeIdP:
+    """
+    Fake OIDC provider listening on a local port.
+
+    latency and error_rate can be a number, applied to all the endpoints, or a dict by endpoint
+    ("discovery", "jwks", "token", "userinfo"). requests counts the requests received per endpoint.
+    """
+
+    def __init__(self, client_id="swan", roles=("swan-users",), latency=0, error_rate=0,
+                 access_token_lifetime=1200, refresh_token_lifetime=36000):
+        self.client_id = client_id
+        self.roles = list(roles)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.access_token_lifetime = access_token_lifetime
+        self.refresh_token_lifetime = refresh_token_lifetime
+        self.private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self.requests = {}
+        self.url = None
+        self._server = None
+
+    def issue(self, username, audience=None, lifetime=None):
+        now = int(time.time())
+        return jwt.encode(
+            payload={
+                "iss": self.url,
+                "aud": audience or self.client_id,
+                "sub": f"sub-{username}",
+                "preferred_username": username,
+                "iat": now,
+                "exp": now + (lifetime or self.access_token_lifetime),
+                "jti": uuid.uuid4().hex,
+                "resource_access": {self.client_id: {"roles": self.roles}},
+            },
+            key=self.private_key,
+            algorithm="RS256",
+            headers={"kid": KEY_ID},
+        )
+
+    def decode(self, token):
+        try:
+            return jwt.decode(token, self.private_key.public_key(), algorithms=["RS256"],
+                              options={"verify_aud": False}, issuer=self.url)
+        except jwt.exceptions.InvalidTokenError as e:
+            raise web.HTTPError(400, f"Invalid token: {e}") from e
+
+    def start(self):
+        app = web.Application([
+            (r"/.well-known/openid-configuration", _DiscoveryHandler, dict(idp=self, endpoint="discovery")),
+            (r"/certs", _JWKSHandler, dict(idp=self, endpoint="jwks")),
+            (r"/token", _TokenHandler, dict(idp=self, endpoint="token")),
+            (r"/userinfo", _UserInfoHandler, dict(idp=self, endpoint="userinfo")),
+        ])
+        sock, port = bind_unused_port()
+        self._server = HTTPServer(app)
+        self._server.add_sockets([sock])
+        self.url = f"http://127.0.0.1:{port}"
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.stop()
+            self._server = None
+
+
+class FakeLoginHandler:
+    """Stands for the oauth callback handler, carrying the authorization code (the username)"""
+
+    def __init__(self, username):
+        self.username = username
+
+    def get_argument(self, name, default=None):
+        return self.username if name == "code" else default
+
+    def find_user(self, name):
+        return None
+
+
+class FakeUser:
+    """Stands for a JupyterHub user, keeping its auth_state in memory"""
+
+    def __init__(self, name, auth_state=None, active=False):
+        self.name = name
+        self.auth_state = auth_state
+        self.active = active
+        self.spawners = {}
+
+    async def get_auth_state(self):
+        return copy.deepcopy(self.auth_state)
+
+    async def save_auth_state(self, auth_state):
+        self.auth_state = copy.deepcopy(auth_state)
+
+
+async def configured_authenticator(idp, **config):
+    """A KeyCloakAuthenticator talking to the fake IdP, once it has loaded its configuration"""
+    from ..auth import KeyCloakAuthenticator
+
+    config.setdefault("username_claim", "preferred_username")
+    authenticator = KeyCloakAuthenticator(
+        oidc_issuer=idp.url,
+        client_id=idp.client_id,
+        client_secret="fake-secret",
+        oauth_callback_url="http://hub/hub/oauth_callback",
+        **config,
+    )
+    # The configuration is loaded by a background task started in the constructor
+    async with asyncio.timeout(10):
+        while not authenticator.configured:  # noqa: ASYNC110
+            await asyncio.sleep(0.01)
+    return authenticator
@@ -0,0 +1,78 @@
+"""
+In-process stand-in of a Redis server, speaking enough of its protocol (RESP) for the shared cache:
+PING, AUTH, SELECT, GET, SET (with EX/PX) and DEL.
+"""
+
+import asyncio
+import time
+
+from ..shared_cache import _read_reply
+
+
+class FakeRedis:
+    """Fake Redis server listening on a local port. commands counts the commands received by name."""
+
+    def __init__(self, password=None):
+        self.password = password
+        self.data = {}
+        self.commands = {}
+        self.port = None
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, "127.0.0.1", 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    @property
+    def url(self):
+        auth = f":{self.password}@" if self.password else ""
+        return f"redis://{auth}127.0.0.1:{self.port}/0"
+
+    async def _serve(self, reader, writer):
+        authenticated = self.password is None
+        try:
+            while True:
+                try:
+                    args = await _read_reply(reader)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    break
+                name = args[0].upper()
+                self.commands[name] = self.commands.get(name, 0) + 1
+                if name == "AUTH":
+                    authenticated = args[-1] == self.password
+                    writer.write(b"+OK\r\n" if authenticated else b"-WRONGPASS invalid password\r\n")
+                elif not authenticated:
+                    writer.write(b"-NOAUTH Authentication required.\r\n")
+                else:
+                    writer.write(self._execute(name, args[1:]))
+                await writer.drain()
+        finally:
+            writer.close()
+
+    def _execute(self, name, args):
+        if name in ("PING", "SELECT"):
+            return b"+OK\r\n"
+        if name == "GET":
+            value, expires_at = self.data.get(args[0], (None, None))
+            if value is None or (expires_at is not None and expires_at <= time.time()):
+                return b"$-1\r\n"
+            data = value.encode("utf8")
+            return b"$%d\r\n%s\r\n" % (len(data), data)
+        if name == "SET":
+            expires_at = None
+            if len(args) == 4 and args[2].upper() == "PX":
+                expires_at = time.time() + int(args[3]) / 1000
+            elif len(args) == 4 and args[2].upper() == "EX":
+                expires_at = time.time() + int(args[3])
+            self.data[args[0]] = (args[1], expires_at)
+            return b"+OK\r\n"
+        if name == "DEL":
+            return b":%d\r\n" % sum(self.data.pop(key, None) is not None for key in args)
+        return b"-ERR unknown command '%s'\r\n" % name.encode("utf8")
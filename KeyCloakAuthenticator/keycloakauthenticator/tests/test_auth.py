@@ -1,12 +1,33 @@
 import asyncio
 import json
+import logging
+import time
+from types import SimpleNamespace
+from urllib import parse
 
 import jwt
 import pytest
 from cryptography.hazmat.primitives.asymmetric import rsa
 from jwt.algorithms import RSAAlgorithm
+from tornado import web
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError, HTTPRequest
+from traitlets import TraitError
 
+from ..admission import AdmissionController, AdmissionRejectedError
 from ..auth import KeyCloakAuthenticator
+from ..breaker import CircuitBreaker, CircuitOpenError
+from ..cache import ExpiringLRUCache
+from ..jwks import JWKSKeySet
+from ..refresher import BackgroundRefresher
+from ..shared_cache import RedisError, SharedCache, cache_backend
+from ..state import (
+    AUTH_STATE_VERSION,
+    compact_auth_state,
+    compress_auth_state,
+    read_auth_state,
+)
+from .fake_idp import FakeIdP, FakeLoginHandler, FakeUser, configured_authenticator
+from .fake_redis import FakeRedis
 
 
 def _generate_mock_public_private_key_pair():
@@ -71,6 +92,19 @@ def _make_jwks(public_key, *, use_sig=True):
     return {"keys": [jwk]}
 
 
+def _json_response(data, headers=None):
+    class MockResponse:
+        def __init__(self):
+            self.code = 200
+            self.body = json.dumps(data).encode('utf-8')
+            self.headers = headers or {}
+            self.request_time = 0
+            self.time_info = {
+                "queue": 0
+            }
+    return MockResponse()
+
+
 class TestGetOidcConfigs:
     @pytest.mark.parametrize("doc", [
         {},
@@ -169,7 +203,7 @@ class TestGetOidcConfigs:
             call_count += 1
             if call_count == 1:
                 return {**OIDC_DISCOVERY_DOC, "jwks_uri": "http://fake/certs"}
-            return jwks
+            return _json_response(jwks)
 
         monkeypatch.setattr(unconfigured_authenticator, "httpfetch", mock_httpfetch)
         unconfigured_authenticator.config.check_signature = True
@@ -192,7 +226,7 @@ class TestGetOidcConfigs:
             call_count += 1
             if call_count == 1:
                 return {**OIDC_DISCOVERY_DOC, "jwks_uri": "http://fake/certs"}
-            return jwks
+            return _json_response(jwks)
 
         monkeypatch.setattr(unconfigured_authenticator, "httpfetch", mock_httpfetch)
         unconfigured_authenticator.config.check_signature = True
@@ -242,7 +276,32 @@ class TestGetOidcConfigs:
 
         assert call_count == 2
         assert len(sleep_calls) == 1
-        assert sleep_calls[0] == 60
+        initial_delay = unconfigured_authenticator.oidc_retry_initial_delay
+        assert initial_delay / 2 <= sleep_calls[0] <= initial_delay
+
+    async def test_retries_with_exponential_backoff(self, unconfigured_authenticator, monkeypatch):
+        call_count = 0
+
+        async def mock_helper(self):
+            nonlocal call_count
+            call_count += 1
+            if call_count <= 6:
+                raise Exception("IdP down")
+
+        sleep_calls = []
+
+        async def mock_sleep(duration):
+            sleep_calls.append(duration)
+
+        monkeypatch.setattr(KeyCloakAuthenticator, "_get_oidc_configs_helper", mock_helper)
+        monkeypatch.setattr(asyncio, "sleep", mock_sleep)
+        unconfigured_authenticator.oidc_retry_initial_delay = 10
+        unconfigured_authenticator.oidc_retry_max_delay = 40
+
+        await unconfigured_authenticator._get_oidc_configs()
+
+        for duration, max_delay in zip(sleep_calls, [10, 20, 40, 40, 40, 40], strict=True):
+            assert max_delay / 2 <= duration <= max_delay
 
 
 
@@ -379,3 +438,1216 @@ async def test_refresh_user_with_expired_refresh_token(monkeypatch):
     refresh_result = await authenticator.refresh_user(MockUser())
 
     assert refresh_result is False
+
+
+class TestDecodeTokenCache:
+    @pytest.fixture
+    def authenticator(self, unconfigured_authenticator, key_pair, monkeypatch):
+        public_key, _ = key_pair
+        unconfigured_authenticator.config.check_signature = True
+        unconfigured_authenticator.public_key = public_key
+        unconfigured_authenticator.client_id = "dummy-client-id"
+        monkeypatch.setattr(unconfigured_authenticator, "oidc_issuer", "dummy-oidc-url")
+        return unconfigured_authenticator
+
+    @pytest.fixture
+    def decode_calls(self, monkeypatch):
+        calls = []
+        original_decode = jwt.decode
+
+        def counting_decode(token, *args, **kwargs):
+            calls.append(token)
+            return original_decode(token, *args, **kwargs)
+
+        monkeypatch.setattr(jwt, "decode", counting_decode)
+        return calls
+
+    def test_same_token_verified_once(self, authenticator, key_pair, decode_calls):
+        _, private_key = key_pair
+        token = _get_mock_token(private_key, "access")
+
+        first = authenticator._decode_token(token)
+        second = authenticator._decode_token(token)
+
+        assert first == second
+        assert first["jti"] == "access"
+        assert len(decode_calls) == 1
+
+    def test_different_options_not_shared(self, authenticator, key_pair, decode_calls):
+        _, private_key = key_pair
+        token = _get_mock_token(private_key, "refresh")
+
+        authenticator._decode_token(token, options={"verify_signature": False})
+        authenticator._decode_token(token)
+
+        assert len(decode_calls) == 2
+
+    def test_expired_entry_evicted(self, authenticator, key_pair, decode_calls, monkeypatch):
+        _, private_key = key_pair
+        token = _get_mock_token(private_key, "access")
+        authenticator._decode_token(token)
+
+        # Move past the token expiry: the cached claims must not be served anymore
+        monkeypatch.setattr(time, "time", lambda: 10_000_000_000)
+        authenticator._decode_token(token)
+
+        assert len(decode_calls) == 2
+
+    def test_lru_bound(self, authenticator, key_pair, decode_calls):
+        _, private_key = key_pair
+        authenticator._verified_tokens = ExpiringLRUCache(2)
+        tokens = [_get_mock_token(private_key, f"token-{i}") for i in range(3)]
+
+        for token in tokens:
+            authenticator._decode_token(token)
+        authenticator._decode_token(tokens[0])
+
+        assert len(authenticator._verified_tokens) == 2
+        assert len(decode_calls) == 4
+
+    async def test_worker_pool_verification_cached(self, authenticator, key_pair, decode_calls):
+        _, private_key = key_pair
+        authenticator.jwt_verify_workers = 2
+        token = _get_mock_token(private_key, "access")
+
+        first = await authenticator._verify_token(token)
+        second = await authenticator._verify_token(token)
+
+        assert first == second
+        assert first["jti"] == "access"
+        assert len(decode_calls) == 1
+        authenticator.close()
+
+    async def test_worker_pool_does_not_block_event_loop(self, authenticator, key_pair, monkeypatch):
+        _, private_key = key_pair
+        authenticator.jwt_verify_workers = 1
+        original_decode = jwt.decode
+
+        def slow_decode(token, *args, **kwargs):
+            time.sleep(0.3)
+            return original_decode(token, *args, **kwargs)
+
+        monkeypatch.setattr(jwt, "decode", slow_decode)
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticking = asyncio.create_task(ticker())
+        decoded = await authenticator._verify_token(_get_mock_token(private_key, "access"))
+        ticking.cancel()
+
+        assert decoded["jti"] == "access"
+        assert ticks >= 10
+        authenticator.close()
+
+    async def test_process_pool_verification(self, authenticator, key_pair):
+        _, private_key = key_pair
+        authenticator.jwt_verify_workers = 1
+        authenticator.jwt_verify_executor = "process"
+
+        decoded = await authenticator._verify_token(_get_mock_token(private_key, "access"))
+        expired = await authenticator._verify_token(_get_mock_token(private_key, "expired", expired=True))
+
+        assert decoded["jti"] == "access"
+        assert expired is None
+        authenticator.close()
+
+        # Workers started again when needed
+        assert authenticator._verifier_pool is None
+        assert (await authenticator._verify_token(_get_mock_token(private_key, "access")))["jti"] == "access"
+        authenticator.close()
+
+
+class TestJWKSKeySet:
+    @staticmethod
+    def _jwk(public_key, kid):
+        jwk = json.loads(RSAAlgorithm.to_jwk(public_key))
+        jwk.update({"use": "sig", "kid": kid})
+        return jwk
+
+    async def test_indexes_all_keys_and_cache_headers(self, unconfigured_authenticator):
+        old_key, new_key = _generate_mock_public_private_key_pair(), _generate_mock_public_private_key_pair()
+        jwks = {"keys": [self._jwk(old_key[0], "old"), self._jwk(new_key[0], "new")]}
+
+        async def fetch(url):
+            return _json_response(jwks, headers={"Cache-Control": "public, max-age=300"})
+
+        keyset = JWKSKeySet("http://fake/certs", fetch, unconfigured_authenticator.log)
+        await keyset.refresh()
+
+        assert "old" in keyset and "new" in keyset
+        assert keyset.expires_in == 300
+
+    async def test_default_key_follows_rotation(self, unconfigured_authenticator):
+        """Tokens without a kid are verified with the default key of the current keys, also after a refresh"""
+        (old_public, _), (new_public, new_private) = _generate_mock_public_private_key_pair(), _generate_mock_public_private_key_pair()
+        jwks = {"keys": [self._jwk(old_public, "old")]}
+
+        async def fetch(url):
+            return _json_response(jwks)
+
+        keyset = JWKSKeySet("http://fake/certs", fetch, unconfigured_authenticator.log)
+        await keyset.refresh()
+        unconfigured_authenticator._use_keyset(keyset)
+        assert unconfigured_authenticator.public_key.public_numbers() == old_public.public_numbers()
+
+        # The IdP rotates its keys, dropping the old one
+        jwks = {"keys": [self._jwk(new_public, "new")]}
+        await keyset.refresh()
+        token = jwt.encode({"sub": "alice"}, new_private, algorithm="RS256")
+        assert unconfigured_authenticator._signing_key(token).public_numbers() == new_public.public_numbers()
+
+        unconfigured_authenticator._use_keyset(None)
+        assert unconfigured_authenticator.public_key is None
+
+    async def test_unknown_kid_single_coalesced_refetch(self, unconfigured_authenticator, monkeypatch):
+        """A key rotation: tokens signed with a new key are accepted after a single refetch"""
+        (old_public, _), (new_public, new_private) = _generate_mock_public_private_key_pair(), _generate_mock_public_private_key_pair()
+        jwks = {"keys": [self._jwk(old_public, "old")]}
+        fetches = 0
+
+        async def fetch(url):
+            nonlocal fetches
+            fetches += 1
+            await asyncio.sleep(0)
+            return _json_response(jwks)
+
+        keyset = JWKSKeySet("http://fake/certs", fetch, unconfigured_authenticator.log, min_refresh_interval=0)
+        await keyset.refresh()
+
+        # The IdP rotates its keys
+        jwks = {"keys": [self._jwk(old_public, "old"), self._jwk(new_public, "new")]}
+
+        auth = unconfigured_authenticator
+        auth.config.check_signature = True
+        auth.client_id = "dummy-client-id"
+        auth._jwks = keyset
+        monkeypatch.setattr(auth, "oidc_issuer", "dummy-oidc-url")
+        token = jwt.encode(
+            {"iss": "dummy-oidc-url", "aud": "dummy-client-id", "exp": 9999999999, "jti": "rotated"},
+            new_private, algorithm="RS256", headers={"kid": "new"},
+        )
+
+        results = await asyncio.gather(*(auth._verify_token(token) for _ in range(5)))
+
+        assert all(r["jti"] == "rotated" for r in results)
+        assert fetches == 2
+
+    async def test_unknown_kid_refetch_rate_limited(self, unconfigured_authenticator):
+        fetches = 0
+        public_key, _ = _generate_mock_public_private_key_pair()
+
+        async def fetch(url):
+            nonlocal fetches
+            fetches += 1
+            return _json_response({"keys": [self._jwk(public_key, "only")]})
+
+        keyset = JWKSKeySet("http://fake/certs", fetch, unconfigured_authenticator.log, min_refresh_interval=60)
+        await keyset.refresh()
+        await keyset.ensure_kid("forged")
+        await keyset.ensure_kid("forged")
+
+        assert fetches == 1
+
+
+class TestExchangeTokensCache:
+    @pytest.fixture
+    def authenticator(self, unconfigured_authenticator):
+        unconfigured_authenticator.client_id = "dummy-client-id"
+        unconfigured_authenticator.client_secret = "dummy-client-secret"
+        unconfigured_authenticator.token_url = "http://fake/token"
+        unconfigured_authenticator.exchange_tokens = ["eos-service", "cernbox-service"]
+        return unconfigured_authenticator
+
+    @pytest.fixture
+    def exchanges(self, authenticator, key_pair, monkeypatch):
+        """Mock the token endpoint, recording the audience of every exchange"""
+        _, private_key = key_pair
+        audiences = []
+        lifetimes = {}
+
+        async def mock_fetch(req, label, **kwargs):
+            audience = dict(parse.parse_qsl(req.body.decode()))["audience"]
+            audiences.append(audience)
+            payload = {"aud": audience, "exp": int(time.time()) + lifetimes.get(audience, 3600)}
+            return _json_response({"access_token": jwt.encode(payload, private_key, algorithm="RS256")})
+
+        monkeypatch.setattr(authenticator, "fetch", mock_fetch)
+        return SimpleNamespace(audiences=audiences, lifetimes=lifetimes)
+
+    async def test_valid_tokens_reused(self, authenticator, exchanges):
+        first = await authenticator._exchange_tokens("subject", username="alice")
+        second = await authenticator._exchange_tokens("subject", username="alice")
+
+        assert first == second
+        assert list(first) == ["eos-service", "cernbox-service"]
+        assert exchanges.audiences == ["eos-service", "cernbox-service"]
+
+    async def test_only_expiring_audiences_exchanged_again(self, authenticator, exchanges):
+        # The cernbox token is already too close to its expiry when it's issued
+        exchanges.lifetimes["cernbox-service"] = authenticator.exchange_token_min_lifetime - 1
+
+        await authenticator._exchange_tokens("subject", username="alice")
+        await authenticator._exchange_tokens("subject", username="alice")
+
+        assert exchanges.audiences == ["eos-service", "cernbox-service", "cernbox-service"]
+
+    async def test_cache_per_user(self, authenticator, exchanges):
+        await authenticator._exchange_tokens("subject", username="alice")
+        await authenticator._exchange_tokens("subject", username="bob")
+
+        assert len(exchanges.audiences) == 4
+
+    async def test_previous_tokens_reused(self, authenticator, exchanges, key_pair):
+        _, private_key = key_pair
+        previous = {
+            "eos-service": jwt.encode({"exp": int(time.time()) + 3600}, private_key, algorithm="RS256"),
+            "cernbox-service": jwt.encode({"exp": int(time.time()) + 10}, private_key, algorithm="RS256"),
+        }
+
+        tokens = await authenticator._exchange_tokens("subject", username="alice", previous=previous)
+
+        assert tokens["eos-service"] == previous["eos-service"]
+        assert exchanges.audiences == ["cernbox-service"]
+
+    async def test_no_username_always_exchanges(self, authenticator, exchanges):
+        await authenticator._exchange_tokens("subject")
+        await authenticator._exchange_tokens("subject")
+
+        assert len(exchanges.audiences) == 4
+
+
+async def test_refresh_user_coalesced(unconfigured_authenticator, key_pair, monkeypatch):
+    """Concurrent refreshes of the same user share a single refresh"""
+    _, private_key = key_pair
+    authenticator = unconfigured_authenticator
+    authenticator.configured = True
+    monkeypatch.setattr(authenticator, "oidc_issuer", "dummy-oidc-url")
+    refreshes = 0
+
+    async def mock_refresh_token(refresh_token):
+        nonlocal refreshes
+        refreshes += 1
+        await asyncio.sleep(0.01)
+        return "new_access_token", _get_mock_token(private_key, "new_refresh_token")
+
+    async def mock_verify_token(token, options=None):
+        return {}
+
+    monkeypatch.setattr(authenticator, "_refresh_token", mock_refresh_token)
+    monkeypatch.setattr(authenticator, "_verify_token", mock_verify_token)
+
+    class MockUser:
+        name = "dummy-user"
+
+        async def get_auth_state(self):
+            return {
+                "access_token": "old_access_token",
+                "refresh_token": _get_mock_token(private_key, "old_refresh_token"),
+            }
+
+    results = await asyncio.gather(*(authenticator.refresh_user(MockUser()) for _ in range(3)))
+
+    assert refreshes == 1
+    assert all(r["auth_state"]["access_token"] == "new_access_token" for r in results)
+    assert not authenticator._refreshes_in_flight
+
+    # Once finished, a new call refreshes again
+    await authenticator.refresh_user(MockUser())
+    assert refreshes == 2
+
+
+async def test_refresh_user_coalesced_after_cancel(unconfigured_authenticator, monkeypatch):
+    """A caller cancelled while its refresh is in progress does not let the next caller start another one"""
+    authenticator = unconfigured_authenticator
+    authenticator.configured = True
+    refreshes = 0
+
+    async def mock_refresh_user(user, force=False, min_lifetime=0):
+        nonlocal refreshes
+        refreshes += 1
+        await asyncio.sleep(0.05)
+        return {"auth_state": {"access_token": "new_access_token"}}
+
+    monkeypatch.setattr(authenticator, "_refresh_user", mock_refresh_user)
+    user = SimpleNamespace(name="dummy-user")
+
+    first = asyncio.create_task(authenticator._coalesced_refresh(user))
+    await asyncio.sleep(0.01)
+    first.cancel()
+    await asyncio.sleep(0)
+    assert "dummy-user" in authenticator._refreshes_in_flight
+
+    result = await authenticator._coalesced_refresh(user)
+    assert refreshes == 1
+    assert result["auth_state"]["access_token"] == "new_access_token"
+    assert not authenticator._refreshes_in_flight
+
+
+async def test_forced_refresh_not_coalesced_onto_skipped_refresh(unconfigured_authenticator, monkeypatch):
+    """A forced refresh joining a refresh that skipped refreshing the tokens refreshes them once it is done"""
+    authenticator = unconfigured_authenticator
+    calls = []
+
+    async def mock_refresh_user(user, force=False, min_lifetime=0):
+        calls.append((force, min_lifetime))
+        await asyncio.sleep(0.01)
+        return {"auth_state": {"access_token": "new_access_token"}} if force else True
+
+    monkeypatch.setattr(authenticator, "_refresh_user", mock_refresh_user)
+    monkeypatch.setattr(authenticator, "_lasts", lambda auth_state, min_lifetime: True)
+    user = SimpleNamespace(name="dummy-user")
+
+    skipped, forced, joined = await asyncio.gather(
+        authenticator._coalesced_refresh(user),
+        authenticator._coalesced_refresh(user, force=True, min_lifetime=120),
+        authenticator._coalesced_refresh(user),
+    )
+
+    assert calls == [(False, 0), (True, 120)]
+    assert skipped is True and joined is True
+    assert forced["auth_state"]["access_token"] == "new_access_token"
+
+
+class TestRefreshPolicy:
+    @staticmethod
+    def _token(private_key, lifetime):
+        return jwt.encode({"exp": int(time.time()) + lifetime}, private_key, algorithm="RS256")
+
+    @pytest.mark.parametrize("min_lifetime,access_lifetime,exchanged_lifetime,needs_refresh", [
+        (0, 3600, 3600, True),      # policy disabled: always refresh
+        (600, 3600, 3600, False),
+        (600, 300, 3600, True),     # access token close to expiry
+        (600, 3600, 300, True),     # exchanged token close to expiry
+    ])
+    def test_needs_refresh(self, unconfigured_authenticator, key_pair, min_lifetime, access_lifetime, exchanged_lifetime, needs_refresh):
+        _, private_key = key_pair
+        authenticator = unconfigured_authenticator
+        authenticator.access_token_min_lifetime = min_lifetime
+        authenticator.refresh_jitter = 60
+        authenticator.exchange_tokens = ["eos-service"]
+        auth_state = {
+            "access_token": self._token(private_key, access_lifetime),
+            "exchanged_tokens": {"eos-service": self._token(private_key, exchanged_lifetime)},
+        }
+
+        assert authenticator._needs_refresh(auth_state) == needs_refresh
+
+    def test_missing_exchanged_token_needs_refresh(self, unconfigured_authenticator, key_pair):
+        _, private_key = key_pair
+        unconfigured_authenticator.access_token_min_lifetime = 600
+        unconfigured_authenticator.exchange_tokens = ["eos-service"]
+
+        assert unconfigured_authenticator._needs_refresh({"access_token": self._token(private_key, 3600)})
+
+    async def test_refresh_skipped(self, unconfigured_authenticator, key_pair, monkeypatch):
+        _, private_key = key_pair
+        authenticator = unconfigured_authenticator
+        authenticator.configured = True
+        authenticator.access_token_min_lifetime = 600
+
+        async def mock_refresh_token(refresh_token):
+            raise AssertionError("The tokens should not be refreshed")
+
+        monkeypatch.setattr(authenticator, "_refresh_token", mock_refresh_token)
+
+        class MockUser:
+            name = "dummy-user"
+
+            async def get_auth_state(self):
+                return {"access_token": TestRefreshPolicy._token(private_key, 3600), "refresh_token": "unused"}
+
+        assert await authenticator.refresh_user(MockUser()) is True
+
+
+class TestIdPHttpClient:
+    async def test_endpoint_concurrency_limit(self, unconfigured_authenticator):
+        authenticator = unconfigured_authenticator
+        authenticator.idp_endpoint_concurrency = 2
+        running = 0
+        max_running = 0
+
+        class MockClient:
+            async def fetch(self, req, **kwargs):
+                nonlocal running, max_running
+                running += 1
+                max_running = max(max_running, running)
+                await asyncio.sleep(0.01)
+                running -= 1
+                response = _json_response({"ok": True})
+                response.time_info = {"connect": 0}
+                return response
+
+        authenticator.http_client = MockClient()
+
+        results = await asyncio.gather(*(
+            authenticator.fetch(HTTPRequest(f"http://fake/token?attempt={i}")) for i in range(6)
+        ))
+
+        assert results == [{"ok": True}] * 6
+        assert max_running == 2
+        assert authenticator._idp_requests_in_flight == 0
+
+    def test_dedicated_client(self, unconfigured_authenticator):
+        unconfigured_authenticator.idp_max_clients = 7
+        client = unconfigured_authenticator.http_client
+
+        assert client is not AsyncHTTPClient()
+        assert getattr(client, "max_clients", 7) == 7
+
+
+class TestCircuitBreaker:
+    def test_opens_after_failures_and_probes(self, monkeypatch):
+        now = 1000
+        monkeypatch.setattr(time, "time", lambda: now)
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10, max_reset_timeout=40)
+
+        breaker.record_failure()
+        assert breaker.allow_request()
+        breaker.record_failure()
+        assert breaker.state == CircuitBreaker.OPEN
+        assert not breaker.allow_request()
+
+        # After the backoff, a single probe is let through
+        now += 10
+        assert breaker.allow_request()
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        assert not breaker.allow_request()
+
+        # The probe fails: the backoff doubles
+        breaker.record_failure()
+        assert breaker.state == CircuitBreaker.OPEN
+        assert breaker.backoff == 20
+        assert 1010 + 10 <= breaker.retry_at <= 1010 + 20
+
+        now += 20
+        assert breaker.allow_request()
+        breaker.record_success()
+        assert breaker.state == CircuitBreaker.CLOSED
+        assert breaker.allow_request()
+
+    def test_lost_probe(self, monkeypatch):
+        now = 1000
+        monkeypatch.setattr(time, "time", lambda: now)
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10, probe_timeout=30)
+        breaker.record_failure()
+        now += 10
+        assert breaker.allow_request()
+        assert not breaker.allow_request()
+
+        # The probe never records its outcome: another one is let through after probe_timeout
+        now += 29
+        assert not breaker.allow_request()
+        now += 1
+        assert breaker.allow_request()
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+
+    async def test_cancelled_probe_reopens(self, unconfigured_authenticator, monkeypatch):
+        authenticator = unconfigured_authenticator
+        authenticator.token_url = "http://fake/token"
+        breaker = authenticator._token_endpoint_breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10)
+        breaker.record_failure()
+        breaker.retry_at = 0
+
+        class HangingClient:
+            async def fetch(self, req, **kwargs):
+                await asyncio.sleep(10)
+
+        authenticator.http_client = HangingClient()
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(authenticator.fetch(HTTPRequest("http://fake/token", method="POST", body="")), 0.01)
+
+        assert breaker.state == CircuitBreaker.OPEN
+        assert breaker.backoff == 20
+        # The next probe goes through once the backoff expired
+        breaker.retry_at = 0
+        assert breaker.allow_request()
+
+    async def test_token_endpoint_fails_fast(self, unconfigured_authenticator):
+        authenticator = unconfigured_authenticator
+        authenticator.token_url = "http://fake/token"
+        authenticator._token_endpoint_breaker = CircuitBreaker(failure_threshold=2)
+        calls = 0
+
+        class MockClient:
+            async def fetch(self, req, **kwargs):
+                nonlocal calls
+                calls += 1
+                raise HTTPClientError(599, "Timeout")
+
+        authenticator.http_client = MockClient()
+
+        for _ in range(2):
+            with pytest.raises(HTTPClientError):
+                await authenticator.fetch(HTTPRequest("http://fake/token", method="POST", body=""))
+        with pytest.raises(CircuitOpenError):
+            await authenticator.fetch(HTTPRequest("http://fake/token", method="POST", body=""))
+
+        assert calls == 2
+
+    @pytest.mark.parametrize("access_lifetime,expected", [(3600, True), (-10, False)])
+    async def test_refresh_user_serves_stale_tokens(self, unconfigured_authenticator, key_pair, monkeypatch, access_lifetime, expected):
+        _, private_key = key_pair
+        authenticator = unconfigured_authenticator
+        authenticator.configured = True
+        monkeypatch.setattr(authenticator, "oidc_issuer", "dummy-oidc-url")
+
+        async def mock_refresh_token(refresh_token):
+            raise CircuitOpenError("http://fake/token")
+
+        monkeypatch.setattr(authenticator, "_refresh_token", mock_refresh_token)
+
+        class MockUser:
+            name = "dummy-user"
+
+            async def get_auth_state(self):
+                return {
+                    "access_token": jwt.encode({"exp": int(time.time()) + access_lifetime}, private_key, algorithm="RS256"),
+                    "refresh_token": _get_mock_token(private_key, "refresh"),
+                }
+
+        assert await authenticator.refresh_user(MockUser()) is expected
+
+
+class TestBackgroundRefresher:
+    async def test_refreshes_in_expiry_order(self):
+        refreshed = []
+        done = asyncio.Event()
+
+        async def refresh(user):
+            refreshed.append(user.name)
+            if len(refreshed) == 3:
+                done.set()
+
+        refresher = BackgroundRefresher(refresh, logging.getLogger(), rate=1000, lead_time=600)
+        now = time.time()
+        for name, expires_in in (("carol", 30), ("alice", 10), ("bob", 20), ("dave", 3600)):
+            refresher.schedule(SimpleNamespace(name=name), now + expires_in)
+        refresher.remove("bob")
+        refresher.schedule(SimpleNamespace(name="bob"), now + 40)
+        refresher.start()
+
+        try:
+            await asyncio.wait_for(done.wait(), 1)
+        finally:
+            refresher.stop()
+
+        assert refreshed == ["alice", "carol", "bob"]
+        assert "dave" in refresher
+
+    async def test_rate_limited(self):
+        refreshed = []
+
+        async def refresh(user):
+            refreshed.append(user.name)
+
+        refresher = BackgroundRefresher(refresh, logging.getLogger(), rate=10, lead_time=0)
+        for i in range(5):
+            refresher.schedule(SimpleNamespace(name=f"user-{i}"), 0)
+        refresher.start()
+
+        await asyncio.sleep(0.25)
+        refresher.stop()
+
+        assert 2 <= len(refreshed) <= 4
+
+    async def test_background_refresh_saves_auth_state(self, unconfigured_authenticator, monkeypatch):
+        authenticator = unconfigured_authenticator
+        saved = []
+
+        async def mock_refresh_user(user, force=False, min_lifetime=0):
+            assert force
+            return {"auth_state": {"access_token": "new"}}
+
+        monkeypatch.setattr(authenticator, "_refresh_user", mock_refresh_user)
+        authenticator._background_refresher = BackgroundRefresher(None, authenticator.log)
+
+        class MockUser:
+            name = "dummy-user"
+
+            async def save_auth_state(self, auth_state):
+                saved.append(auth_state)
+
+        await authenticator._background_refresh_user(MockUser())
+
+        assert saved == [{"access_token": "new"}]
+
+
+    async def test_refresh_does_not_loop_with_defaults(self):
+        """Exchanged tokens expiring within the lead time are exchanged again, and the next refresh is not due right away"""
+        idp = FakeIdP(access_token_lifetime=500).start()
+        try:
+            authenticator = await configured_authenticator(idp, exchange_tokens=["eos-service"], background_refresh=True)
+            login = await authenticator.authenticate(FakeLoginHandler("alice"))
+            user = FakeUser("alice", login["auth_state"], active=True)
+            idp.access_token_lifetime = 1200
+            token_requests = idp.requests.get("token", 0)
+
+            # Due right away, as the tokens expire within background_refresh_lead_time
+            authenticator._schedule_background_refresh(user, await authenticator.get_user_auth_state(user))
+            await asyncio.sleep(1)
+            authenticator._background_refresher.stop()
+
+            # A single refresh, with the exchange of a new eos-service token
+            assert idp.requests["token"] - token_requests == 2
+            assert user.auth_state["expires_at"]["exchanged_tokens"]["eos-service"] > time.time() + 1000
+            _, due = authenticator._background_refresher._scheduled["alice"]
+            assert due > time.time() + 500
+        finally:
+            idp.stop()
+
+    async def test_short_lived_tokens_do_not_loop(self):
+        refreshed = []
+
+        async def refresh(user):
+            refreshed.append(time.time())
+            # The tokens are not extended past the lead time
+            refresher.schedule(user, time.time() + 10)
+
+        refresher = BackgroundRefresher(refresh, logging.getLogger(), rate=1000, lead_time=600, min_interval=60)
+        refresher.schedule(SimpleNamespace(name="alice"), time.time() + 10)
+        refresher.start()
+        await asyncio.sleep(0.3)
+        refresher.stop()
+
+        assert len(refreshed) == 1
+        _, due = refresher._scheduled["alice"]
+        assert due > refreshed[0] + 59
+
+
+class TestExchangeTokensDeadlines:
+    @pytest.fixture
+    def authenticator(self, unconfigured_authenticator):
+        unconfigured_authenticator.token_url = "http://fake/token"
+        unconfigured_authenticator.exchange_tokens = ["eos-service", "slow-service"]
+        return unconfigured_authenticator
+
+    @pytest.fixture
+    def token_endpoint(self, authenticator, monkeypatch):
+        """Mock the token endpoint, where each audience answers after the delays in the list (None fails)"""
+        delays = {"eos-service": [0], "slow-service": [0]}
+        requests = []
+
+        async def mock_fetch(req, label, **kwargs):
+            audience = dict(parse.parse_qsl(req.body.decode()))["audience"]
+            requests.append(audience)
+            delay = delays[audience][min(requests.count(audience), len(delays[audience])) - 1]
+            if delay is None:
+                raise HTTPClientError(500)
+            try:
+                await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                cancelled.append(audience)
+                raise
+            return _json_response({"access_token": f"{audience}-token-{requests.count(audience)}"})
+
+        cancelled = []
+        monkeypatch.setattr(authenticator, "fetch", mock_fetch)
+        return SimpleNamespace(delays=delays, requests=requests, cancelled=cancelled)
+
+    async def test_critical_audience_fails(self, authenticator, token_endpoint):
+        token_endpoint.delays["slow-service"] = [None]
+
+        with pytest.raises(HTTPClientError):
+            await authenticator._exchange_tokens("subject")
+
+    async def test_optional_audience_fails(self, authenticator, token_endpoint):
+        authenticator.optional_exchange_tokens = ["slow-service"]
+        token_endpoint.delays["slow-service"] = [None]
+
+        tokens = await authenticator._exchange_tokens("subject")
+
+        assert tokens == {"eos-service": "eos-service-token-1"}
+
+    async def test_optional_audience_times_out(self, authenticator, token_endpoint):
+        authenticator.optional_exchange_tokens = ["slow-service"]
+        authenticator.exchange_token_timeout = 0.05
+        token_endpoint.delays["slow-service"] = [10]
+
+        start = time.time()
+        tokens = await authenticator._exchange_tokens("subject")
+
+        assert time.time() - start < 1
+        assert list(tokens) == ["eos-service"]
+
+    async def test_hedged_request(self, authenticator, token_endpoint):
+        authenticator.exchange_token_hedge_delay = 0.05
+        # The first request hangs, the second one answers immediately
+        token_endpoint.delays["slow-service"] = [10, 0]
+
+        tokens = await authenticator._exchange_tokens("subject")
+
+        assert tokens["slow-service"] == "slow-service-token-2"
+        assert token_endpoint.requests.count("eos-service") == 1
+        # The hedge loser is cancelled, without counting as a failure of the token endpoint
+        await asyncio.sleep(0)
+        assert token_endpoint.cancelled == ["slow-service"]
+        assert authenticator._token_endpoint_breaker.failures == 0
+
+    @pytest.mark.parametrize("hedge_delay", [0, 1])
+    async def test_timeout_cancels_requests(self, authenticator, token_endpoint, hedge_delay):
+        authenticator.optional_exchange_tokens = ["slow-service"]
+        authenticator.exchange_token_timeout = 0.05
+        # Before the second request is sent
+        authenticator.exchange_token_hedge_delay = hedge_delay
+        token_endpoint.delays["slow-service"] = [10]
+
+        await authenticator._exchange_tokens("subject")
+        await asyncio.sleep(0)
+
+        assert token_endpoint.cancelled == ["slow-service"]
+
+    async def test_timeouts_open_the_circuit(self, authenticator, token_endpoint):
+        authenticator.exchange_tokens = ["slow-service"]
+        authenticator.exchange_token_timeout = 0.01
+        token_endpoint.delays["slow-service"] = [10]
+        breaker = authenticator._token_endpoint_breaker
+
+        for _ in range(breaker.failure_threshold):
+            with pytest.raises(TimeoutError):
+                await authenticator._exchange_tokens("subject")
+
+        assert breaker.state == breaker.OPEN
+
+
+async def test_fake_idp_login_and_refresh():
+    """Run the authenticator against the fake IdP, without any mock"""
+    idp = FakeIdP().start()
+    try:
+        authenticator = await configured_authenticator(idp, exchange_tokens=["eos-service"])
+
+        user = await authenticator.authenticate(FakeLoginHandler("alice"))
+        assert user["name"] == "alice"
+        assert user["auth_state"]["roles"] == ["swan-users"]
+        assert jwt.decode(user["auth_state"]["exchanged_tokens"]["eos-service"],
+                          options={"verify_signature": False})["aud"] == "eos-service"
+
+        fake_user = FakeUser("alice", user["auth_state"])
+        refreshed = await authenticator.refresh_user(fake_user)
+        assert refreshed["auth_state"]["access_token"] != user["auth_state"]["access_token"]
+
+        assert idp.requests == {"discovery": 1, "jwks": 1, "token": 3, "userinfo": 1}
+    finally:
+        idp.stop()
+
+
+class TestOidcSnapshot:
+    async def test_saved_and_loaded_at_startup(self, unconfigured_authenticator, monkeypatch, key_pair, tmp_path):
+        public_key, private_key = key_pair
+        snapshot_file = str(tmp_path / "oidc.json")
+
+        async def mock_httpfetch(url, **kwargs):
+            if url.endswith("openid-configuration"):
+                return {**OIDC_DISCOVERY_DOC, "jwks_uri": "http://fake/certs"}
+            jwks = _make_jwks(public_key)
+            jwks["keys"][0]["kid"] = "dummy-key-id"
+            return _json_response(jwks)
+
+        monkeypatch.setattr(unconfigured_authenticator, "httpfetch", mock_httpfetch)
+        unconfigured_authenticator.config.check_signature = True
+        unconfigured_authenticator.oidc_cache_file = snapshot_file
+        await unconfigured_authenticator._get_oidc_configs_helper()
+
+        # After a restart, the authenticator is configured before reaching the IdP
+        authenticator = KeyCloakAuthenticator(oidc_issuer="dummy-oidc-url", oidc_cache_file=snapshot_file,
+                                              client_id="dummy-client-id")
+        authenticator.config.check_signature = True
+
+        assert authenticator.configured
+        assert authenticator.token_url == "http://fake/token"
+        assert authenticator._decode_token(_get_mock_token(private_key, "access"))["jti"] == "access"
+
+    def test_invalid_snapshot_ignored(self, unconfigured_authenticator, tmp_path):
+        snapshot_file = tmp_path / "oidc.json"
+        snapshot_file.write_text("{not json")
+
+        authenticator = KeyCloakAuthenticator(oidc_issuer="http://fake-issuer", oidc_cache_file=str(snapshot_file))
+
+        assert not authenticator.configured
+
+
+class TestAuthStateCache:
+    class CountingUser(FakeUser):
+        reads = 0
+
+        async def get_auth_state(self):
+            self.reads += 1
+            return await super().get_auth_state()
+
+    async def test_decrypted_once_and_copied(self, unconfigured_authenticator):
+        user = self.CountingUser("alice", {"access_token": "token", "exchanged_tokens": {}})
+
+        first = await unconfigured_authenticator.get_user_auth_state(user)
+        first["exchanged_tokens"]["eos-service"] = "modified"
+        second = await unconfigured_authenticator.get_user_auth_state(user)
+
+        assert user.reads == 1
+        assert second["access_token"] == "token"
+        assert second["exchanged_tokens"] == {}
+
+    async def test_expires_after_ttl(self, unconfigured_authenticator, monkeypatch):
+        user = self.CountingUser("alice", {"access_token": "token"})
+        await unconfigured_authenticator.get_user_auth_state(user)
+
+        now = time.time()
+        monkeypatch.setattr(time, "time", lambda: now + unconfigured_authenticator.auth_state_cache_ttl + 1)
+        await unconfigured_authenticator.get_user_auth_state(user)
+
+        assert user.reads == 2
+
+    async def test_updated_on_login(self, unconfigured_authenticator):
+        user = self.CountingUser("alice", {"access_token": "old"})
+        await unconfigured_authenticator.get_user_auth_state(user)
+
+        await unconfigured_authenticator.run_post_auth_hook(None, {"name": "alice", "auth_state": {"access_token": "new"}})
+
+        assert (await unconfigured_authenticator.get_user_auth_state(user))["access_token"] == "new"
+        assert user.reads == 1
+
+    async def test_updated_on_refresh(self):
+        idp = FakeIdP().start()
+        try:
+            authenticator = await configured_authenticator(idp)
+            login = await authenticator.authenticate(FakeLoginHandler("alice"))
+            user = self.CountingUser("alice", login["auth_state"])
+
+            refreshed = await authenticator.refresh_user(user)
+            cached = await authenticator.get_user_auth_state(user)
+
+            assert cached["access_token"] == refreshed["auth_state"]["access_token"] != login["auth_state"]["access_token"]
+            assert user.reads == 1
+        finally:
+            idp.stop()
+
+
+class TestLoginAdmission:
+    async def test_queue_then_reject(self):
+        controller = AdmissionController(max_concurrent=2, max_queue=1, retry_after=7)
+        release = asyncio.Event()
+        waits = []
+
+        async def login():
+            async with controller.admit() as wait_time:
+                waits.append(wait_time)
+                await release.wait()
+
+        running = [asyncio.create_task(login()) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        assert len(waits) == 2
+        assert controller.waiting == 1
+
+        with pytest.raises(AdmissionRejectedError) as e:
+            await login()
+        assert e.value.status_code == 503
+        assert e.value.headers == {"Retry-After": "7"}
+
+        release.set()
+        await asyncio.gather(*running)
+        assert len(waits) == 3
+        assert waits[2] > 0
+        assert controller.waiting == 0
+
+    async def test_disabled(self):
+        controller = AdmissionController(max_concurrent=0, max_queue=0)
+        async with controller.admit() as first, controller.admit() as second:
+            assert first == second == 0
+
+    async def test_authenticate_limited(self, unconfigured_authenticator, monkeypatch):
+        authenticator = unconfigured_authenticator
+        authenticator._login_admission = AdmissionController(max_concurrent=1, max_queue=1)
+        in_progress = 0
+        max_in_progress = 0
+
+        async def mock_authenticate(handler, data=None):
+            nonlocal in_progress, max_in_progress
+            in_progress += 1
+            max_in_progress = max(max_in_progress, in_progress)
+            await asyncio.sleep(0.01)
+            in_progress -= 1
+            return {"name": "user"}
+
+        monkeypatch.setattr(authenticator, "_authenticate", mock_authenticate)
+        results = await asyncio.gather(*(authenticator.authenticate(None) for _ in range(3)), return_exceptions=True)
+
+        assert results[:2] == [{"name": "user"}, {"name": "user"}]
+        assert isinstance(results[2], AdmissionRejectedError)
+        assert max_in_progress == 1
+
+
+@pytest.mark.parametrize("source", ["id_token", "access_token"])
+async def test_user_from_token_claims(source):
+    """The user is built from the verified token, without calling the userinfo endpoint"""
+    idp = FakeIdP().start()
+    try:
+        authenticator = await configured_authenticator(idp, user_claims_source=source)
+
+        user = await authenticator.authenticate(FakeLoginHandler("alice"))
+
+        assert user["name"] == "alice"
+        assert user["auth_state"]["roles"] == ["swan-users"]
+        assert "userinfo" not in idp.requests
+    finally:
+        idp.stop()
+
+
+async def test_user_from_missing_token(unconfigured_authenticator):
+    unconfigured_authenticator.user_claims_source = "id_token"
+    with pytest.raises(web.HTTPError) as e:
+        await unconfigured_authenticator.token_to_user({"access_token": "token"})
+    assert e.value.status_code == 500
+
+
+async def test_on_demand_exchange_tokens():
+    """Audiences needed by the spawn options are only exchanged when such a session is started"""
+    idp = FakeIdP().start()
+    try:
+        authenticator = await configured_authenticator(
+            idp, exchange_tokens=["eos-service"],
+            on_demand_exchange_tokens={"clusters": {"analytix": ["hadoop-service"], "*": ["spark-service"]}})
+
+        login = await authenticator.authenticate(FakeLoginHandler("alice"))
+        assert list(login["auth_state"]["exchanged_tokens"]) == ["eos-service"]
+        user = FakeUser("alice", login["auth_state"])
+
+        await authenticator.pre_spawn_start(user, SimpleNamespace(user_options={"clusters": "none"}))
+        assert list(user.auth_state["exchanged_tokens"]) == ["eos-service"]
+
+        await authenticator.pre_spawn_start(user, SimpleNamespace(user_options={"clusters": "analytix"}))
+        assert list(user.auth_state["exchanged_tokens"]) == ["eos-service", "hadoop-service"]
+        assert jwt.decode(user.auth_state["exchanged_tokens"]["hadoop-service"],
+                          options={"verify_signature": False})["aud"] == "hadoop-service"
+
+        # The on demand tokens of the running session are kept fresh, the other ones are still not exchanged
+        spawner = SimpleNamespace(active=True, user_options={"clusters": "analytix"})
+        user.spawners = {"": spawner}
+        authenticator._exchanged_tokens.clear()
+        refreshed = await authenticator.refresh_user(user)
+        assert list(refreshed["auth_state"]["exchanged_tokens"]) == ["eos-service", "hadoop-service"]
+
+        # No longer renewed once the session is stopped
+        await user.save_auth_state(refreshed["auth_state"])
+        spawner.active = False
+        authenticator._exchanged_tokens.clear()
+        refreshed = await authenticator.refresh_user(user)
+        assert list(refreshed["auth_state"]["exchanged_tokens"]) == ["eos-service"]
+    finally:
+        idp.stop()
+
+
+class TestAuthStateLayout:
+    @pytest.fixture
+    def legacy_auth_state(self, key_pair):
+        _, private_key = key_pair
+        access_token = _get_mock_token(private_key, "access")
+        refresh_token = _get_mock_token(private_key, "refresh")
+        return {
+            "access_token": access_token,
+            "refresh_token": refresh_token,
+            "id_token": _get_mock_token(private_key, "id"),
+            "token_response": {"access_token": access_token, "refresh_token": refresh_token},
+            "scope": ["openid"],
+            "oauth_user": {"preferred_username": "alice"},
+            "roles": ["swan-users"],
+            "exchanged_tokens": {"eos-service": _get_mock_token(private_key, "eos")},
+        }
+
+    def test_legacy_layout_migrated(self, legacy_auth_state):
+        auth_state = read_auth_state(legacy_auth_state)
+
+        assert auth_state["version"] == AUTH_STATE_VERSION
+        assert "token_response" not in auth_state
+        assert auth_state["id_token"] == legacy_auth_state["id_token"]
+        assert auth_state["access_token"] == legacy_auth_state["access_token"]
+        assert auth_state["oauth_user"] == {"preferred_username": "alice"}
+        assert auth_state["expires_at"] == {
+            "access_token": 9999999999,
+            "refresh_token": 9999999999,
+            "exchanged_tokens": {"eos-service": 9999999999},
+        }
+
+    def test_compressed_round_trip(self, legacy_auth_state):
+        auth_state = compact_auth_state(legacy_auth_state)
+        compressed = compress_auth_state(auth_state)
+
+        assert read_auth_state(compressed) == auth_state
+        assert read_auth_state(auth_state) is auth_state
+        assert len(json.dumps(compressed)) < len(json.dumps(auth_state)) < len(json.dumps(legacy_auth_state))
+
+    def test_expiry_not_decoded(self, unconfigured_authenticator, monkeypatch):
+        unconfigured_authenticator.exchange_tokens = ["eos-service"]
+        auth_state = {
+            "version": AUTH_STATE_VERSION,
+            "access_token": "not-a-jwt",
+            "exchanged_tokens": {"eos-service": "not-a-jwt"},
+            "expires_at": {"access_token": 2000, "refresh_token": None, "exchanged_tokens": {"eos-service": 1000}},
+        }
+        monkeypatch.setattr(jwt, "decode", None)
+
+        assert unconfigured_authenticator._tokens_expiry(auth_state) == 1000
+
+    async def test_stored_compressed(self):
+        idp = FakeIdP().start()
+        try:
+            authenticator = await configured_authenticator(idp, compress_auth_state=True, auth_state_cache_ttl=0)
+            login = await authenticator.authenticate(FakeLoginHandler("alice"))
+            auth_model = await authenticator.run_post_auth_hook(None, login)
+            user = FakeUser("alice", auth_model["auth_state"])
+            assert list(user.auth_state) == ["version", "compressed"]
+
+            refreshed = await authenticator.refresh_user(user)
+            assert list(refreshed["auth_state"]) == ["version", "compressed"]
+            user.auth_state = refreshed["auth_state"]
+
+            auth_state = await authenticator.get_user_auth_state(user)
+            assert auth_state["roles"] == ["swan-users"]
+            assert auth_state["expires_at"]["access_token"] > time.time()
+        finally:
+            idp.stop()
+
+
+async def test_refresh_stale_while_revalidate():
+    """While the tokens are valid, refresh_user returns right away and the refresh is stored in the background"""
+    idp = FakeIdP().start()
+    try:
+        authenticator = await configured_authenticator(idp, refresh_stale_while_revalidate=True)
+        login = await authenticator.authenticate(FakeLoginHandler("alice"))
+        user = FakeUser("alice", login["auth_state"])
+        idp.latency = {"token": 0.2}
+
+        start = time.perf_counter()
+        assert await authenticator.refresh_user(user) is True
+        assert time.perf_counter() - start < 0.1
+        assert len(authenticator._revalidations) == 1
+        # A refresh is already in progress, no other one is started
+        assert await authenticator.refresh_user(user) is True
+        assert len(authenticator._revalidations) == 1
+
+        await asyncio.gather(*authenticator._revalidations.values())
+        assert user.auth_state["access_token"] != login["auth_state"]["access_token"]
+
+        # Once the tokens are expired, the request waits for the refresh
+        user.auth_state["expires_at"]["access_token"] = time.time() - 1
+        authenticator._auth_states.clear()
+        refreshed = await authenticator.refresh_user(user)
+        assert refreshed["auth_state"]["access_token"] != user.auth_state["access_token"]
+    finally:
+        idp.stop()
+
+
+async def test_spawn_refreshes_expiring_tokens():
+    """Tokens expiring soon are refreshed before the session starts, concurrently with the on demand exchanges"""
+    idp = FakeIdP(access_token_lifetime=60).start()
+    try:
+        hook_auth_states = []
+
+        def pre_spawn_hook(authenticator, spawner, auth_state):
+            hook_auth_states.append(auth_state)
+
+        authenticator = await configured_authenticator(
+            idp, exchange_tokens=["eos-service"], spawn_token_min_lifetime=30, pre_spawn_hook=pre_spawn_hook,
+            on_demand_exchange_tokens={"clusters": {"analytix": ["hadoop-service"]}})
+        login = await authenticator.authenticate(FakeLoginHandler("alice"))
+        user = FakeUser("alice", login["auth_state"])
+
+        # Valid for long enough, nothing to do
+        await authenticator.pre_spawn_start(user, SimpleNamespace(user_options={}))
+        assert hook_auth_states[-1]["access_token"] == login["auth_state"]["access_token"]
+
+        authenticator.spawn_token_min_lifetime = 120
+        idp.latency = {"token": 0.2}
+        start = time.perf_counter()
+        await authenticator.pre_spawn_start(user, SimpleNamespace(user_options={"clusters": "analytix"}))
+        elapsed = time.perf_counter() - start
+
+        # Refresh and exchange for eos-service, with the exchange for hadoop-service at the same time
+        assert elapsed < 0.55
+        assert hook_auth_states[-1]["access_token"] != login["auth_state"]["access_token"]
+        assert user.auth_state["access_token"] == hook_auth_states[-1]["access_token"]
+        assert list(user.auth_state["exchanged_tokens"]) == ["eos-service", "hadoop-service"]
+        assert user.auth_state["exchanged_tokens"]["eos-service"] != login["auth_state"]["exchanged_tokens"]["eos-service"]
+    finally:
+        idp.stop()
+
+
+class TestSharedCache:
+    @pytest.fixture(params=["memory", "sqlite", "redis"])
+    async def backend(self, request, tmp_path):
+        if request.param == "memory":
+            yield cache_backend("memory")
+        elif request.param == "sqlite":
+            backend = cache_backend(f"sqlite:///{tmp_path}/cache.db")
+            yield backend
+            backend.close()
+        else:
+            server = await FakeRedis(password="secret").start()
+            backend = cache_backend(server.url)
+            yield backend
+            backend.close()
+            await server.stop()
+
+    async def test_backend(self, backend):
+        await backend.set("key", "value", time.time() + 60)
+        await backend.set("expired", "value", time.time() - 1)
+
+        assert await backend.get("key") == "value"
+        assert await backend.get("expired") is None
+        assert await backend.get("missing") is None
+
+        await backend.delete("key")
+        assert await backend.get("key") is None
+
+    async def test_unavailable_backend_is_a_miss(self):
+        server = await FakeRedis().start()
+        await server.stop()
+        shared = SharedCache(cache_backend(server.url), logging.getLogger())
+
+        assert await shared.get("key") is None
+        await shared.set("key", {"value": 1}, time.time() + 60)
+
+    async def test_failed_handshake_closes_connection(self):
+        server = await FakeRedis(password="secret").start()
+        backend = cache_backend(f"redis://:wrong@127.0.0.1:{server.port}/0")
+        try:
+            with pytest.raises(RedisError):
+                await backend.get("key")
+            # Not kept unauthenticated, the next command connects again
+            assert backend._writer is None
+
+            backend.password = "secret"
+            await backend.set("key", "value", time.time() + 60)
+            assert await backend.get("key") == "value"
+            assert server.commands["AUTH"] == 2
+        finally:
+            backend.close()
+            await server.stop()
+
+    @pytest.mark.parametrize("url", ["memory", "sqlite:///shared.db", "redis://:password@localhost:6379/1", ""])
+    def test_url_validation(self, unconfigured_authenticator, url):
+        unconfigured_authenticator.shared_cache_url = url
+
+    def test_invalid_url(self, unconfigured_authenticator):
+        with pytest.raises(TraitError):
+            unconfigured_authenticator.shared_cache_url = "memcached://localhost"
+
+    async def test_hubs_share_keys_and_exchanged_tokens(self):
+        idp = FakeIdP().start()
+        redis = await FakeRedis().start()
+        try:
+            config = dict(exchange_tokens=["eos-service"], shared_cache_url=redis.url)
+            first = await configured_authenticator(idp, **config)
+            login = await first.authenticate(FakeLoginHandler("alice"))
+            assert idp.requests == {"discovery": 1, "jwks": 1, "token": 2, "userinfo": 1}
+
+            # Another hub is configured from the shared cache, and reuses the token exchanged by the first one
+            second = await configured_authenticator(idp, **config)
+            tokens = await second._exchange_tokens(login["auth_state"]["access_token"], username="alice")
+
+            assert tokens == login["auth_state"]["exchanged_tokens"]
+            assert idp.requests == {"discovery": 1, "jwks": 1, "token": 2, "userinfo": 1}
+        finally:
+            idp.stop()
+            await redis.stop()
@@ -0,0 +1,61 @@
+"""
+Verification of JWT signatures in a pool of workers, to keep it off the hub event loop
+"""
+
+import asyncio
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import jwt
+from cryptography.hazmat.primitives import serialization
+
+from .metrics import metric_jwt_verify_duration, metric_jwt_verify_queue_depth
+
+
+def _decode(token, key, kwargs):
+    """Runs in the worker, returns the claims and the time spent decoding"""
+    start = time.perf_counter()
+    decoded_token = jwt.decode(token, key, **kwargs)
+    return decoded_token, time.perf_counter() - start
+
+
+class TokenVerifierPool:
+    """Decodes tokens with jwt.decode in a pool of `workers` threads or processes"""
+
+    def __init__(self, workers, kind='thread'):
+        self.kind = kind
+        if kind == 'process':
+            self._executor = ProcessPoolExecutor(workers)
+        else:
+            self._executor = ThreadPoolExecutor(workers, thread_name_prefix='jwt-verify')
+        self._pem_keys = {}
+        self.pending = 0
+
+    def _worker_key(self, key):
+        if self.kind != 'process' or key is None or isinstance(key, (str, bytes)):
+            return key
+        # Key objects cannot be sent to other processes, send them in PEM format
+        # Key objects are not hashable, index them by id and keep them referenced so that the id is not reused
+        cached = self._pem_keys.get(id(key))
+        if cached is None or cached[0] is not key:
+            if len(self._pem_keys) > 32:
+                # Old keys after rotations
+                self._pem_keys.clear()
+            cached = (key, key.public_bytes(serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo))
+            self._pem_keys[id(key)] = cached
+        return cached[1]
+
+    async def decode(self, token, key, **kwargs):
+        loop = asyncio.get_running_loop()
+        self.pending += 1
+        metric_jwt_verify_queue_depth.set(self.pending)
+        try:
+            decoded_token, duration = await loop.run_in_executor(self._executor, _decode, token, self._worker_key(key), kwargs)
+        finally:
+            self.pending -= 1
+            metric_jwt_verify_queue_depth.set(self.pending)
+        metric_jwt_verify_duration.observe(duration)
+        return decoded_token
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
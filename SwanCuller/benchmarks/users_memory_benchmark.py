@@ -0,0 +1,102 @@
+"""
+Benchmark of the memory held by the users list kept by the culler between two runs.
+
+The culler used to keep the JSON models of all the users, returned at once by the Hub API.
+It now lists the users page by page like list_users, and keeps a UserRecord for each.
+This measures the memory still allocated once done and at the peak (with tracemalloc),
+and the time taken, which for the records includes parsing the times of the users.
+
+Example:
+
+    python SwanCuller/benchmarks/users_memory_benchmark.py --users 50000 --servers 2 --page-size 200
+"""
+import gc
+import json
+import time
+import tracemalloc
+from datetime import UTC, datetime, timedelta
+
+import click
+from swanculler.users import UserRecord
+
+
+def _user_models(n_users, n_servers):
+    """Models of n_users listed by the Hub API, each with n_servers running"""
+    now = datetime.now(UTC)
+    users = []
+    for i in range(n_users):
+        started = (now - timedelta(seconds=i)).isoformat()
+        servers = {
+            f"server{j}" if j else "": {
+                "name": f"server{j}" if j else "",
+                "full_name": f"user{i}/server{j}" if j else f"user{i}/",
+                "last_activity": started,
+                "started": started,
+                "pending": None,
+                "ready": True,
+                "stopped": False,
+                "url": f"/user/user{i}/server{j}/" if j else f"/user/user{i}/",
+                "user_options": {"software_source": "lcg", "lcg": "LCG_107", "platform": "x86_64-el9-gcc13-opt"},
+                "progress_url": f"/hub/api/users/user{i}/server/progress",
+            }
+            for j in range(n_servers)
+        }
+        users.append({
+            "kind": "user",
+            "name": f"user{i}",
+            "admin": False,
+            "roles": ["user"],
+            "groups": [],
+            "server": f"/user/user{i}/",
+            "pending": None,
+            "created": (now - timedelta(days=30)).isoformat(),
+            "last_activity": started,
+            "servers": servers,
+        })
+    return users
+
+
+def _pages(models, page_size):
+    """JSON responses of the Hub API listing the users page by page"""
+    return [json.dumps({"items": models[i:i + page_size]}).encode("utf8") for i in range(0, len(models), page_size)]
+
+
+def _records(pages):
+    """Records of the users, decoding one page at a time as list_users does"""
+    records = []
+    for page in pages:
+        records.extend(UserRecord.from_model(user) for user in json.loads(page.decode("utf8", "replace"))["items"])
+    return records
+
+
+def _measure(name, build):
+    """Memory still allocated by what build returns, and the time it took"""
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = build()
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    click.echo(f"{name:<8} {size / 2**20:>8.1f} MiB held  {peak / 2**20:>8.1f} MiB peak  {elapsed:>6.2f} s")
+    return result
+
+
+@click.command()
+@click.option("--users", "n_users", default=50000, show_default=True, help="Number of users listed")
+@click.option("--servers", "n_servers", default=1, show_default=True, help="Number of running servers per user")
+@click.option("--page-size", default=200, show_default=True, help="Number of users per page of the listing")
+def main(n_users, n_servers, page_size):
+    models = _user_models(n_users, n_servers)
+    body = json.dumps(models).encode("utf8")
+    pages = _pages(models, page_size)
+    del models
+    click.echo(f"{n_users} users with {n_servers} server(s): {len(body) / 2**20:.1f} MiB of JSON")
+
+    _measure("models", lambda: json.loads(body.decode("utf8", "replace")))
+    _measure("records", lambda: _records(pages))
+
+
+if __name__ == "__main__":
+    main()
@@ -32,9 +32,11 @@ users and servers, you should add this script to the services list
 twice, just with different ``name``s, different values, and one with
 the ``--cull-users`` option.
 """
+import asyncio
 import json
 import os
-from datetime import UTC, datetime
+import time
+from datetime import timedelta
 from functools import partial
 
 try:
@@ -42,43 +44,83 @@ try:
 except ImportError:
     from urllib import quote, urlencode
 
-from subprocess import call
-
-import dateutil.parser
-from tornado.gen import coroutine, multi
+from prometheus_client import start_http_server
 from tornado.httpclient import AsyncHTTPClient, HTTPClientError, HTTPRequest
-from tornado.ioloop import IOLoop, PeriodicCallback
-from tornado.locks import Semaphore
 from tornado.log import app_log
 from tornado.options import define, options, parse_command_line
 
+from .cache import TokenCache, VerdictCache
+from .metrics import (
+    metric_blocked_check_cached,
+    metric_blocked_check_requested,
+    metric_ticket_check_duration,
+    metric_ticket_check_failures,
+    metric_ticket_check_users,
+)
+from .retry import RetryingFetch
+from .users import UserRecord
+
 # Global variables
 # The users list is shared between the functions that check for idle
 # sessions and the one that validates wether a user is blocked
+# (unless culling users, only the users with an active server are listed)
 users = []
 
-def check_ticket(username):
-    app_log.info("Checking ticket for user %s", username)
-    call(['sudo', '--preserve-env=SWAN_DEV', "%s/check_ticket.sh" % options.hooks_dir, username])
-# End SWAN code
+# Kept between the blocked user checks: the token of the authorization service,
+# and the users found not blocked (or not found) recently
+service_token = TokenCache()
+blocked_verdicts = VerdictCache()
 
-def parse_date(date_string):
-    """Parse a timestamp
+def ticket_command(hooks_dir, usernames):
+    return ['sudo', '--preserve-env=SWAN_DEV', "%s/check_ticket.sh" % hooks_dir, *usernames]
 
-    If it doesn't have a timezone, assume utc
+async def check_ticket(usernames, hooks_dir, max_duration=60):
+    """Run check_ticket.sh for the users, in a subprocess
 
-    Returned datetime object will always be timezone-aware
+    The script is stopped if it does not finish within max_duration seconds.
+    Failures are logged and counted in the metrics, not raised.
     """
-    dt = dateutil.parser.parse(date_string)
-    if not dt.tzinfo:
-        # assume naïve timestamps are UTC
-        dt = dt.replace(tzinfo=UTC)
-    return dt
-
+    app_log.info("Checking ticket for user(s) %s", ", ".join(usernames))
+    mode = 'batch' if len(usernames) > 1 else 'single'
+    start = time.perf_counter()
+    try:
+        proc = await asyncio.create_subprocess_exec(*ticket_command(hooks_dir, usernames))
+        try:
+            async with asyncio.timeout(max_duration):
+                returncode = await proc.wait()
+        except TimeoutError:
+            app_log.error("Ticket check of user(s) %s timed out after %ss", ", ".join(usernames), max_duration)
+            metric_ticket_check_failures.labels(reason='timeout').inc()
+            await stop_process(proc)
+            return False
+        if returncode:
+            app_log.error("Ticket check of user(s) %s failed with exit code %s", ", ".join(usernames), returncode)
+            metric_ticket_check_failures.labels(reason='exit_code').inc()
+            return False
+        return True
+    except Exception:
+        app_log.exception("Failed to check ticket of user(s) %s", ", ".join(usernames))
+        metric_ticket_check_failures.labels(reason='error').inc()
+        return False
+    finally:
+        metric_ticket_check_duration.labels(mode=mode).observe(time.perf_counter() - start)
+        metric_ticket_check_users.inc(len(usernames))
+
+async def stop_process(proc, grace_period=5):
+    """Terminate a subprocess, killing it if it is still running after grace_period seconds"""
+    # sudo relays SIGTERM to the script, but cannot relay SIGKILL
+    proc.terminate()
+    try:
+        async with asyncio.timeout(grace_period):
+            await proc.wait()
+    except TimeoutError:
+        proc.kill()
+        await proc.wait()
+# End SWAN code
 
 def format_td(td):
     """
-    Nicely format a timedelta object
+    Nicely format a timedelta object (or a number of seconds)
 
     as HH:MM:SS
     """
@@ -86,15 +128,16 @@ def format_td(td):
         return "unknown"
     if isinstance(td, str):
         return td
-    seconds = int(td.total_seconds())
+    if isinstance(td, timedelta):
+        td = td.total_seconds()
+    seconds = int(td)
     h = seconds // 3600
     seconds = seconds % 3600
     m = seconds // 60
     seconds = seconds % 60
     return f"{h:02}:{m:02}:{seconds:02}"
 
-@coroutine
-def delete_server(user_name, server_name, url, auth_header, fetch):
+async def delete_server(user_name, server_name, url, auth_header, fetch):
     if server_name:
         # culling a named server
         delete_url = url + "/users/%s/servers/%s" % (
@@ -105,92 +148,118 @@ def delete_server(user_name, server_name, url, auth_header, fetch):
         delete_url = url + '/users/%s/server' % quote(user_name)
 
     req = HTTPRequest(url=delete_url, method='DELETE', headers=auth_header)
-    resp = yield fetch(req)
+    resp = await fetch(req)
     return resp
 
-@coroutine
-def delete_user(user_name, url, auth_header, fetch):
+async def delete_user(user_name, url, auth_header, fetch):
     req = HTTPRequest(
         url=url + '/users/%s' % user_name, method='DELETE', headers=auth_header
     )
-    resp = yield fetch(req)
+    resp = await fetch(req)
     return resp
 
-@coroutine
-def cull_idle(
-    url, api_token, inactive_limit, cull_users=False, disable_hooks=False, max_age=0, concurrency=10
+async def list_users(url, auth_header, fetch, state=None, page_size=200):
+    """List the users of the Hub, one page at a time
+
+    Yields the user models of each page as soon as it is received, so that they can
+    be handled while the next pages are fetched.
+    state ('ready', 'active' or 'inactive') only lists the users with servers in that state.
+
+    The pages are fetched by offset: users leaving the listed state meanwhile (e.g. because
+    their server was culled) would shift the next pages, and the users moved to the pages
+    already fetched would be missed. Do not delete servers or users until the listing is over.
+    """
+    offset = 0
+    headers = dict(auth_header, Accept='application/jupyterhub-pagination+json')
+    while True:
+        params = {'offset': offset, 'limit': page_size}
+        if state:
+            params['state'] = state
+        req = HTTPRequest(url=url + '/users?' + urlencode(params), headers=headers)
+        resp = await fetch(req)
+        page = json.loads(resp.body.decode('utf8', 'replace'))
+        if isinstance(page, list):
+            # jupyterhub < 2.0 does not paginate, the whole list was returned
+            yield page
+            return
+        yield page['items']
+        next_page = page['_pagination'].get('next')
+        if not next_page:
+            return
+        offset = next_page['offset']
+
+async def cull_idle(
+    url, api_token, inactive_limit, cull_users=False, disable_hooks=False, max_age=0, concurrency=10, page_size=200,
+    workers=50, hooks_dir="/srv/jupyterhub/culler", ticket_concurrency=10, ticket_timeout=60, ticket_batch_size=0,
 ):
     """Shutdown idle single-user servers
 
     If cull_users, inactive *users* will be deleted as well.
+    Otherwise, only the users with an active (ready or pending) server are listed:
+    the pending ones are not culled, but are checked by check_blocked_users.
+
+    The listed users are handled by a fixed number of workers, as they are listed: the next
+    pages are only requested once the workers can take them. The users with servers (or
+    themselves) to cull are handled again once all the users are listed, so that the
+    deletions do not shift the pages of the listing.
+
+    Unless disable_hooks, the tickets of the users with sessions still alive are checked,
+    with at most ticket_concurrency scripts running at the same time. With a ticket_batch_size,
+    the script is called with that many users at once, and stopped after ticket_timeout seconds
+    for each of them.
     """
     auth_header = {'Authorization': 'token %s' % api_token}
-    req = HTTPRequest(url=url + '/users', headers=auth_header)
-    now = datetime.now(UTC)
+    now = time.time()
     client = AsyncHTTPClient()
 
     if concurrency:
-        semaphore = Semaphore(concurrency)
+        semaphore = asyncio.Semaphore(concurrency)
 
-        @coroutine
-        def fetch(req):
+        async def fetch(req):
             """client.fetch wrapped in a semaphore to limit concurrency"""
-            yield semaphore.acquire()
-            try:
-                return (yield client.fetch(req))
-            finally:
-                yield semaphore.release()
+            async with semaphore:
+                return await client.fetch(req)
 
     else:
         fetch = client.fetch
 
-    resp = yield fetch(req)
-
-    global users
-    users = json.loads(resp.body.decode('utf8', 'replace'))
-    futures = []
-
-    @coroutine
-    def handle_server(user, server_name, server, max_age, inactive_limit):
+    async def handle_server(user, server_name, server, max_age, inactive_limit):
         """Handle (maybe) culling a single server
 
-        "server" is the entire server model from the API.
+        "server" is the ServerRecord of the server model from the API.
 
         Returns True if server is now stopped (user removable),
-        False otherwise.
+        False otherwise, and None if it is to be culled once all the users are listed.
         """
-        log_name = user['name']
+        log_name = user.name
         if server_name:
-            log_name = '%s/%s' % (user['name'], server_name)
-        if server.get('pending'):
+            log_name = '%s/%s' % (user.name, server_name)
+        if server.pending:
             app_log.warning(
-                "Not culling server %s with pending %s", log_name, server['pending']
+                "Not culling server %s with pending %s", log_name, server.pending
             )
             return False
 
-        # jupyterhub < 0.9 defined 'server.url' once the server was ready
-        # as an *implicit* signal that the server was ready.
-        # 0.9 adds a dedicated, explicit 'ready' field.
         # By current (0.9) definitions, servers that have no pending
         # events and are not ready shouldn't be in the model,
         # but let's check just to be safe.
 
-        if not server.get('ready', bool(server['url'])):
+        if not server.ready:
             app_log.warning(
-                "Not culling not-ready not-pending server %s: %s", log_name, server
+                "Not culling not-ready not-pending server %s", log_name
             )
             return False
 
-        if server.get('started'):
-            age = now - parse_date(server['started'])
+        if server.started is not None:
+            age = now - server.started
         else:
             # started may be undefined on jupyterhub < 0.9
             age = None
 
         # check last activity
         # last_activity can be None in 0.9
-        if server['last_activity']:
-            inactive = now - parse_date(server['last_activity'])
+        if server.last_activity is not None:
+            inactive = now - server.last_activity
         else:
             # no activity yet, use start date
             # last_activity may be None with jupyterhub 0.9,
@@ -203,37 +272,24 @@ def cull_idle(
         # cull", True means "cull immediately", or, for example, update some
         # other variables like inactive_limit.
         #
-        # Here, server['state'] is the result of the get_state method
-        # on the spawner.  This does *not* contain the below by
-        # default, you may have to modify your spawner to make this
-        # work.  The `user` variable is the user model from the API.
+        # The server state (result of the get_state method on the
+        # spawner) is not requested from the API, and would need to be
+        # added to the ServerRecord.  The `user` variable is the
+        # UserRecord of the user model from the API.
         #
-        # if server['state']['profile_name'] == 'unlimited'
+        # if server.state['profile_name'] == 'unlimited'
         #     return False
-        # inactive_limit = server['state']['culltime']
+        # inactive_limit = server.state['culltime']
 
         should_cull = (
-            inactive is not None and inactive.total_seconds() >= inactive_limit
+            inactive is not None and inactive >= inactive_limit
         )
-        if should_cull:
-            app_log.info(
-                "Culling server %s (inactive for %s)", log_name, format_td(inactive)
-            )
+        # only check started if max_age is specified
+        # so that we can still be compatible with jupyterhub 0.8
+        # which doesn't define the 'started' field
+        too_old = bool(max_age) and not should_cull and age is not None and age >= max_age
 
-        if max_age and not should_cull:
-            # only check started if max_age is specified
-            # so that we can still be compatible with jupyterhub 0.8
-            # which doesn't define the 'started' field
-            if age is not None and age.total_seconds() >= max_age:
-                app_log.info(
-                    "Culling server %s (age: %s, inactive for %s)",
-                    log_name,
-                    format_td(age),
-                    format_td(inactive),
-                )
-                should_cull = True
-
-        if not should_cull:
+        if not should_cull and not too_old:
             app_log.debug(
                 "Not culling server %s (age: %s, inactive for %s)",
                 log_name,
@@ -242,15 +298,30 @@ def cull_idle(
             )
             return False
 
-        resp = yield delete_server(user['name'], server_name, url, auth_header, fetch)
+        if listing:
+            # culled once all the users are listed
+            return None
+
+        if should_cull:
+            app_log.info(
+                "Culling server %s (inactive for %s)", log_name, format_td(inactive)
+            )
+        else:
+            app_log.info(
+                "Culling server %s (age: %s, inactive for %s)",
+                log_name,
+                format_td(age),
+                format_td(inactive),
+            )
+
+        resp = await delete_server(user.name, server_name, url, auth_header, fetch)
         if resp.code == 202:
             app_log.warning("Server %s is slow to stop", log_name)
             # return False to prevent culling user with pending shutdowns
             return False
         return True
 
-    @coroutine
-    def handle_user(user):
+    async def handle_user(user):
         """Handle one user.
 
         Create a list of their servers, and async exec them.  Wait for
@@ -259,27 +330,14 @@ def cull_idle(
         """
         # shutdown servers first.
         # Hub doesn't allow deleting users with running servers.
-        # jupyterhub 0.9 always provides a 'servers' model.
-        # 0.8 only does this when named servers are enabled.
-        if 'servers' in user:
-            servers = user['servers']
-        else:
-            # jupyterhub < 0.9 without named servers enabled.
-            # create servers dict with one entry for the default server
-            # from the user model.
-            # only if the server is running.
-            servers = {}
-            if user['server']:
-                servers[''] = {
-                    'last_activity': user['last_activity'],
-                    'pending': user['pending'],
-                    'url': user['server'],
-                }
         server_futures = [
             handle_server(user, server_name, server, max_age, inactive_limit)
-            for server_name, server in servers.items()
+            for server_name, server in user.servers.items()
         ]
-        results = yield multi(server_futures)
+        results = await asyncio.gather(*server_futures)
+        if None in results:
+            # handled again once all the users are listed
+            return None
 
         # some servers are still running, cannot cull users
         still_alive = len(results) - sum(results)
@@ -292,22 +350,22 @@ def cull_idle(
         if still_alive:
             app_log.debug(
                 "Not culling user %s with %i servers still alive",
-                user['name'],
+                user.name,
                 still_alive,
             )
             return False
 
         should_cull = False
-        if user.get('created'):
-            age = now - parse_date(user['created'])
+        if user.created is not None:
+            age = now - user.created
         else:
             # created may be undefined on jupyterhub < 0.9
             age = None
 
         # check last activity
         # last_activity can be None in 0.9
-        if user['last_activity']:
-            inactive = now - parse_date(user['last_activity'])
+        if user.last_activity is not None:
+            inactive = now - user.last_activity
         else:
             # no activity yet, use start date
             # last_activity may be None with jupyterhub 0.9,
@@ -315,55 +373,137 @@ def cull_idle(
             inactive = age
 
         should_cull = (
-            inactive is not None and inactive.total_seconds() >= inactive_limit
+            inactive is not None and inactive >= inactive_limit
         )
-        if should_cull:
-            app_log.info("Culling user %s (inactive for %s)", user['name'], inactive)
-
-        if max_age and not should_cull:
-            # only check created if max_age is specified
-            # so that we can still be compatible with jupyterhub 0.8
-            # which doesn't define the 'started' field
-            if age is not None and age.total_seconds() >= max_age:
-                app_log.info(
-                    "Culling user %s (age: %s, inactive for %s)",
-                    user['name'],
-                    format_td(age),
-                    format_td(inactive),
-                )
-                should_cull = True
-
-        if not should_cull:
+        # only check created if max_age is specified
+        # so that we can still be compatible with jupyterhub 0.8
+        # which doesn't define the 'started' field
+        too_old = bool(max_age) and not should_cull and age is not None and age >= max_age
+
+        if not should_cull and not too_old:
             app_log.debug(
                 "Not culling user %s (created: %s, last active: %s)",
-                user['name'],
+                user.name,
                 format_td(age),
                 format_td(inactive),
             )
             return False
 
-        yield delete_user(user['name'], url, auth_header, fetch)
-        return True
-
-    for user in users:
-        futures.append((user['name'], handle_user(user)))
+        if listing:
+            # culled once all the users are listed
+            return None
 
-    for (name, f) in futures:
-        try:
-            result = yield f
-        except Exception:
-            app_log.exception("Error processing %s", name)
+        if should_cull:
+            app_log.info("Culling user %s (inactive for %s)", user.name, format_td(inactive))
         else:
-            if result:
-                app_log.debug("Finished culling %s", name)
+            app_log.info(
+                "Culling user %s (age: %s, inactive for %s)",
+                user.name,
+                format_td(age),
+                format_td(inactive),
+            )
+
+        await delete_user(user.name, url, auth_header, fetch)
+        return True
+
+    ticket_semaphore = asyncio.Semaphore(ticket_concurrency)
+    ticket_batch = []
+
+    async def renew_tickets(usernames):
+        async with ticket_semaphore:
+            # the script checks the users of a batch one after the other
+            await check_ticket(usernames, hooks_dir, ticket_timeout * len(usernames))
+
+    async def handle_ticket(user_name):
+        """Check the ticket of the user, or add them to the batch (checked once full)"""
+        if not ticket_batch_size:
+            await renew_tickets([user_name])
+            return
+        ticket_batch.append(user_name)
+        if len(ticket_batch) >= ticket_batch_size:
+            batch = ticket_batch.copy()
+            ticket_batch.clear()
+            await renew_tickets(batch)
+
+    async def worker(queue):
+        """Handle the users put in the queue, until None"""
+        while (user := await queue.get()) is not None:
+            try:
+                result = await handle_user(user)
+            except Exception:
+                app_log.exception("Error processing %s", user.name)
             else:
-                if not disable_hooks: check_ticket(name)
+                if result is None:
+                    deferred.append(user)
+                elif result:
+                    app_log.debug("Finished culling %s", user.name)
+                else:
+                    if not disable_hooks: await handle_ticket(user.name)
+
+    async def run_workers(fill):
+        """Handle the users that fill puts in the queue, the next ones wait when all the workers are busy"""
+        queue = asyncio.Queue(maxsize=workers)
+        worker_tasks = [asyncio.create_task(worker(queue)) for _ in range(max(workers, 1))]
+        try:
+            await fill(queue)
+        finally:
+            for _ in worker_tasks:
+                await queue.put(None)
+            await asyncio.gather(*worker_tasks)
+
+    async def put_listed(queue):
+        async for page in list_users(
+            url, auth_header, fetch, state=None if cull_users else 'active', page_size=page_size
+        ):
+            records = [UserRecord.from_model(user) for user in page]
+            listed.extend(records)
+            for user in records:
+                await queue.put(user)
+
+    async def put_deferred(queue):
+        for user in deferred:
+            await queue.put(user)
 
-@coroutine
-def check_blocked_users(url, api_token, client_id, client_secret, auth_url, audience, authz_api_url):
+    global users
+    listed = []
+    # the users with servers (or themselves) to cull, handled again once all the users are listed:
+    # deleting them meanwhile would shift the next pages of the listing
+    deferred = []
+    listing = True
+    try:
+        await run_workers(put_listed)
+    except Exception:
+        app_log.exception("Failed to list users")
+    else:
+        users = listed
+    listing = False
+    await run_workers(put_deferred)
+
+    if ticket_batch:
+        await renew_tickets(ticket_batch)
+
+async def check_blocked_users(
+    url, api_token, client_id, client_secret, auth_url, audience, authz_api_url, concurrency=10, retries=3,
+    verdict_ttl=0, not_found_ttl=0,
+):
     """Detect blocked users.
 
     Detect blocked users and cull their servers.
+
+    Only the users listed by the last cull_idle are checked: unless it culls users too,
+    these are the users with an active server, so blocked users without any server are
+    not deleted (they cannot start one anyway).
+
+    The users are checked by concurrency workers, which also delete the servers of the blocked ones.
+    The requests are retried up to retries times when rate limited or failing temporarily.
+    concurrency and the pauses requested by a rate limited service apply to each service
+    (the token endpoint, the authorization service and the Hub) separately.
+
+    Users found not blocked are not checked again for verdict_ttl seconds,
+    and users not found in the authorization service for not_found_ttl seconds.
+
+    If the authorization service rejects the token (401), a new one is requested once,
+    and the check stops if it is rejected too.
     """
     # Step 1: Get Token for Authorization Service APIs (no Token Exchange permissions - too powerful)
     token_req = HTTPRequest(
@@ -375,80 +515,153 @@ def check_blocked_users(url, api_token, client_id, client_secret, auth_url, audi
     )
 
     client = AsyncHTTPClient()
+    # one for each service, so that a service asking to slow down does not pause the requests to the others
+    token_fetch = RetryingFetch(client, concurrency=concurrency, retries=retries)
+    authz_fetch = RetryingFetch(client, concurrency=concurrency, retries=retries)
+    hub_fetch = RetryingFetch(client, concurrency=concurrency, retries=retries)
+    token_key = (auth_url, client_id, audience)
+
+    async def request_token():
+        """A new token for the authorization service (None if it could not be obtained)"""
+        try:
+            token_resp = await token_fetch(token_req)
+            token_data = json.loads(token_resp.body.decode("utf-8"))
+            token = token_data["access_token"]
+        except Exception:
+            app_log.exception("Failed to get access token for blocked user check")
+            return None
+        service_token.set(token_key, token, token_data.get("expires_in"))
+        return token
 
-    try:
-        token_resp = yield client.fetch(token_req)
-        token_data = json.loads(token_resp.body.decode("utf-8"))
-        access_token = token_data["access_token"]
-    except Exception:
-        app_log.exception("Failed to get access token for blocked user check")
+    access_token = service_token.get(token_key) or await request_token()
+    if access_token is None:
         return
 
-    # Step 2: Check each user - Get their identity from the Authorization Service API using the obtained token as Bearer
-    for user in users:
-        app_log.info("Checking if user %s is blocked", user['name'])
-        query = urlencode([("field", "uniqueIdentifier"), ("field", "blocked"), ("field", "disabled")])
-        id_url = f"{authz_api_url}/{quote(user['name'])}/accounts?{query}"
-        id_req = HTTPRequest(
-            url=id_url,
-            headers={
-                "Authorization": "Bearer %s" % access_token,
-                "Accept": "*/*",
-            }
-        )
+    # a token rejected by the authorization service (revoked, or expired before its time) is
+    # replaced once, the check stops if the new one is rejected too
+    token_lock = asyncio.Lock()
+    token_renewed = False
+    stopped = False
+
+    async def renew_token(rejected_token):
+        """Replace the token rejected with a 401, False if the check should stop"""
+        nonlocal access_token, token_renewed, stopped
+        async with token_lock:
+            if stopped:
+                return False
+            if access_token != rejected_token:
+                # already replaced for another user
+                return True
+            service_token.clear()
+            new_token = None if token_renewed else await request_token()
+            if new_token is None:
+                app_log.error("No token accepted by the authorization service, stopping the blocked user check")
+                stopped = True
+                return False
+            access_token = new_token
+            token_renewed = True
+            return True
 
+    auth_header = {'Authorization': 'token %s' % api_token}
+    query = urlencode([("field", "uniqueIdentifier"), ("field", "blocked"), ("field", "disabled")])
+
+    async def fetch_identity(user):
+        """Accounts of the user, requested again with a new token if the one used is rejected"""
+        for retry in (True, False):
+            token = access_token
+            id_req = HTTPRequest(
+                url=f"{authz_api_url}/{quote(user.name)}/accounts?{query}",
+                headers={
+                    "Authorization": "Bearer %s" % token,
+                    "Accept": "*/*",
+                }
+            )
+            try:
+                return await authz_fetch(id_req)
+            except HTTPClientError as e:
+                if not retry or e.code != 401 or not await renew_token(token):
+                    raise
+
+    async def is_blocked(user):
+        """Whether the user is blocked or disabled (None if unknown)"""
+        app_log.info("Checking if user %s is blocked", user.name)
         try:
-            id_resp = yield client.fetch(id_req)
-            data = json.loads(id_resp.body.decode("utf-8")).get("data", [])
-            if not data:
-                app_log.warning(f"No identity data returned for user {user['name']}")
-                continue
-            is_blocked = data[0].get("blocked", False)
-            is_disabled = data[0].get("disabled", False)
+            id_resp = await fetch_identity(user)
         except HTTPClientError as e:
             if e.code == 404:
-                app_log.info(f"User {user['name']} not found for blocked user check, skipping.")
-                continue
+                app_log.info(f"User {user.name} not found for blocked user check, skipping.")
+                blocked_verdicts.add(user.name, not_found_ttl)
             else:
-                app_log.warning(f"Failed to check identity for {user['name']}: {e}")
+                app_log.warning(f"Failed to check identity for {user.name}: {e}")
+            return None
+        data = json.loads(id_resp.body.decode("utf-8")).get("data", [])
+        if not data:
+            app_log.warning(f"No identity data returned for user {user.name}")
+            return None
+        blocked = data[0].get("blocked", False) or data[0].get("disabled", False)
+        if not blocked:
+            blocked_verdicts.add(user.name, verdict_ttl)
+        return blocked
+
+    async def cull_blocked(user):
+        app_log.warning("User %s is blocked. Terminating their sessions.", user.name)
+        servers = user.servers
+        delete_futures = []
+        for server_name in servers:
+            delete_futures.append(
+                delete_server(user.name, server_name, url, auth_header, hub_fetch)
+            )
+        # wait for all delete requests to complete
+        results = await asyncio.gather(*delete_futures, return_exceptions=True)
+
+        for server_name, resp in zip(servers, results, strict=True):
+            if isinstance(resp, Exception):
+                app_log.error("Failed to delete server %s for user %s: %s", server_name, user.name, resp)
+            elif resp.code in (204, 202):
+                app_log.info("Deleted server '%s' for user %s", server_name, user.name)
+            else:
+                app_log.warning("Unexpected response deleting server %s for user %s: %s",
+                                server_name, user.name, resp.code)
+
+        await delete_user(user.name, url, auth_header, hub_fetch)
+
+    async def worker(users_iter):
+        # the workers share the iterator, each user is handled by one of them
+        for user in users_iter:
+            if stopped:
+                return
+            if blocked_verdicts.is_fresh(user.name):
+                metric_blocked_check_cached.inc()
                 continue
+            metric_blocked_check_requested.inc()
+            try:
+                if await is_blocked(user):
+                    await cull_blocked(user)
+            except Exception:
+                app_log.exception("Error checking if user %s is blocked", user.name)
 
-        if is_blocked or is_disabled:
-            app_log.warning("User %s is blocked. Terminating their sessions.", user['name'])
-            auth_header = {'Authorization': 'token %s' % api_token}
+    # Step 2: Check each user - Get their identity from the Authorization Service API using the obtained token as Bearer
+    # (only the new users, and the ones whose verdict is stale)
+    blocked_verdicts.purge()
+    users_iter = iter(users)
+    await asyncio.gather(*(worker(users_iter) for _ in range(max(concurrency, 1))))
 
-            # collect user's server
-            if 'servers' in user:
-                servers = user['servers']
-            else:
-                servers = {}
-                if user.get('server'):
-                    servers[''] = {
-                        'last_activity': user.get('last_activity'),
-                        'pending': user.get('pending'),
-                        'url': user['server'],
-                    }
-
-            delete_futures = []
-            for server_name in servers:
-                delete_futures.append(
-                    delete_server(user['name'], server_name, url, auth_header, client.fetch)
-                )
-            # wait for all delete requests to complete
-            results = yield multi(delete_futures)
-
-            for i, server_name in enumerate(servers):
-                try:
-                    resp = results[i]
-                    if resp.code in (204, 202):
-                        app_log.info("Deleted server '%s' for user %s", server_name, user['name'])
-                    else:
-                        app_log.warning("Unexpected response deleting server %s for user %s: %s",
-                                        server_name, user['name'], resp.code)
-                except Exception:
-                    app_log.exception("Failed to delete server %s for user %s", server_name, user['name'])
-
-            yield delete_user(user['name'], url, auth_header, client.fetch)
+async def run_every(interval, func):
+    """Call func now, then every interval seconds (only once if interval is 0)
+
+    Like tornado's PeriodicCallback, a call taking longer than interval skips the next ones.
+    """
+    loop = asyncio.get_running_loop()
+    next_time = loop.time()
+    while True:
+        try:
+            await func()
+        except Exception:
+            app_log.exception("Error running %s", getattr(func, 'func', func).__name__)
+        if not interval:
+            return
+        next_time += interval * ((loop.time() - next_time) // interval + 1)
+        await asyncio.sleep(next_time - loop.time())
 
 def main():
     define(
@@ -482,14 +695,56 @@ def main():
                 so limit the number of API requests we have outstanding at any given time.
                 """,
     )
+    define(
+        'page_size',
+        default=200,
+        help="Number of users requested per page when listing the users of the Hub, at most JupyterHub.api_page_max_limit (default: 200)",
+    )
+    define(
+        'workers',
+        default=50,
+        help="Number of users handled at the same time while culling, as they are listed: the next pages are only requested once the workers can take them, and the servers and users to cull are only deleted once all the users are listed",
+    )
     define('hooks_dir', default="/srv/jupyterhub/culler", help="Path to the directory for the krb tickets script (check_ticket.sh)")
     define('disable_hooks', default=False, help="The user's home is a temporary scratch directory and we should not check krb tickets")
+    define('ticket_concurrency', default=10, help="Maximum number of krb tickets scripts running at the same time")
+    define(
+        'ticket_timeout',
+        default=60,
+        help="Time (in seconds) after which a krb tickets script is stopped, for each of the users passed to it",
+    )
+    define(
+        'ticket_batch_size',
+        default=0,
+        help="Number of users passed to each call of the krb tickets script, which must then accept several usernames (if 0, the script is called for each user)",
+    )
+    define('metrics_port', default=0, help="Port serving the prometheus metrics of the culler (disabled if 0)")
     define('auth_url', default='', help="URL to fetch CERN access token")
     define('auth_client_id', default=os.environ.get('AUTH_CLIENT_ID'), help="Client ID for blocked user check")
     define('auth_client_secret', default=os.environ.get('AUTH_CLIENT_SECRET'), help="Client secret for blocked user check")
     define('audience', default='', help="Audience for CERN access token")
     define('auth_check_interval', default=0, help="The interval (in seconds) for checking blocked users")
     define('authz_api_url', default='', help="URL to fetch user identity from authorization service")
+    define(
+        'auth_check_concurrency',
+        default=10,
+        help="Limit the number of concurrent requests of the blocked user check, to each of the authorization service and the Hub",
+    )
+    define(
+        'auth_check_retries',
+        default=3,
+        help="Number of retries of the requests of the blocked user check that are rate limited or fail temporarily",
+    )
+    define(
+        'auth_check_verdict_ttl',
+        default=0,
+        help="Time (in seconds) during which a user found not blocked is not checked again, so a user blocked meanwhile is detected up to this much later (if 0, all the users are checked every time)",
+    )
+    define(
+        'auth_check_not_found_ttl',
+        default=0,
+        help="Time (in seconds) during which a user not found by the authorization service is not checked again",
+    )
 
 
     parse_command_line()
@@ -497,6 +752,9 @@ def main():
         options.cull_every = options.timeout // 2
     api_token = os.environ['JUPYTERHUB_API_TOKEN']
 
+    if options.metrics_port:
+        start_http_server(options.metrics_port)
+
     try:
         AsyncHTTPClient.configure("tornado.curl_httpclient.CurlAsyncHTTPClient")
     except ImportError as e:
@@ -506,7 +764,6 @@ def main():
             e,
         )
 
-    loop = IOLoop.current()
     cull = partial(
         cull_idle,
         url=options.url,
@@ -514,16 +771,15 @@ def main():
         inactive_limit=options.timeout,
         cull_users=options.cull_users,
         disable_hooks=options.disable_hooks,
+        hooks_dir=options.hooks_dir,
+        ticket_concurrency=options.ticket_concurrency,
+        ticket_timeout=options.ticket_timeout,
+        ticket_batch_size=options.ticket_batch_size,
         max_age=options.max_age,
         concurrency=options.concurrency,
+        page_size=options.page_size,
+        workers=options.workers,
     )
-    # schedule first cull immediately
-    # because PeriodicCallback doesn't start until the end of the first interval
-    loop.add_callback(cull)
-    # schedule periodic cull
-    pc = PeriodicCallback(cull, 1e3 * options.cull_every)
-    pc.start()
-
     blocked_check = partial(
         check_blocked_users,
         url=options.url,
@@ -533,14 +789,20 @@ def main():
         client_secret=options.auth_client_secret,
         audience = options.audience,
         authz_api_url=options.authz_api_url,
+        concurrency=options.auth_check_concurrency,
+        retries=options.auth_check_retries,
+        verdict_ttl=options.auth_check_verdict_ttl,
+        not_found_ttl=options.auth_check_not_found_ttl,
     )
-    # schedule first blocked user check
-    loop.add_callback(blocked_check)
-    # schedule periodic blocked user check
-    pc_blocked = PeriodicCallback(blocked_check, 1e3 * options.auth_check_interval)
-    pc_blocked.start()
+
+    async def run():
+        # the first cull and blocked user check run immediately, then periodically
+        await asyncio.gather(
+            run_every(options.cull_every, cull),
+            run_every(options.auth_check_interval, blocked_check),
+        )
 
     try:
-        loop.start()
+        asyncio.run(run())
     except KeyboardInterrupt:
         pass
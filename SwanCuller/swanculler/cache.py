@@ -0,0 +1,61 @@
+"""Caches kept between the runs of the blocked user check"""
+import random
+import time
+
+
+class TokenCache:
+    """Access token of the authorization service, kept until margin seconds before it expires"""
+
+    def __init__(self, margin=60):
+        self.margin = margin
+        self.clear()
+
+    def get(self, key):
+        """The token for key (e.g. the token url, client and audience), None if missing or expiring"""
+        if key == self._key and time.monotonic() < self._expires_at:
+            return self._token
+        return None
+
+    def set(self, key, token, expires_in):
+        if not expires_in:
+            # unknown lifetime, a new one is requested next time
+            return
+        self._key = key
+        self._token = token
+        # short-lived tokens are kept for at least half of their lifetime
+        self._expires_at = time.monotonic() + expires_in - min(self.margin, expires_in / 2)
+
+    def clear(self):
+        self._key = None
+        self._token = None
+        self._expires_at = 0
+
+
+class VerdictCache:
+    """
+    Users checked as not blocked (or not found), until their verdict is stale.
+
+    The time-to-live of each verdict is shortened by up to 10%, so that the users checked
+    in the same run are not all checked again in the same later run.
+    """
+
+    def __init__(self):
+        self._expires_at = {}
+
+    def __len__(self):
+        return len(self._expires_at)
+
+    def is_fresh(self, name):
+        return self._expires_at.get(name, 0) > time.monotonic()
+
+    def add(self, name, ttl):
+        if ttl > 0:
+            self._expires_at[name] = time.monotonic() + ttl * random.uniform(0.9, 1)
+
+    def purge(self):
+        """Forget the stale verdicts, e.g. of the users gone since"""
+        now = time.monotonic()
+        self._expires_at = {name: expires_at for name, expires_at in self._expires_at.items() if expires_at > now}
+
+    def clear(self):
+        self._expires_at.clear()
@@ -0,0 +1,56 @@
+"""
+Defines prometheus metrics of the SwanCuller
+
+These metrics are served on the metrics_port of the culler, when set
+"""
+
+from prometheus_client import Counter, Histogram
+
+# The scripts renewing the tickets can take a few seconds each
+_buckets = (
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    20.0,
+    30.0,
+    60.0,
+    120.0,
+    float("inf"),
+)
+
+
+_TICKET_CHECK_DURATION_SECONDS = Histogram(
+    "swan_culler_ticket_check_duration_seconds",
+    "Histogram of durations of the check_ticket.sh invocations, for one user (single) or several (batch)",
+    labelnames=["mode"],
+    buckets=_buckets,
+)
+
+_TICKET_CHECK_USERS = Counter(
+    "swan_culler_ticket_check_users_total",
+    "Number of users whose ticket was checked",
+)
+
+_TICKET_CHECK_FAILURES = Counter(
+    "swan_culler_ticket_check_failures_total",
+    "Number of check_ticket.sh invocations that failed, by reason (timeout, exit_code, error)",
+    labelnames=["reason"],
+)
+
+_BLOCKED_CHECK_LOOKUPS = Counter(
+    "swan_culler_blocked_check_lookups_total",
+    "Number of users of the blocked user check, requested from the authorization service or with a cached verdict",
+    labelnames=["result"],
+)
+
+
+metric_ticket_check_duration = _TICKET_CHECK_DURATION_SECONDS # Label 'mode' set dynamically
+metric_ticket_check_users = _TICKET_CHECK_USERS
+metric_ticket_check_failures = _TICKET_CHECK_FAILURES # Label 'reason' set dynamically
+
+metric_blocked_check_cached = _BLOCKED_CHECK_LOOKUPS.labels("cached")
+metric_blocked_check_requested = _BLOCKED_CHECK_LOOKUPS.labels("requested")
@@ -0,0 +1,80 @@
+"""Requests limited in concurrency, retried when rate limited or failing temporarily"""
+import asyncio
+import random
+import time
+from email.utils import parsedate_to_datetime
+
+from tornado.httpclient import HTTPClientError
+from tornado.log import app_log
+
+# Rate limited, or failing temporarily (599: timeout or connection error)
+RETRY_CODES = (429, 502, 503, 504, 599)
+
+
+def retry_after(error):
+    """Seconds to wait requested by the Retry-After header of the error response (None if not set)"""
+    response = getattr(error, 'response', None)
+    value = response.headers.get('Retry-After') if response is not None and response.headers else None
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryingFetch:
+    """
+    client.fetch wrapped in a semaphore to limit concurrency, retrying the requests failing with RETRY_CODES.
+
+    The delay before retrying is the one requested by the server (Retry-After), or an exponential backoff
+    with jitter. A rate limited response (429, or any with Retry-After) pauses all the requests until then,
+    since the next ones would be rejected as well. A request is not retried if the server asks to wait
+    more than max_delay seconds.
+    """
+
+    def __init__(self, client, concurrency=10, retries=3, backoff=1.0, max_delay=60):
+        self.client = client
+        self.retries = retries
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self._semaphore = asyncio.Semaphore(concurrency) if concurrency else None
+        self._paused_until = 0
+
+    def _retry_delay(self, error, attempt):
+        """Seconds to wait before retrying the request, or None if it should not be retried"""
+        if attempt >= self.retries or error.code not in RETRY_CODES:
+            return None
+        delay = retry_after(error)
+        if delay is not None:
+            return delay if delay <= self.max_delay else None
+        return min(self.backoff * 2 ** attempt, self.max_delay) * random.uniform(0.5, 1)
+
+    async def _fetch(self, req):
+        # wait for the end of a pause requested by the server
+        pause = self._paused_until - time.monotonic()
+        if pause > 0:
+            await asyncio.sleep(pause)
+        return await self.client.fetch(req)
+
+    async def __call__(self, req):
+        attempt = 0
+        while True:
+            try:
+                if self._semaphore is None:
+                    return await self._fetch(req)
+                async with self._semaphore:
+                    return await self._fetch(req)
+            except HTTPClientError as e:
+                delay = self._retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                if e.code == 429 or retry_after(e) is not None:
+                    self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                app_log.warning("Request to %s failed (%s), retrying in %.1fs", req.url, e, delay)
+            attempt += 1
+            await asyncio.sleep(delay)
@@ -0,0 +1,98 @@
+"""Compact records of the users listed from the Hub API
+
+Between two runs the culler keeps the users it listed (for the blocked users check),
+so only what the culling needs is kept from the JSON models: the names, the flags of the
+servers and their times, parsed once to epoch seconds.
+"""
+from datetime import UTC, datetime
+
+import dateutil.parser
+
+
+def parse_date(date_string):
+    """Parse a timestamp
+
+    If it doesn't have a timezone, assume utc
+
+    Returned datetime object will always be timezone-aware
+    """
+    try:
+        # the Hub API returns ISO 8601 timestamps, much faster to parse this way
+        dt = datetime.fromisoformat(date_string)
+    except ValueError:
+        dt = dateutil.parser.parse(date_string)
+    if not dt.tzinfo:
+        # assume naïve timestamps are UTC
+        dt = dt.replace(tzinfo=UTC)
+    return dt
+
+
+def parse_epoch(date_string):
+    """Parse a timestamp to seconds since the epoch (None if not set)"""
+    if not date_string:
+        return None
+    return parse_date(date_string).timestamp()
+
+
+class ServerRecord:
+    """A server of a user: its pending action, whether it is ready, and when it started and was last active"""
+
+    __slots__ = ('last_activity', 'pending', 'ready', 'started')
+
+    def __init__(self, started=None, last_activity=None, pending=None, ready=False):
+        self.started = started
+        self.last_activity = last_activity
+        self.pending = pending
+        self.ready = ready
+
+    @classmethod
+    def from_model(cls, server):
+        # jupyterhub < 0.9 defined 'server.url' once the server was ready
+        # as an *implicit* signal that the server was ready.
+        # 0.9 adds a dedicated, explicit 'ready' field.
+        return cls(
+            started=parse_epoch(server.get('started')),
+            last_activity=parse_epoch(server.get('last_activity')),
+            pending=server.get('pending'),
+            ready=bool(server.get('ready', bool(server.get('url')))),
+        )
+
+
+class UserRecord:
+    """A user of the Hub, with their servers by name ('' for the default one)"""
+
+    __slots__ = ('created', 'last_activity', 'name', 'servers')
+
+    def __init__(self, name, servers=None, created=None, last_activity=None):
+        self.name = name
+        self.servers = servers or {}
+        self.created = created
+        self.last_activity = last_activity
+
+    @classmethod
+    def from_model(cls, user):
+        # jupyterhub 0.9 always provides a 'servers' model.
+        # 0.8 only does this when named servers are enabled.
+        if 'servers' in user:
+            servers = {
+                server_name: ServerRecord.from_model(server)
+                for server_name, server in user['servers'].items()
+            }
+        else:
+            # jupyterhub < 0.9 without named servers enabled.
+            # create servers dict with one entry for the default server
+            # from the user model.
+            # only if the server is running.
+            servers = {}
+            if user.get('server'):
+                servers[''] = ServerRecord.from_model({
+                    'last_activity': user.get('last_activity'),
+                    'pending': user.get('pending'),
+                    'url': user['server'],
+                })
+        return cls(
+            user['name'],
+            servers=servers,
+            created=parse_epoch(user.get('created')),
+            last_activity=parse_epoch(user.get('last_activity')),
+        )
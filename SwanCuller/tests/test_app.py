@@ -1,28 +1,60 @@
+import asyncio
 import json
-from datetime import UTC, datetime
+import time
+from datetime import UTC, datetime, timedelta
+from inspect import isawaitable
+from urllib.parse import parse_qs, urlparse
 
 import pytest
+from prometheus_client import REGISTRY
 from swanculler import app
-from swanculler.app import check_blocked_users
+from swanculler.app import check_blocked_users, check_ticket, cull_idle
+from swanculler.cache import TokenCache
+from swanculler.retry import RetryingFetch, retry_after
+from swanculler.users import ServerRecord, UserRecord
+from tornado.httpclient import HTTPClientError
 
 # ---------------------------------------------------------------------------
 # Helpers
 # ---------------------------------------------------------------------------
 
-def make_user(name):
-    now = datetime.now(UTC).isoformat()
+def make_user(name, inactive=0):
+    now = datetime.now(UTC)
     return {
         "name": name,
         "servers": {'': {
-            "last_activity": now,
+            "last_activity": (now - timedelta(seconds=inactive)).isoformat(),
+            "started": (now - timedelta(seconds=inactive)).isoformat(),
+            "pending": None,
+            "ready": True,
+            "url": f"/user/{name}/",
         }},
     }
 
 
+def paginated_users(users):
+    """Handler of the /users requests of the Hub API, paginated like jupyterhub >= 2.0"""
+    def handler(req):
+        params = {key: values[0] for key, values in parse_qs(urlparse(req.url).query).items()}
+        offset, limit = int(params["offset"]), int(params["limit"])
+        end = offset + limit
+        return MockHTTPResponse(200, json.dumps({
+            "items": users[offset:end],
+            "_pagination": {
+                "offset": offset,
+                "limit": limit,
+                "total": len(users),
+                "next": {"offset": end, "limit": limit} if end < len(users) else None,
+            },
+        }).encode())
+    return handler
+
+
 class MockHTTPResponse:
-    def __init__(self, code=200, body=b""):
+    def __init__(self, code=200, body=b"", headers=None):
         self.code = code
         self.body = body
+        self.headers = headers or {}
 
 
 class MockHTTPClient:
@@ -32,13 +64,19 @@ class MockHTTPClient:
 
     async def fetch(self, req, **kwargs):
         self.calls.append(req)
-        return self._handler(req)
+        resp = self._handler(req)
+        if isawaitable(resp):
+            resp = await resp
+        if resp.code >= 400:
+            raise HTTPClientError(resp.code, response=resp)
+        return resp
 
 
-def _token_ok():
-    return MockHTTPResponse(
-        200, json.dumps({"access_token": "mock-token"}).encode()
-    )
+def _token_ok(expires_in=None):
+    token = {"access_token": "mock-token"}
+    if expires_in:
+        token["expires_in"] = expires_in
+    return MockHTTPResponse(200, json.dumps(token).encode())
 
 
 def _identity(blocked=False, disabled=False):
@@ -62,10 +100,14 @@ AUDIENCE = "aud"
 
 @pytest.fixture(autouse=True)
 def _reset_global_users():
-    """Reset the global users list between tests."""
+    """Reset the global users list and the caches of the blocked user check between tests."""
     app.users = []
+    app.service_token.clear()
+    app.blocked_verdicts.clear()
     yield
     app.users = []
+    app.service_token.clear()
+    app.blocked_verdicts.clear()
 
 
 @pytest.fixture
@@ -85,7 +127,7 @@ def mock_http(monkeypatch):
 @pytest.mark.parametrize("is_blocked", (True, False))
 @pytest.mark.parametrize("is_disabled", (True, False))
 async def test_check_blocked(mock_http, is_blocked, is_disabled):
-    app.users = [make_user("alice")]
+    app.users = [UserRecord.from_model(make_user("alice"))]
 
     def handler(req):
         if req.method == "POST":
@@ -112,8 +154,8 @@ async def test_check_blocked(mock_http, is_blocked, is_disabled):
 @pytest.mark.asyncio
 async def test_check_blocked_mix_of_users(mock_http):
     app.users = [
-        make_user("blocked_user"),
-        make_user("ok_user"),
+        UserRecord.from_model(make_user("blocked_user")),
+        UserRecord.from_model(make_user("ok_user")),
     ]
 
     def handler(req):
@@ -135,3 +177,526 @@ async def test_check_blocked_mix_of_users(mock_http):
     # Only blocked_user: server DELETE + user DELETE
     assert len(delete_calls) == 2
     assert all("blocked_user" in c.url for c in delete_calls)
+
+
+@pytest.mark.asyncio
+async def test_check_blocked_concurrent(mock_http):
+    app.users = [UserRecord.from_model(make_user(f"user{i}")) for i in range(20)]
+    running = 0
+    max_running = 0
+
+    async def handler(req):
+        nonlocal running, max_running
+        if req.method == "POST":
+            return _token_ok()
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        if req.method == "DELETE":
+            return MockHTTPResponse(204)
+        return _identity(blocked=int(req.url.split("/")[-2].removeprefix("user")) % 2 == 0)
+
+    client = mock_http(handler=handler)
+    await check_blocked_users(
+        HUB_URL, API_TOKEN, CLIENT_ID, CLIENT_SECRET, AUTH_URL, AUDIENCE, AUTHZ_URL, concurrency=4
+    )
+    assert max_running == 4
+    assert len([c for c in client.calls if "/accounts" in c.url]) == 20
+    # the server and the user of each blocked user are deleted
+    assert len([c for c in client.calls if c.method == "DELETE"]) == 20
+
+
+@pytest.mark.asyncio
+async def test_check_blocked_retries_rate_limited(mock_http):
+    app.users = [UserRecord.from_model(make_user("alice")), UserRecord.from_model(make_user("bob"))]
+    rate_limited = {"alice"}
+
+    def handler(req):
+        if req.method == "POST":
+            return _token_ok()
+        if req.method == "DELETE":
+            return MockHTTPResponse(204)
+        if "/bob/" in req.url:
+            return MockHTTPResponse(404)
+        if rate_limited:
+            rate_limited.clear()
+            return MockHTTPResponse(429, headers={"Retry-After": "0"})
+        return _identity(blocked=True)
+
+    client = mock_http(handler=handler)
+    await check_blocked_users(
+        HUB_URL, API_TOKEN, CLIENT_ID, CLIENT_SECRET, AUTH_URL, AUDIENCE, AUTHZ_URL
+    )
+    assert len([c for c in client.calls if "/alice/accounts" in c.url]) == 2
+    # not found is not retried
+    assert len([c for c in client.calls if "/bob/accounts" in c.url]) == 1
+    assert len([c for c in client.calls if c.method == "DELETE"]) == 2
+
+@pytest.mark.asyncio
+async def test_check_blocked_rate_limit_does_not_pause_hub(mock_http):
+    """The pause requested by the authorization service does not delay the deletions on the Hub"""
+    app.users = [UserRecord.from_model(make_user("alice")), UserRecord.from_model(make_user("bob"))]
+    rate_limited = {"bob"}
+    loop = asyncio.get_running_loop()
+    deleted_at = []
+
+    def handler(req):
+        if req.method == "POST":
+            return _token_ok()
+        if req.method == "DELETE":
+            deleted_at.append(loop.time())
+            return MockHTTPResponse(204)
+        if "/bob/" in req.url and rate_limited:
+            rate_limited.clear()
+            return MockHTTPResponse(429, headers={"Retry-After": "1"})
+        return _identity(blocked="/alice/" in req.url)
+
+    mock_http(handler=handler)
+    start = loop.time()
+    await check_blocked_users(
+        HUB_URL, API_TOKEN, CLIENT_ID, CLIENT_SECRET, AUTH_URL, AUDIENCE, AUTHZ_URL, concurrency=2
+    )
+    assert loop.time() - start >= 1
+    assert len(deleted_at) == 2
+    assert all(t - start < 0.5 for t in deleted_at)
+
+
+@pytest.mark.asyncio
+async def test_check_blocked_caches_service_token(mock_http):
+    app.users = [UserRecord.from_model(make_user("alice"))]
+
+    def handler(req):
+        if req.method == "POST":
+            return _token_ok(expires_in=300)
+        return _identity()
+
+    client = mock_http(handler=handler)
+    for _ in range(3):
+        await check_blocked_users(
+            HUB_URL, API_TOKEN, CLIENT_ID, CLIENT_SECRET, AUTH_URL, AUDIENCE, AUTHZ_URL
+        )
+    assert len([c for c in client.calls if c.method == "POST"]) == 1
+    assert len([c for c in client.calls if "/accounts" in c.url]) == 3
+
+
+@pytest.mark.asyncio
+async def test_check_blocked_unauthorized_renews_service_token(mock_http):
+    """A revoked token is replaced once, and the users are checked with the new one"""
+    app.users = [UserRecord.from_model(make_user(f"user{i}")) for i in range(5)]
+    tokens = iter(["revoked", "renewed"])
+
+    def handler(req):
+        if req.method == "POST":
+            return MockHTTPResponse(200, json.dumps({"access_token": next(tokens), "expires_in": 300}).encode())
+        if req.headers["Authorization"] == "Bearer revoked":
+            return MockHTTPResponse(401)
+        return _identity()
+
+    client = mock_http(handler=handler)
+    await check_blocked_users(
+        HUB_URL, API_TOKEN, CLIENT_ID, CLIENT_SECRET, AUTH_URL, AUDIENCE, AUTHZ_URL, verdict_ttl=300
+    )
+    assert len([c for c in client.calls if c.method == "POST"]) == 2
+    assert len(app.blocked_verdicts) == 5
+    assert app.service_token.get((AUTH_URL, CLIENT_ID, AUDIENCE)) == "renewed"
+
+
+@pytest.mark.asyncio
+async def test_check_blocked_unauthorized_stops(mock_http):
+    """If the new token is rejected too, the remaining users are not checked"""
+    app.users = [UserRecord.from_model(make_user(f"user{i}")) for i in range(20)]
+
+    def handler(req):
+        if req.method == "POST":
+            return _token_ok(expires_in=300)
+        return MockHTTPResponse(401)
+
+    client = mock_http(handler=handler)
+    for _ in range(2):
+        await check_blocked_users(
+            HUB_URL, API_TOKEN, CLIENT_ID, CLIENT_SECRET, AUTH_URL, AUDIENCE, AUTHZ_URL, concurrency=2
+        )
+    # one new token per run, not kept once rejected
+    assert len([c for c in client.calls if c.method == "POST"]) == 4
+    assert len([c for c in client.calls if "/accounts" in c.url]) < 10
+    assert app.service_token.get((AUTH_URL, CLIENT_ID, AUDIENCE)) is None
+
+
+def test_token_cache(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr("swanculler.cache.time.monotonic", lambda: now)
+    cache = TokenCache(margin=60)
+    cache.set("key", "token", expires_in=300)
+    assert cache.get("key") == "token"
+    assert cache.get("other") is None
+    now += 239
+    assert cache.get("key") == "token"
+    now += 1
+    assert cache.get("key") is None
+    # short-lived tokens are kept for half of their lifetime
+    cache.set("key", "token", expires_in=60)
+    now += 29
+    assert cache.get("key") == "token"
+    # tokens without a known lifetime are not kept
+    cache.clear()
+    cache.set("key", "token", expires_in=None)
+    assert cache.get("key") is None
+
+
+@pytest.mark.asyncio
+async def test_check_blocked_caches_verdicts(mock_http, monkeypatch):
+    app.users = [UserRecord.from_model(make_user(name)) for name in ("ok_user", "unknown_user", "broken_user")]
+    blocked = set()
+
+    def handler(req):
+        if req.method == "POST":
+            return _token_ok()
+        if req.method == "DELETE":
+            return MockHTTPResponse(204)
+        name = req.url.split("/")[-2]
+        if name == "unknown_user":
+            return MockHTTPResponse(404)
+        if name == "broken_user":
+            return MockHTTPResponse(500)
+        return _identity(blocked=name in blocked)
+
+    client = mock_http(handler=handler)
+
+    async def check():
+        client.calls.clear()
+        await check_blocked_users(
+            HUB_URL, API_TOKEN, CLIENT_ID, CLIENT_SECRET, AUTH_URL, AUDIENCE, AUTHZ_URL,
+            verdict_ttl=3600, not_found_ttl=3600,
+        )
+        return sorted(c.url.split("/")[-2] for c in client.calls if "/accounts" in c.url)
+
+    assert await check() == ["broken_user", "ok_user", "unknown_user"]
+    # only the users without a verdict are checked again
+    assert await check() == ["broken_user"]
+    # and the new ones
+    app.users.append(UserRecord.from_model(make_user("new_user")))
+    blocked.add("new_user")
+    assert await check() == ["broken_user", "new_user"]
+    assert len([c for c in client.calls if c.method == "DELETE"]) == 2
+    # the blocked users are not cached
+    assert await check() == ["broken_user", "new_user"]
+
+    # stale verdicts are checked again
+    later = time.monotonic() + 3600
+    monkeypatch.setattr("swanculler.cache.time.monotonic", lambda: later)
+    assert await check() == ["broken_user", "new_user", "ok_user", "unknown_user"]
+
+
+@pytest.mark.asyncio
+async def test_check_blocked_no_verdict_ttl(mock_http):
+    app.users = [UserRecord.from_model(make_user("alice"))]
+    mock_http(handler=lambda req: _token_ok() if req.method == "POST" else _identity())
+    await check_blocked_users(
+        HUB_URL, API_TOKEN, CLIENT_ID, CLIENT_SECRET, AUTH_URL, AUDIENCE, AUTHZ_URL
+    )
+    assert len(app.blocked_verdicts) == 0
+
+# ---------------------------------------------------------------------------
+# RetryingFetch
+# ---------------------------------------------------------------------------
+
+def test_retry_after():
+    def error(value):
+        return HTTPClientError(429, response=MockHTTPResponse(429, headers={"Retry-After": value} if value else None))
+
+    assert retry_after(error("5")) == 5
+    assert retry_after(error(None)) is None
+    assert retry_after(error("soon")) is None
+    http_date = (datetime.now(UTC) + timedelta(seconds=30)).strftime("%a, %d %b %Y %H:%M:%S GMT")
+    assert 25 < retry_after(error(http_date)) <= 30
+    assert retry_after(HTTPClientError(599)) is None
+
+
+@pytest.mark.asyncio
+async def test_retrying_fetch_gives_up():
+    responses = [MockHTTPResponse(503), MockHTTPResponse(503), MockHTTPResponse(503)]
+    client = MockHTTPClient(handler=lambda req: responses.pop(0))
+    fetch = RetryingFetch(client, retries=2, backoff=0.001)
+    with pytest.raises(HTTPClientError):
+        await fetch(app.HTTPRequest(url=AUTHZ_URL))
+    assert len(client.calls) == 3
+
+
+@pytest.mark.asyncio
+async def test_retrying_fetch_too_long_retry_after():
+    """The request is not retried if the server asks to wait for too long"""
+    client = MockHTTPClient(handler=lambda req: MockHTTPResponse(429, headers={"Retry-After": "3600"}))
+    fetch = RetryingFetch(client, max_delay=60)
+    with pytest.raises(HTTPClientError):
+        await fetch(app.HTTPRequest(url=AUTHZ_URL))
+    assert len(client.calls) == 1
+
+# ---------------------------------------------------------------------------
+# UserRecord
+# ---------------------------------------------------------------------------
+
+def test_user_record_from_model():
+    user = UserRecord.from_model({
+        "name": "alice",
+        "created": "2024-01-01T00:00:00Z",
+        "last_activity": "2024-01-02T00:00:00.000000Z",
+        "servers": {"": {
+            "started": "2024-01-02T00:00:00+01:00",
+            "last_activity": None,
+            "pending": None,
+            "ready": True,
+            "url": "/user/alice/",
+            "state": {"pod_name": "jupyter-alice"},
+        }},
+    })
+    assert user.name == "alice"
+    assert user.created == datetime(2024, 1, 1, tzinfo=UTC).timestamp()
+    assert user.last_activity == datetime(2024, 1, 2, tzinfo=UTC).timestamp()
+    server = user.servers[""]
+    assert server.started == datetime(2024, 1, 1, 23, tzinfo=UTC).timestamp()
+    assert server.last_activity is None
+    assert server.ready and server.pending is None
+    assert not hasattr(server, "__dict__")
+
+
+def test_user_record_from_model_without_servers():
+    """jupyterhub < 0.9 without named servers only has the default server in the user model"""
+    user = UserRecord.from_model({
+        "name": "bob",
+        "server": "/user/bob/",
+        "pending": None,
+        "last_activity": "2024-01-02 00:00:00",
+    })
+    server = user.servers[""]
+    assert isinstance(server, ServerRecord)
+    assert server.ready
+    assert server.last_activity == datetime(2024, 1, 2, tzinfo=UTC).timestamp()
+    assert UserRecord.from_model({"name": "carol", "server": None}).servers == {}
+
+# ---------------------------------------------------------------------------
+# cull_idle
+# ---------------------------------------------------------------------------
+
+@pytest.mark.asyncio
+async def test_cull_idle_paginated(mock_http):
+    hub_users = [make_user(f"user{i}", inactive=7200 if i % 2 else 0) for i in range(5)]
+    list_users = paginated_users(hub_users)
+
+    def handler(req):
+        if req.method == "DELETE":
+            return MockHTTPResponse(204)
+        return list_users(req)
+
+    client = mock_http(handler=handler)
+    await cull_idle(HUB_URL, API_TOKEN, inactive_limit=3600, disable_hooks=True, page_size=2)
+
+    list_calls = [c for c in client.calls if c.method == "GET"]
+    assert [parse_qs(urlparse(c.url).query)["offset"] for c in list_calls] == [["0"], ["2"], ["4"]]
+    assert all(parse_qs(urlparse(c.url).query)["state"] == ["active"] for c in list_calls)
+    assert all(c.headers["Accept"] == "application/jupyterhub-pagination+json" for c in list_calls)
+
+    delete_calls = [c for c in client.calls if c.method == "DELETE"]
+    assert sorted(c.url for c in delete_calls) == [
+        f"{HUB_URL}/users/user1/server",
+        f"{HUB_URL}/users/user3/server",
+    ]
+    assert [u.name for u in app.users] == [u["name"] for u in hub_users]
+
+
+@pytest.mark.asyncio
+async def test_pending_blocked_user_is_culled(mock_http):
+    """A user whose server is still starting is not culled as idle, but is checked for being blocked"""
+    pending = make_user("alice", inactive=7200)
+    pending["servers"][""].update(pending="spawn", ready=False, url=None)
+
+    def handler(req):
+        if req.method == "POST":
+            return _token_ok()
+        if "/accounts" in req.url:
+            return _identity(blocked=True)
+        if req.method == "DELETE":
+            return MockHTTPResponse(204)
+        return paginated_users([pending])(req)
+
+    client = mock_http(handler=handler)
+    await cull_idle(HUB_URL, API_TOKEN, inactive_limit=3600, disable_hooks=True)
+    assert not [c for c in client.calls if c.method == "DELETE"]
+
+    await check_blocked_users(HUB_URL, API_TOKEN, CLIENT_ID, CLIENT_SECRET, AUTH_URL, AUDIENCE, AUTHZ_URL)
+    assert [c.url for c in client.calls if c.method == "DELETE"] == [
+        f"{HUB_URL}/users/alice/server",
+        f"{HUB_URL}/users/alice",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_cull_idle_lists_all_users_when_culling_users(mock_http):
+    client = mock_http(handler=paginated_users([]))
+    await cull_idle(HUB_URL, API_TOKEN, inactive_limit=3600, cull_users=True, disable_hooks=True)
+    assert "state" not in parse_qs(urlparse(client.calls[0].url).query)
+
+
+@pytest.mark.asyncio
+async def test_cull_idle_deletes_after_listing(mock_http):
+    """Culled users leave the listing, which must not shift the pages still to fetch"""
+    hub_users = [make_user(f"user{i}", inactive=7200) for i in range(6)]
+
+    async def handler(req):
+        if req.method == "DELETE":
+            name = urlparse(req.url).path.split("/")[-2]
+            hub_users[:] = [user for user in hub_users if user["name"] != name]
+            return MockHTTPResponse(204)
+        # slower than the deletions
+        await asyncio.sleep(0.01)
+        return paginated_users(hub_users)(req)
+
+    client = mock_http(handler=handler)
+    await cull_idle(HUB_URL, API_TOKEN, inactive_limit=3600, disable_hooks=True, page_size=2)
+
+    assert len([c for c in client.calls if c.method == "DELETE"]) == 6
+    assert not hub_users
+
+
+@pytest.mark.asyncio
+async def test_cull_idle_listing_waits_for_workers(mock_http, monkeypatch):
+    """The next pages are only listed once the workers can take them"""
+    released = asyncio.Event()
+
+    async def check_ticket(usernames, hooks_dir, max_duration=60):
+        await released.wait()
+        return True
+
+    monkeypatch.setattr("swanculler.app.check_ticket", check_ticket)
+    client = mock_http(handler=paginated_users([make_user(f"user{i}") for i in range(20)]))
+    culling = asyncio.create_task(cull_idle(HUB_URL, API_TOKEN, inactive_limit=3600, page_size=1, workers=2))
+    await asyncio.sleep(0.05)
+    # two users with the workers, two in the queue, and one waiting for a place
+    assert len(client.calls) == 5
+
+    released.set()
+    await culling
+    assert len(client.calls) == 20
+
+
+@pytest.mark.asyncio
+async def test_cull_idle_unpaginated_hub(mock_http):
+    """jupyterhub < 2.0 returns the whole list of users"""
+    hub_users = [make_user("alice"), make_user("bob", inactive=7200)]
+
+    def handler(req):
+        if req.method == "DELETE":
+            return MockHTTPResponse(204)
+        return MockHTTPResponse(200, json.dumps(hub_users).encode())
+
+    client = mock_http(handler=handler)
+    await cull_idle(HUB_URL, API_TOKEN, inactive_limit=3600, disable_hooks=True)
+    assert len([c for c in client.calls if c.method == "GET"]) == 1
+    assert [c.url for c in client.calls if c.method == "DELETE"] == [f"{HUB_URL}/users/bob/server"]
+
+
+@pytest.mark.asyncio
+async def test_cull_idle_bounded_workers(mock_http, monkeypatch):
+    """No more users than workers are handled at the same time"""
+    hub_users = [make_user(f"user{i}", inactive=7200) for i in range(20)]
+    list_users = paginated_users(hub_users)
+    running = 0
+    max_running = 0
+
+    async def delete_server(user_name, server_name, url, auth_header, fetch):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return MockHTTPResponse(204)
+
+    monkeypatch.setattr("swanculler.app.delete_server", delete_server)
+    mock_http(handler=list_users)
+    await cull_idle(HUB_URL, API_TOKEN, inactive_limit=3600, disable_hooks=True, page_size=5, workers=3)
+    assert max_running == 3
+    assert len(app.users) == 20
+
+
+# ---------------------------------------------------------------------------
+# Ticket checks
+# ---------------------------------------------------------------------------
+
+@pytest.fixture
+def ticket_script(monkeypatch, tmp_path):
+    """Runs the given shell script instead of check_ticket.sh, and returns the file logging its calls"""
+    calls = tmp_path / "calls"
+
+    def _create(script='echo "$@" >> "$CALLS"'):
+        monkeypatch.setenv("CALLS", str(calls))
+        monkeypatch.setattr(
+            "swanculler.app.ticket_command",
+            lambda hooks_dir, usernames: ["sh", "-c", script, "check_ticket.sh", *usernames],
+        )
+        return calls
+
+    return _create
+
+
+def _failures(reason):
+    return REGISTRY.get_sample_value("swan_culler_ticket_check_failures_total", {"reason": reason}) or 0
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("batch_size, expected_calls", [(0, 5), (2, 3), (10, 1)])
+async def test_cull_idle_checks_tickets(mock_http, ticket_script, batch_size, expected_calls):
+    calls = ticket_script()
+    hub_users = [make_user(f"user{i}") for i in range(5)] + [make_user("idle", inactive=7200)]
+
+    def handler(req):
+        if req.method == "DELETE":
+            return MockHTTPResponse(204)
+        return paginated_users(hub_users)(req)
+
+    mock_http(handler=handler)
+    await cull_idle(HUB_URL, API_TOKEN, inactive_limit=3600, hooks_dir="/hooks", ticket_batch_size=batch_size)
+
+    lines = calls.read_text().splitlines()
+    assert len(lines) == expected_calls
+    # the tickets of the users with a session still alive are checked, once
+    assert sorted(" ".join(lines).split()) == [f"user{i}" for i in range(5)]
+
+
+@pytest.mark.asyncio
+async def test_cull_idle_ticket_timeout_per_user(mock_http, monkeypatch):
+    """A batch of users gets the time to check each of them"""
+    max_durations = []
+
+    async def check_ticket(usernames, hooks_dir, max_duration=60):
+        max_durations.append(max_duration)
+        return True
+
+    monkeypatch.setattr("swanculler.app.check_ticket", check_ticket)
+    mock_http(handler=paginated_users([make_user(f"user{i}") for i in range(5)]))
+    await cull_idle(HUB_URL, API_TOKEN, inactive_limit=3600, ticket_timeout=30, ticket_batch_size=2)
+    assert sorted(max_durations) == [30, 60, 60]
+
+
+@pytest.mark.asyncio
+async def test_check_ticket(ticket_script):
+    calls = ticket_script()
+    assert await check_ticket(["alice", "bob"], "/hooks")
+    assert calls.read_text() == "alice bob\n"
+
+
+@pytest.mark.asyncio
+async def test_check_ticket_failure(ticket_script):
+    ticket_script("exit 3")
+    failures = _failures("exit_code")
+    assert not await check_ticket(["alice"], "/hooks")
+    assert _failures("exit_code") == failures + 1
+
+
+@pytest.mark.asyncio
+async def test_check_ticket_timeout(ticket_script):
+    ticket_script("exec sleep 30")
+    failures = _failures("timeout")
+    start = asyncio.get_running_loop().time()
+    assert not await check_ticket(["alice"], "/hooks", max_duration=0.2)
+    assert asyncio.get_running_loop().time() - start < 5
+    assert _failures("timeout") == failures + 1
@@ -1,8 +1,24 @@
 import os
 
+from jupyterhub.user import User
+
 from ._version import __version__  # noqa: F401
 
 
 def get_templates():
     path = os.path.abspath(__file__)
     return os.path.join(os.path.dirname(path), 'templates')
+
+
+async def get_auth_state(authenticator, user):
+    """Get the auth_state of the user from the authenticator, when it caches them, to avoid decrypting it again
+
+    Services (e.g. the token owner of the user api) have no auth_state.
+    """
+    if not isinstance(user, User):
+        # the cache of the authenticator is indexed by name, which a service could share with a user
+        return None
+    get_user_auth_state = getattr(authenticator, 'get_user_auth_state', None)
+    if get_user_auth_state is not None:
+        return await get_user_auth_state(user)
+    return await user.get_auth_state()
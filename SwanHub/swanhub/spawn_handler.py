@@ -15,6 +15,7 @@ from jupyterhub.utils import maybe_future, url_path_join
 from tornado import web
 from tornado.httputil import url_concat
 
+from . import get_auth_state
 from .handlers_configs import SpawnHandlersConfigs
 
 
@@ -52,7 +53,7 @@ class SpawnHandler(JHSpawnHandler):
 
         elif spawner.pending:
             # If the spawner is pending, show the pending page
-            auth_state = await user.get_auth_state()
+            auth_state = await get_auth_state(self.authenticator, user)
             page = await self.render_template(
                 'spawn_pending.html',
                 for_user=user,
@@ -221,7 +222,7 @@ class SpawnHandler(JHSpawnHandler):
 
     async def _render_form(self, for_user, spawner_options_form, message='', *args, **kwargs):
         configs = SpawnHandlersConfigs.instance()
-        auth_state = await for_user.get_auth_state()
+        auth_state = await get_auth_state(self.authenticator, for_user)
 
         return await self.render_template('spawn.html',
                                     for_user=for_user,
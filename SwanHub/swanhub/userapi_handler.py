@@ -7,6 +7,8 @@ from jupyterhub.scopes import identify_scopes as scopes_identify_scopes
 from jupyterhub.scopes import parse_scopes
 from tornado import web
 
+from . import get_auth_state
+
 
 class SelfAPIHandler(APIHandler):
     """
@@ -62,5 +64,6 @@ class SelfAPIHandler(APIHandler):
         # but not the scopes we added to ensure we could read our own model
         model["scopes"] = sorted(self.expanded_scopes.difference(_added_scopes))
         # SWAN the line bellow was added
-        model['auth_state'] = await user.get_auth_state()
+        # The user api is polled, use the auth_state cached by the authenticator when it does
+        model['auth_state'] = await get_auth_state(self.authenticator, user)
         self.write(json.dumps(model))
@@ -0,0 +1,45 @@
+from types import SimpleNamespace
+
+from jupyterhub import orm
+from jupyterhub.user import User
+from swanhub import get_auth_state
+
+
+class CachingAuthenticator:
+    """Authenticator caching the auth_state of the users by name"""
+
+    def __init__(self, auth_states):
+        self.auth_states = auth_states
+
+    async def get_user_auth_state(self, user):
+        return self.auth_states.get(user.name)
+
+
+def make_user(name, auth_state=None):
+    db = orm.new_session_factory("sqlite:///:memory:")()
+    orm_user = orm.User(name=name)
+    db.add(orm_user)
+    user = User(orm_user, settings={}, db=db)
+
+    async def get_auth_state():
+        return auth_state
+
+    user.get_auth_state = get_auth_state
+    return user
+
+
+async def test_cached_auth_state():
+    authenticator = CachingAuthenticator({"alice": {"access_token": "cached"}})
+    assert await get_auth_state(authenticator, make_user("alice")) == {"access_token": "cached"}
+
+
+async def test_auth_state_without_cache():
+    authenticator = SimpleNamespace()
+    user = make_user("alice", {"access_token": "stored"})
+    assert await get_auth_state(authenticator, user) == {"access_token": "stored"}
+
+
+async def test_service_has_no_auth_state():
+    """A service named like a user does not get the tokens of the user"""
+    authenticator = CachingAuthenticator({"alice": {"access_token": "cached"}})
+    assert await get_auth_state(authenticator, orm.Service(name="alice")) is None
@@ -110,7 +110,12 @@ class SwanKubeSpawner(define_SwanSpawner_from(KubeSpawner)):
     async def _get_user_roles(self, spawner):
         """Fetch user roles from auth state"""
         try:
-            auth_state = await spawner.user.get_auth_state()
+            # Served from memory by authenticators that cache the decrypted auth_state
+            get_user_auth_state = getattr(spawner.authenticator, 'get_user_auth_state', None)
+            if get_user_auth_state is not None:
+                auth_state = await get_user_auth_state(spawner.user)
+            else:
+                auth_state = await spawner.user.get_auth_state()
             user_roles = set(auth_state.get("roles", []))
         except Exception as e:
             self.log.error("Failed to retrieve user roles from auth_state: %s", e, exc_info=True)